@@ -17,6 +17,8 @@ import numpy as np
 
 from director.tasks.taskuserpanel import ImageBasedAffordanceFit
 
+from spartan.utils.mesh_distance import getMeshDistanceIndex
+
 import PythonQt
 from PythonQt import QtGui, QtCore
 
@@ -66,26 +68,14 @@ def computeLandmarkTransform(sourcePoints, targetPoints):
     return t
 
 
-def computePointToSurfaceDistance(pointsPolyData, meshPolyData):
-
-    cl = vtk.vtkCellLocator()
-    cl.SetDataSet(meshPolyData)
-    cl.BuildLocator()
-
+def computePointToSurfaceDistance(pointsPolyData, meshPolyData, maxDistance=distanceToMeshThreshold):
+    '''
+    Returns the distance of each point to the mesh surface, np.inf for points
+    further than maxDistance. The mesh index is cached, so repeated calls
+    with the same mesh only pay for the queries.
+    '''
     points = vnp.getNumpyFromVtk(pointsPolyData, 'Points')
-    dists = np.zeros(len(points))
-
-
-    closestPoint = np.zeros(3)
-    closestPointDist = vtk.mutable(0.0)
-    cellId = vtk.mutable(0)
-    subId = vtk.mutable(0)
-
-    for i in xrange(len(points)):
-        cl.FindClosestPoint(points[i], closestPoint, cellId, subId, closestPointDist)
-        dists[i] = closestPointDist
-
-    return np.sqrt(dists)
+    return getMeshDistanceIndex(meshPolyData, maxDistance).distances(points)
 
 
 class TestFitCamera(object):
@@ -16,6 +16,10 @@ from director import vtkAll as vtk
 from director import vtkNumpy as vnp
 import numpy as np
 
+import spartan.utils.color_features as colorFeatures
+import spartan.utils.pointcloud_index as pointCloudIndex
+import spartan.utils.kinematics as kinematics
+
 
 
 def loadMomapModel(name, meshFile):
@@ -164,40 +168,51 @@ def planReachGoal(goalFrameName='reach goal', startPose=None, planTraj=True, int
             return endPose, info
 
 
-def getLinkFrameSamplesFromPlan(plan, linkName, numberOfSamples=30):
+_kinematics = None
+
+def getKinematics():
+    """
+    BatchKinematics of the robot model, for director poses
+    """
+    global _kinematics
+    if _kinematics is None:
+        urdfFile = drcargs.getDirectorConfig()['urdfConfig']['default']
+        _kinematics = kinematics.BatchKinematics.fromUrdfFile(urdfFile, robotstate.getDrakePoseJointNames())
+    return _kinematics
 
+
+def getLinkTransformSamplesFromPlan(plan, linkName, numberOfSamples=30):
+    """
+    :return: sample times and numberOfSamples x 4 x 4 link to world transforms
+    """
     poseTimes, poses = robotSystem.planPlayback.getPlanPoses(plan)
     poseInterpolator = robotSystem.planPlayback.getPoseInterpolator(poseTimes, poses)
 
     sampleTimes = np.linspace(poseTimes[0], poseTimes[-1], numberOfSamples)
+    samplePoses = np.asarray(poseInterpolator(sampleTimes))
+
+    return sampleTimes, getKinematics().getLinkTransforms(linkName, samplePoses)
 
-    frames = []
-    for sampleTime in sampleTimes:
-        pose = poseInterpolator(sampleTime)
-        linkFrame = ikPlanner.getLinkFrameAtPose(linkName, pose)
-        frames.append(linkFrame)
 
-    return frames
+def getLinkFrameSamplesFromPlan(plan, linkName, numberOfSamples=30):
 
+    _, transforms = getLinkTransformSamplesFromPlan(plan, linkName, numberOfSamples)
+    return [transformUtils.getTransformFromNumpy(t) for t in transforms]
 
-def drawEndEffectorTrajFromPlan(plan=None):
+
+def drawEndEffectorTrajFromPlan(plan=None, numberOfSamples=200):
 
     if plan is None:
         plan = robotSystem.ikPlanner.lastManipPlan
     linkName = getEndEffectorLinkName()
 
-    frames = getLinkFrameSamplesFromPlan(plan, linkName)
+    _, transforms = getLinkTransformSamplesFromPlan(plan, linkName, numberOfSamples)
 
     pointInFrame = np.array(getGraspToHandLink().GetPosition())
-
-    pts = []
-    for f in frames:
-        p = np.array(f.TransformPoint(pointInFrame))
-        pts.append(p)
+    pts = np.matmul(transforms[:, :3, :3], pointInFrame) + transforms[:, :3, 3]
 
     d = DebugData()
-    for p1, p2 in zip(pts, pts[1:]):
-        d.addLine(p1, p2)
+    d.addPolyLine(pts)
 
     vis.updatePolyData(d.getPolyData(), 'end effector traj', parent='debug')
 
@@ -235,12 +250,7 @@ def getPointCloud(name='openni point cloud'):
 
 
 def addHSVArrays(polyData, rgbArrayName='rgb_colors'):
-    import colorsys
-    rgb = vnp.getNumpyFromVtk(polyData, rgbArrayName)/255.0
-    hsv = np.array([colorsys.rgb_to_hsv(*t) for t in rgb])
-    vnp.addNumpyToVtk(polyData, hsv[:,0].copy(), 'hue')
-    vnp.addNumpyToVtk(polyData, hsv[:,1].copy(), 'saturation')
-    vnp.addNumpyToVtk(polyData, hsv[:,2].copy(), 'value')
+    colorFeatures.addColorFeatureArrays(polyData, rgbArrayName, features=['hsv'])
 
 
 def getMaxZCoordinate(polyData):
@@ -255,7 +265,7 @@ def fitSupport(pickPoint=[0.92858565, 0.00213802, 0.30315629]):
 
     t = vtk.vtkTransform()
     t.Translate(pickPoint)
-    polyData = segmentation.cropToBox(polyData, t, [0.3,0.3,0.5])
+    polyData = pointCloudIndex.cropToBox(polyData, t, [0.3,0.3,0.5])
 
     addHSVArrays(polyData)
 
@@ -275,11 +285,7 @@ def fitSupport(pickPoint=[0.92858565, 0.00213802, 0.30315629]):
 
 
 def cropToCylinder(polyData, p1, p2, radius):
-    polyData = segmentation.cropToLineSegment(polyData, p1, p2)
-    if polyData.GetNumberOfPoints():
-        polyData = segmentation.labelDistanceToLine(polyData, p1, p2)
-        polyData = segmentation.thresholdPoints(polyData, 'distance_to_line', [0.0, radius])
-    return polyData
+    return pointCloudIndex.cropToCylinder(polyData, p1, p2, radius)
 
 
 def getSupportSearchPoint(supportName='cylinder'):
@@ -464,6 +470,44 @@ def computePoseCost(pose):
     return np.linalg.norm(robotSystem.ikPlanner.jointController.getPose('q_nom') - pose)
 
 
+# upper bound of the distance in meters from any arm joint axis to the grasp
+# point, so a joint turning by x radians moves the grasp point at most ARM_REACH*x
+ARM_REACH = 1.3
+
+
+def computeReachPlanCostLowerBound(suffix):
+    """
+    Lower bound of computeReachPlanCost(suffix).cost without running IK.
+
+    Turning a joint by x radians moves the grasp point by at most ARM_REACH*x
+    and turns the hand by at most x, so a goal that is d meters and a radians
+    from the grasp frame at q_nom, less the goal tolerances, needs a joint
+    space distance from q_nom of at least max(d/ARM_REACH, a)/sqrt(numJoints).
+    """
+    nominalPose = robotSystem.ikPlanner.jointController.getPose('q_nom')
+    numJoints = len(nominalPose) - len(robotstate.matchJoints('base_'))
+    handToWorld = transformUtils.getTransformFromNumpy(
+        getKinematics().getLinkTransforms(getEndEffectorLinkName(), nominalPose)[0])
+    nominalPos, nominalQuat = transformUtils.poseFromTransform(
+        transformUtils.concatenateTransforms([getGraspToHandLink(), handToWorld]))
+
+    bound = 0.0
+    for goalName in ['pregrasp to world%s' % suffix, 'grasp to world%s' % suffix]:
+        isPregrasp = goalName.startswith('pre')
+        # the tolerances of planReachGoal, the 5 and 20 degree gaze cones
+        # allow rotations of up to 2*20 + 5 degrees
+        positionTolerance = 0.02 if isPregrasp else 0.0
+        angleTolerance = np.radians(45.0) if isPregrasp else 0.0
+
+        goalPos, goalQuat = transformUtils.poseFromTransform(om.findObjectByName(goalName).transform)
+        distance = max(np.linalg.norm(goalPos - nominalPos) - positionTolerance, 0.0)
+        angle = 2.0*np.arccos(min(abs(np.dot(goalQuat, nominalQuat)), 1.0))
+        angle = max(angle - angleTolerance, 0.0)
+        bound += max(distance/ARM_REACH, angle)/np.sqrt(numJoints)
+
+    return bound
+
+
 def computeReachPlanCost(suffix):
 
     goalNames = ['pregrasp to world%s' % suffix,
@@ -496,12 +540,27 @@ def getGraspFrameSuffixes(affordanceName):
     return suffixes
 
 
-def computeReachPlanCosts(affordanceName):
-
+def computeReachPlanCosts(affordanceName, bestFirst=True):
+    """
+    Plans the grasp frames of the affordance in order of their cost lower
+    bound. With bestFirst, stops as soon as a feasible one costs no more
+    than the bound of every grasp frame left, those can't be better, and
+    only the planned grasp frames are in the result. getBestGraspSuffix
+    picks the same grasp frame from it as from all of them.
+    """
     suffixes = getGraspFrameSuffixes(affordanceName)
+    bounds = dict((suffix, computeReachPlanCostLowerBound(suffix)) for suffix in suffixes)
+
     costs = {}
-    for suffix in suffixes:
+    best = None
+    for suffix in sorted(suffixes, key=bounds.get):
+        if bestFirst and best is not None and costs[best].cost <= bounds[suffix]:
+            break
         costs[suffix] = computeReachPlanCost(suffix)
+        if costs[suffix].isFeasible and (best is None or costs[suffix].cost < costs[best].cost):
+            best = suffix
+
+    print 'planned %d of %d grasp frames' % (len(costs), len(suffixes))
     return costs
 
 
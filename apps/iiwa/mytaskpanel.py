@@ -121,12 +121,7 @@ class ImageFitter(ImageBasedAffordanceFit):
         polyData = segmentation.cropToBox(polyData, t, [0.3,0.3,0.5])
 
 
-        import colorsys
-        rgb = vnp.getNumpyFromVtk(polyData, 'rgb_colors')/255.0
-        hsv = np.array([colorsys.rgb_to_hsv(*t) for t in rgb])
-        vnp.addNumpyToVtk(polyData, hsv[:,0].copy(), 'hue')
-        vnp.addNumpyToVtk(polyData, hsv[:,1].copy(), 'saturation')
-        vnp.addNumpyToVtk(polyData, hsv[:,2].copy(), 'value')
+        iiwaplanning.addHSVArrays(polyData)
 
 
         vis.updatePolyData(polyData, 'crop region', colorByName='rgb_colors', visible=False)
@@ -39,14 +39,9 @@ import bot_core as lcmbotcore
 from director.ikparameters import IkParameters
 
 
-# try:
-#     from labelfusion.cameraposes import CameraPoses
-# except:
-#     print "Have you sourced setup_environment_labelfusion.sh in spartan/config?"
-#     quit()
-
 # spartan
 import spartan.utils.utils as spartanUtils
+from spartan.utils.cameraposes import CameraPoses
 import spartan.utils.ros_utils as spartanROSUtils
 from spartan.utils.taskrunner import TaskRunner
 
@@ -946,19 +941,15 @@ cameraPoses is a CameraPoses object
 def addCameraPosesToDataFile(calibrationData, cameraPoses):
     # augment data with matched camera poses
     # NOTE: camera poses are defined relative to first camera frame, hence the first one will look unintialized
-    for index, value in enumerate(calibrationData):
-        transform = cameraPoses.getCameraPoseAtUTime(value['utime'])
-        (pos, quat) = transformUtils.poseFromTransform(transform)
-        calibrationData[index]['camera_frame'] = dict()
-        calibrationData[index]['camera_frame']['quaternion'] = dict()
-        calibrationData[index]['camera_frame']['quaternion']['w'] = float(quat[0])
-        calibrationData[index]['camera_frame']['quaternion']['x'] = float(quat[1])
-        calibrationData[index]['camera_frame']['quaternion']['y'] = float(quat[2])
-        calibrationData[index]['camera_frame']['quaternion']['z'] = float(quat[3])
-        calibrationData[index]['camera_frame']['translation'] = dict()
-        calibrationData[index]['camera_frame']['translation']['x'] = float(pos[0])
-        calibrationData[index]['camera_frame']['translation']['y'] = float(pos[1])
-        calibrationData[index]['camera_frame']['translation']['z'] = float(pos[2])
+    # all entries are matched and interpolated in one batched lookup
+    utimes = np.array([value['utime'] for value in calibrationData], dtype=np.int64)
+    if len(utimes) == 0:
+        return calibrationData
+
+    positions, quaternions = cameraPoses.getCameraPosesAtUTimes(utimes)
+
+    for value, pos, quat in zip(calibrationData, positions.tolist(), quaternions.tolist()):
+        value['camera_frame'] = spartanUtils.dictFromPosQuat(pos, quat)
 
     return calibrationData
 
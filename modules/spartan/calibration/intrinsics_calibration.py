@@ -1,17 +1,49 @@
 import os
+import glob
 import argparse
+import tarfile
 import yaml
+import numpy as np
+import cv2
 import spartan.utils.utils as spartanUtils
 
 
+"""
+Native intrinsics calibration.
+
+Chessboard corners are detected once per image and cached in a .npz file next to
+the images, so re-running the calibration (e.g. with a different frame budget)
+doesn't touch the images again.
+
+Frames are fed one at a time into IntrinsicsCalibrator. A frame is only kept if
+it covers a part of the (x, y, size, skew) space that no kept frame covers yet,
+which is the same heuristic the ROS camera_calibration GUI uses. The number of
+kept frames is capped, and calibrateCamera is only re-run (warm started from the
+previous solution) every few kept frames, so the total work is linear in the
+number of frames captured rather than quadratic.
+
+The result is written directly as a ROS camera_info yaml, e.g.
+
+    python intrinsics_calibration.py --rgb --camera_name carmine_1 --images "/path/to/*_rgb.png"
+
+The ROS camera_calibration GUI workflow is still supported, just don't pass --images,
+the ost.yaml is then read straight out of /tmp/calibrationdata.tar.gz.
+"""
+
+DEFAULT_PATTERN_SIZE = (7, 6)
+DEFAULT_SQUARE_SIZE = 0.0256
+
+CORNER_CACHE_FILENAME = 'chessboard_corners.npz'
+
+
 def extract_intrinsics(path_to_tar_file, path_to_camera_info_yaml_file,
                        camera_name):
-    cmd = 'mkdir -p /tmp/calibrationdata'
-    os.system(cmd)
-    cmd = 'tar xvf ' + path_to_tar_file + ' -C ' + '/tmp/calibrationdata' + ' > /dev/null 2>&1'
-    os.system(cmd)
-
-    camera_info_dict = spartanUtils.getDictFromYamlFilename('/tmp/calibrationdata/ost.yaml')
+    """
+    Copies the ost.yaml produced by the ROS camera_calibration GUI into
+    the camera_config folder. The tar file is read in memory, nothing is extracted to disk.
+    """
+    with tarfile.open(path_to_tar_file, 'r:*') as tar:
+        camera_info_dict = yaml.load(tar.extractfile('ost.yaml'))
 
     print camera_info_dict
 
@@ -20,12 +52,322 @@ def extract_intrinsics(path_to_tar_file, path_to_camera_info_yaml_file,
     spartanUtils.saveToYaml(camera_info_dict, path_to_camera_info_yaml_file)
 
 
+def make_chessboard_object_points(pattern_size=DEFAULT_PATTERN_SIZE, square_size=DEFAULT_SQUARE_SIZE):
+    """
+    Returns the 3D location of the chessboard corners in the board frame
+    :param pattern_size: (num_cols, num_rows) of inner corners
+    :param square_size: edge length of a single square in meters
+    :return: N x 3 np.float32 array
+    """
+    objp = np.zeros((pattern_size[0]*pattern_size[1], 3), np.float32)
+    objp[:, :2] = np.mgrid[0:pattern_size[0], 0:pattern_size[1]].T.reshape(-1, 2)
+    objp *= square_size
+    return objp
+
+
+def detect_chessboard_corners(image, pattern_size=DEFAULT_PATTERN_SIZE):
+    """
+    Detects chessboard corners, with subpixel refinement
+    :param image: opencv image, either grayscale or BGR
+    :return: N x 2 np.float32 array of corners, or None if the board wasn't found
+    """
+    if image.ndim == 3:
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    else:
+        gray = image
+
+    if gray.dtype != np.uint8:
+        gray = cv2.normalize(gray, None, 0, 255, cv2.NORM_MINMAX).astype(np.uint8)
+
+    ret, corners = cv2.findChessboardCorners(gray, pattern_size, None)
+    if not ret:
+        return None
+
+    criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 30, 0.001)
+    cv2.cornerSubPix(gray, corners, (11, 11), (-1, -1), criteria)
+    return corners.reshape(-1, 2)
+
+
+def load_cached_chessboard_corners(image_filenames, pattern_size=DEFAULT_PATTERN_SIZE, cache_filename=None):
+    """
+    Returns the chessboard detections for a list of images. Detections are
+    read from / written to a cache file so each image is only processed once.
+
+    :param image_filenames: list of image filenames
+    :param cache_filename: defaults to chessboard_corners.npz in the folder of the first image
+    :return: tuple (detections, image_size). detections is a list of (filename, corners)
+    for every image where the board was found, image_size is (width, height)
+    :rtype: tuple
+    """
+    if len(image_filenames) == 0:
+        raise ValueError("no images to detect chessboard corners in")
+
+    if cache_filename is None:
+        cache_filename = os.path.join(os.path.dirname(image_filenames[0]), CORNER_CACHE_FILENAME)
+
+    cache = dict()
+    image_size = None
+    if os.path.exists(cache_filename):
+        data = np.load(cache_filename)
+        if tuple(data['pattern_size']) == tuple(pattern_size):
+            image_size = tuple(data['image_size'])
+            for name, corners in zip(data['filenames'], data['corners']):
+                cache[str(name)] = corners
+            for name in data['failed_filenames']:
+                cache[str(name)] = None
+
+    cache_dirty = False
+    detections = []
+    for filename in image_filenames:
+        key = os.path.basename(filename)
+        if key not in cache:
+            image = cv2.imread(filename, cv2.IMREAD_UNCHANGED)
+            if image is None:
+                raise ValueError("unable to read image %s" % filename)
+            image_size = (image.shape[1], image.shape[0])
+            cache[key] = detect_chessboard_corners(image, pattern_size)
+            cache_dirty = True
+
+        if cache[key] is not None:
+            detections.append((filename, cache[key]))
+
+    if cache_dirty:
+        found = [k for k in sorted(cache.keys()) if cache[k] is not None]
+        failed = [k for k in sorted(cache.keys()) if cache[k] is None]
+        num_corners = pattern_size[0]*pattern_size[1]
+        corners = np.zeros((len(found), num_corners, 2), np.float32)
+        for i, k in enumerate(found):
+            corners[i] = cache[k]
+
+        np.savez(cache_filename, filenames=np.array(found), failed_filenames=np.array(failed),
+                 corners=corners, image_size=np.array(image_size),
+                 pattern_size=np.array(pattern_size))
+
+    return detections, image_size
+
+
+class IntrinsicsCalibrator(object):
+    """
+    Incremental intrinsics calibration from chessboard detections.
+
+    Usage:
+
+        calibrator = IntrinsicsCalibrator((640, 480))
+        for corners in detections:
+            calibrator.add_corners(corners)
+        result = calibrator.solve()
+    """
+
+    def __init__(self, image_size, pattern_size=DEFAULT_PATTERN_SIZE, square_size=DEFAULT_SQUARE_SIZE,
+                 max_frames=40, solve_every=5, num_position_bins=5, num_size_bins=3, num_skew_bins=3):
+        """
+        :param image_size: (width, height)
+        :param max_frames: maximum number of frames used in the solve, bounds the solve time
+        :param solve_every: re-solve after this many newly selected frames
+        """
+        self.image_size = tuple(image_size)
+        self.pattern_size = tuple(pattern_size)
+        self.object_points = make_chessboard_object_points(pattern_size, square_size)
+        self.max_frames = max_frames
+        self.solve_every = solve_every
+        self.bins = np.array([num_position_bins, num_position_bins, num_size_bins, num_skew_bins])
+
+        self.selected_corners = []
+        self.selected_params = []
+        self.occupied_bins = set()
+        self.num_frames_seen = 0
+        self.num_frames_since_solve = 0
+
+        self.camera_matrix = None
+        self.distortion_coefficients = None
+        self.reprojection_error = None
+
+    def compute_board_params(self, corners):
+        """
+        Summarizes a detection by where the board is in the image, how
+        large it is and how skewed it is. All values are in [0, 1]
+
+        :param corners: N x 2 array of corners
+        :return: np.array [x, y, size, skew]
+        """
+        corners = corners.reshape(-1, 2)
+        width, height = self.image_size
+        cols, rows = self.pattern_size
+
+        # outer corners in order: top left, top right, bottom right, bottom left
+        quad = corners[[0, cols - 1, cols*rows - 1, (rows - 1)*cols]]
+
+        # shoelace formula for the area of the outer quadrilateral
+        x = quad[:, 0]
+        y = quad[:, 1]
+        area = 0.5*np.abs(np.dot(x, np.roll(y, 1)) - np.dot(y, np.roll(x, 1)))
+
+        # angle at the top right corner, 90 deg means no skew
+        a = quad[0] - quad[1]
+        b = quad[2] - quad[1]
+        cos_angle = np.dot(a, b)/(np.linalg.norm(a)*np.linalg.norm(b))
+        skew = min(1.0, 2.0*np.abs(np.pi/2 - np.arccos(np.clip(cos_angle, -1, 1))))
+
+        mean = corners.mean(axis=0)
+        params = np.array([mean[0]/width, mean[1]/height, np.sqrt(area/(width*height)), skew])
+        return np.clip(params, 0, 1)
+
+    def bin_from_params(self, params):
+        return tuple(np.minimum((params*self.bins).astype(int), self.bins - 1))
+
+    def add_corners(self, corners):
+        """
+        Adds a single detection. The detection is kept only if it covers
+        a new bin of the (x, y, size, skew) space and the frame budget
+        hasn't been used up.
+
+        :param corners: N x 2 array of corners
+        :return: True if the frame was selected
+        :rtype: bool
+        """
+        self.num_frames_seen += 1
+        if len(self.selected_corners) >= self.max_frames:
+            return False
+
+        params = self.compute_board_params(corners)
+        board_bin = self.bin_from_params(params)
+        if board_bin in self.occupied_bins:
+            return False
+
+        self.occupied_bins.add(board_bin)
+        self.selected_corners.append(np.asarray(corners, dtype=np.float32).reshape(-1, 1, 2))
+        self.selected_params.append(params)
+        self.num_frames_since_solve += 1
+
+        if self.num_frames_since_solve >= self.solve_every:
+            self.solve()
+
+        return True
+
+    def coverage(self):
+        """
+        Fraction of the range of each of x, y, size, skew that the selected frames span
+        :return: np.array [x, y, size, skew]
+        """
+        if len(self.selected_params) == 0:
+            return np.zeros(4)
+
+        params = np.array(self.selected_params)
+        return params.max(axis=0) - params.min(axis=0)
+
+    def solve(self):
+        """
+        Runs calibrateCamera on the selected frames, warm started from
+        the previous solution if there is one.
+
+        :return: dict with camera_matrix, distortion_coefficients and reprojection_error
+        :rtype: dict
+        """
+        if len(self.selected_corners) < 3:
+            raise ValueError("need at least 3 chessboard detections to calibrate, have %d" % len(self.selected_corners))
+
+        object_points = [self.object_points]*len(self.selected_corners)
+
+        flags = 0
+        camera_matrix = None
+        distortion_coefficients = None
+        if self.camera_matrix is not None:
+            flags = cv2.CALIB_USE_INTRINSIC_GUESS
+            camera_matrix = self.camera_matrix.copy()
+            distortion_coefficients = self.distortion_coefficients.copy()
+
+        rms, camera_matrix, distortion_coefficients, _, _ = cv2.calibrateCamera(
+            object_points, self.selected_corners, self.image_size,
+            camera_matrix, distortion_coefficients, flags=flags)
+
+        self.camera_matrix = camera_matrix
+        self.distortion_coefficients = distortion_coefficients.reshape(-1)[:5]
+        self.reprojection_error = rms
+        self.num_frames_since_solve = 0
+
+        return self.get_result()
+
+    def get_result(self):
+        d = dict()
+        d['camera_matrix'] = self.camera_matrix
+        d['distortion_coefficients'] = self.distortion_coefficients
+        d['reprojection_error'] = self.reprojection_error
+        d['num_frames_seen'] = self.num_frames_seen
+        d['num_frames_used'] = len(self.selected_corners)
+        d['coverage'] = self.coverage()
+        return d
+
+
+def camera_info_dict_from_intrinsics(camera_name, camera_matrix, distortion_coefficients, image_size):
+    """
+    Makes a dict in the same format as the ROS camera_info yaml files in camera_config/data
+
+    :param image_size: (width, height)
+    """
+    def matrix_dict(data, rows, cols):
+        d = dict()
+        d['rows'] = rows
+        d['cols'] = cols
+        d['data'] = [float(x) for x in np.asarray(data).flatten()]
+        return d
+
+    projection_matrix = np.zeros((3, 4))
+    projection_matrix[:, :3] = camera_matrix
+
+    d = dict()
+    d['camera_name'] = camera_name
+    d['image_width'] = int(image_size[0])
+    d['image_height'] = int(image_size[1])
+    d['distortion_model'] = 'plumb_bob'
+    d['camera_matrix'] = matrix_dict(camera_matrix, 3, 3)
+    d['distortion_coefficients'] = matrix_dict(distortion_coefficients, 1, 5)
+    d['rectification_matrix'] = matrix_dict(np.eye(3), 3, 3)
+    d['projection_matrix'] = matrix_dict(projection_matrix, 3, 4)
+    return d
+
+
+def calibrate_intrinsics_from_images(image_filenames, path_to_camera_info_yaml_file, camera_name,
+                                     pattern_size=DEFAULT_PATTERN_SIZE, square_size=DEFAULT_SQUARE_SIZE,
+                                     max_frames=40, solve_every=5):
+    """
+    Runs the full pipeline: cached corner detection, incremental frame selection
+    and calibration, then writes the camera_info yaml.
+
+    :return: the dict returned by IntrinsicsCalibrator.get_result()
+    :rtype: dict
+    """
+    detections, image_size = load_cached_chessboard_corners(image_filenames, pattern_size)
+
+    calibrator = IntrinsicsCalibrator(image_size, pattern_size=pattern_size, square_size=square_size,
+                                      max_frames=max_frames, solve_every=solve_every)
+
+    for _, corners in detections:
+        calibrator.add_corners(corners)
+
+    result = calibrator.solve()
+
+    print "detected chessboard in %d of %d images, calibrated using %d" \
+          % (len(detections), len(image_filenames), result['num_frames_used'])
+    print "reprojection error %.3f pixels" % result['reprojection_error']
+
+    camera_info_dict = camera_info_dict_from_intrinsics(camera_name, result['camera_matrix'],
+                                                        result['distortion_coefficients'], image_size)
+    spartanUtils.saveToYaml(camera_info_dict, path_to_camera_info_yaml_file)
+
+    return result
+
+
 if __name__ == '__main__':
 
     parser = argparse.ArgumentParser()
     parser.add_argument('--camera_name', default='xtion_pro')
     parser.add_argument('--rgb', default=False, action='store_true')
     parser.add_argument('--ir', default=False, action='store_true')
+    parser.add_argument('--images', default=None, help='glob of chessboard images, e.g. "/path/*_rgb.png". '
+                                                       'If not given the ROS camera_calibration output is used')
+    parser.add_argument('--pattern_size', default=DEFAULT_PATTERN_SIZE, type=int, nargs=2)
+    parser.add_argument('--square_size', default=DEFAULT_SQUARE_SIZE, type=float)
+    parser.add_argument('--max_frames', default=40, type=int)
     args = parser.parse_args()
 
     camera_info_filename = ""
@@ -41,6 +383,11 @@ if __name__ == '__main__':
                  'src/catkin_projects/camera_config/data', args.camera_name,
                  'master', camera_info_filename)
 
-    path_to_tar_file = '/tmp/calibrationdata.tar.gz'
-    extract_intrinsics(path_to_tar_file, path_to_camera_info_yaml_file,
-                       args.camera_name)
+    if args.images is not None:
+        calibrate_intrinsics_from_images(sorted(glob.glob(args.images)), path_to_camera_info_yaml_file,
+                                         args.camera_name, pattern_size=tuple(args.pattern_size),
+                                         square_size=args.square_size, max_frames=args.max_frames)
+    else:
+        path_to_tar_file = '/tmp/calibrationdata.tar.gz'
+        extract_intrinsics(path_to_tar_file, path_to_camera_info_yaml_file,
+                           args.camera_name)
@@ -71,9 +71,9 @@ def setupRLGDirector(globalsDict=None):
     globalsDict['treeViewer'].subscriber.setSpeedLimit(5)
 
     #
-    ros_visualizer = DirectorROSVisualizer(tf_buffer=tfBuffer)
+    ros_visualizer = DirectorROSVisualizer(tf_buffer=tfBuffer, point_budget=200000)
     topic = "/camera_carmine_1/depth/points"
-    ros_visualizer.add_subscriber(topic, name="Carmine", visualize=True)
+    ros_visualizer.add_subscriber(topic, name="Carmine", visualize=True, voxel_size=0.005)
     globalsDict['ros_visualizer'] = ros_visualizer
     ros_visualizer.start()
 
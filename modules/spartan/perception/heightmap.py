@@ -0,0 +1,199 @@
+# system
+import numpy as np
+
+# spartan
+import spartan.perception.utils as perception_utils
+from spartan.utils.pointcloud2_utils import PointCloud2Encoder
+
+
+class HeightMap(object):
+    """
+    2.5D height map over a regular x-y grid, fused over multiple frames.
+
+    Each inserted pointcloud is stride decimated to a few points per cell,
+    binned into the grid and reduced to the max height per cell, all
+    vectorized. Frames are then fused incrementally:
+    every cell keeps an exponentially decayed, weighted average of its
+    per-frame heights. Cells that haven't been observed for a while decay
+    below min_weight and are reported as empty again, so moving objects
+    don't leave stale heights behind.
+
+    Usage:
+
+        hm = HeightMap.make_default()
+        hm.insert_pointcloud_into_heightmap(pc, T_world_camera)
+        heights = hm.get_heightmap()  # (num_x, num_y), NaN where empty
+        pc_hm = hm.heightmap_to_pointcloud()
+    """
+
+    def __init__(self, config):
+        self._config = config
+        self._x_min, self._x_max = config['x_range']
+        self._y_min, self._y_max = config['y_range']
+        self._z_min, self._z_max = config['z_range']
+        self._resolution = float(config['resolution'])
+        self._decay = config['decay']
+        self._max_points_per_cell = config.get('max_points_per_cell')
+        self._min_weight = config['min_weight']
+
+        self._num_x = int(np.ceil((self._x_max - self._x_min)/self._resolution - 1e-6))
+        self._num_y = int(np.ceil((self._y_max - self._y_min)/self._resolution - 1e-6))
+
+        self._frame_heights = np.empty(self._num_x*self._num_y, dtype=np.float32)
+        self._pointcloud_encoder = None
+        self.reset()
+
+    @staticmethod
+    def default_config():
+        """
+        Table in front of the robot, expressed in the robot base frame
+        """
+        config = dict()
+        config['x_range'] = [0.3, 0.9]
+        config['y_range'] = [-0.4, 0.4]
+        config['z_range'] = [-0.1, 0.5]
+        config['resolution'] = 0.005
+
+        # frames are stride decimated to at most this many points per cell of
+        # the map before binning, about a 640 x 480 cloud at stride 4 by
+        # default, None keeps every point
+        config['max_points_per_cell'] = 4
+
+        # weight of the past relative to a new frame, 0 means only the latest frame counts
+        config['decay'] = 0.9
+
+        # cells with a lower (decayed) weight are considered empty
+        config['min_weight'] = 0.5
+        return config
+
+    @staticmethod
+    def make_default():
+        return HeightMap(HeightMap.default_config())
+
+    @property
+    def config(self):
+        return self._config
+
+    @property
+    def shape(self):
+        return (self._num_x, self._num_y)
+
+    @property
+    def resolution(self):
+        return self._resolution
+
+    def reset(self):
+        """
+        Clears all fused data
+        """
+        num_cells = self._num_x*self._num_y
+        self._height_sums = np.zeros(num_cells, dtype=np.float32)
+        self._weights = np.zeros(num_cells, dtype=np.float32)
+        self._counts = np.zeros(num_cells, dtype=np.int32)
+        self._num_frames = 0
+
+    def cell_indices(self, points):
+        """
+        :param points: N x 3 array in the heightmap frame
+        :return: tuple (flat_index, valid), flat_index is the flattened cell index
+        of each valid point, valid is the length N mask of points inside the bounds
+        :rtype: tuple
+        """
+        x = points[:, 0]
+        y = points[:, 1]
+        z = points[:, 2]
+
+        # NaNs compare False so they are dropped here as well
+        valid = (x >= self._x_min) & (x < self._x_max) & \
+                (y >= self._y_min) & (y < self._y_max) & \
+                (z >= self._z_min) & (z <= self._z_max)
+
+        ix = ((x[valid] - self._x_min)/self._resolution).astype(np.int64)
+        iy = ((y[valid] - self._y_min)/self._resolution).astype(np.int64)
+        np.minimum(ix, self._num_x - 1, out=ix)
+        np.minimum(iy, self._num_y - 1, out=iy)
+
+        return ix*self._num_y + iy, valid
+
+    def insert_pointcloud_into_heightmap(self, pointcloud, T=None):
+        """
+        Fuses a single frame into the heightmap.
+
+        :param pointcloud: N x 3 array or H x W x 3 organized cloud, may contain NaNs
+        :param T: 4 x 4 transform from the pointcloud frame to the heightmap frame,
+        None if the points are already in the heightmap frame
+        :return: number of points that fell inside the heightmap
+        :rtype: int
+        """
+        points = np.asarray(pointcloud).reshape(-1, 3)
+
+        # consecutive points of a depth image are neighboring pixels, keeping
+        # every k-th one still leaves several per cell as long as k pixels
+        # span less than a cell. Peaks narrower than that can be missed.
+        if self._max_points_per_cell is not None:
+            points = perception_utils.stride_downsample(
+                points, self._max_points_per_cell*self._num_x*self._num_y)
+
+        if T is not None:
+            points = perception_utils.transform_pointcloud(points, T)
+
+        flat_index, valid = self.cell_indices(points)
+
+        # max height per cell for this frame
+        frame_heights = self._frame_heights
+        frame_heights.fill(-np.inf)
+        perception_utils.scatter_max(frame_heights, flat_index, points[valid, 2].astype(np.float32))
+        observed = np.isfinite(frame_heights)
+
+        # decay the past, then add this frame with weight 1
+        self._height_sums *= self._decay
+        self._weights *= self._decay
+        self._height_sums[observed] += frame_heights[observed]
+        self._weights[observed] += 1.0
+        self._counts[observed] += 1
+        self._num_frames += 1
+
+        return len(flat_index)
+
+    def get_heightmap(self):
+        """
+        :return: (num_x, num_y) float32 array of fused heights, NaN for empty cells.
+        Element [i, j] is the cell centered at x_min + (i + 0.5)*resolution, y_min + (j + 0.5)*resolution
+        :rtype: np.ndarray
+        """
+        heights = np.full(self._num_x*self._num_y, np.nan, dtype=np.float32)
+        occupied = self._weights >= self._min_weight
+        heights[occupied] = self._height_sums[occupied]/self._weights[occupied]
+        return heights.reshape(self._num_x, self._num_y)
+
+    def get_counts(self):
+        """
+        :return: (num_x, num_y) array, number of frames each cell was observed in
+        :rtype: np.ndarray
+        """
+        return self._counts.reshape(self._num_x, self._num_y)
+
+    def heightmap_to_pointcloud(self):
+        """
+        :return: M x 3 float32 array with one point at the center of each non-empty
+        cell, at the cell height
+        :rtype: np.ndarray
+        """
+        heights = self.get_heightmap().reshape(-1)
+        occupied = np.flatnonzero(np.isfinite(heights))
+        ix, iy = np.divmod(occupied, self._num_y)
+
+        pointcloud = np.empty((len(occupied), 3), dtype=np.float32)
+        pointcloud[:, 0] = self._x_min + (ix + 0.5)*self._resolution
+        pointcloud[:, 1] = self._y_min + (iy + 0.5)*self._resolution
+        pointcloud[:, 2] = heights[occupied]
+        return pointcloud
+
+    def heightmap_to_pointcloud2_msg(self, frame_id=None, stamp=None):
+        """
+        :return: the heightmap_to_pointcloud() points as a packed float32 sensor_msgs/PointCloud2
+        """
+        if self._pointcloud_encoder is None:
+            self._pointcloud_encoder = PointCloud2Encoder()
+
+        return self._pointcloud_encoder.encode(self.heightmap_to_pointcloud(), frame_id=frame_id, stamp=stamp)
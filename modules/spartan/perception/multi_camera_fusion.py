@@ -0,0 +1,321 @@
+# system
+import threading
+import collections
+import numpy as np
+
+# ROS
+import rospy
+import ros_numpy
+import tf2_ros
+import sensor_msgs.msg
+
+# spartan
+import spartan.perception.utils as perception_utils
+import spartan.utils.pointcloud2_utils as pointcloud2_utils
+from spartan.perception.camera_model import SENSOR_FILES, get_camera_extrinsics
+
+
+"""
+Fuses the point clouds of several cameras into a single cloud in a common
+reference frame.
+
+Each camera gets a fixed slot in one preallocated float32 buffer. A new
+cloud is transformed straight into its camera's slot with the cached
+extrinsic (a single np.dot with out= plus the translation), nothing is
+reallocated per frame. Fusing then concatenates the slots of the cameras
+that are in sync into a second preallocated buffer and dedupes the
+overlapping regions with a voxel hash (perception_utils.voxel_hash_downsample,
+no sorting), so all the work is linear in the total number of points, i.e.
+in the number of cameras.
+
+Usage:
+
+    fusion = MultiCameraFusion(voxel_size=0.005, sync_tolerance=0.05)
+    fusion.add_camera("d415_01", T_base_d415_01)
+    fusion.add_camera("d415_02", T_base_d415_02)
+
+    fusion.update("d415_01", points_1, stamp_1)
+    fusion.update("d415_02", points_2, stamp_2)
+    points, stamp, cameras = fusion.fuse()
+"""
+
+# substrings of the optical frame names that tell which sensor a cloud is in
+SENSOR_FRAME_KEYWORDS = {
+    'depth': ['depth'],
+    'rgb': ['rgb', 'color'],
+}
+
+
+def sensor_from_frame_id(frame_id):
+    """
+    :return: 'depth' or 'rgb', None if frame_id doesn't name exactly one of them,
+    e.g. "camera_carmine_1_rgb_optical_frame" -> 'rgb'
+    """
+    frame_id = frame_id.lower()
+    sensors = [sensor for sensor, keywords in SENSOR_FRAME_KEYWORDS.items()
+               if any(keyword in frame_id for keyword in keywords)]
+    return sensors[0] if len(sensors) == 1 else None
+
+
+class MultiCameraFusion(object):
+
+    def __init__(self, voxel_size=0.005, sync_tolerance=0.05, max_points_per_camera=640*480):
+        """
+        :param voxel_size: edge length of the voxels used to dedupe, None disables deduping
+        :param sync_tolerance: clouds stamped more than this many seconds before the
+        newest one are left out of the fused cloud
+        :param max_points_per_camera: size of each camera's slot, larger clouds are strided down
+        """
+        self.voxel_size = voxel_size
+        self.sync_tolerance = sync_tolerance
+        self.max_points_per_camera = max_points_per_camera
+
+        self._cameras = collections.OrderedDict()
+        self._points = np.zeros((0, 3), dtype=np.float32)
+        self._fused_points = np.zeros((0, 3), dtype=np.float32)
+        self._lock = threading.Lock()
+
+    @property
+    def camera_names(self):
+        return self._cameras.keys()
+
+    def add_camera(self, name, extrinsics=None):
+        """
+        :param name: camera name, used as the key in update()
+        :param extrinsics: 4 x 4 transform from the cloud frame to the reference frame,
+        can also be set later with set_extrinsics
+        """
+        with self._lock:
+            if name in self._cameras:
+                raise ValueError("camera %s was already added" % name)
+
+            data = dict()
+            data['slot'] = len(self._cameras)
+            data['extrinsics'] = None
+            data['num_points'] = 0
+            data['stamp'] = None
+            self._cameras[name] = data
+
+            # grow the buffers by one slot, only happens at setup
+            num_slots = len(self._cameras)
+            points = np.zeros((num_slots*self.max_points_per_camera, 3), dtype=np.float32)
+            points[:len(self._points)] = self._points
+            self._points = points
+            self._fused_points = np.zeros_like(points)
+
+        if extrinsics is not None:
+            self.set_extrinsics(name, extrinsics)
+
+    def set_extrinsics(self, name, extrinsics):
+        T = np.asarray(extrinsics, dtype=np.float64)
+        data = self._cameras[name]
+        data['extrinsics'] = T
+        data['rotation_transpose'] = np.ascontiguousarray(T[:3, :3].T, dtype=np.float32)
+
+    def has_extrinsics(self, name):
+        return self._cameras[name]['extrinsics'] is not None
+
+    def _slot(self, data):
+        start = data['slot']*self.max_points_per_camera
+        return self._points[start:start + self.max_points_per_camera]
+
+    def update(self, name, points, stamp):
+        """
+        Transforms a new cloud of camera name into the reference frame and
+        stores it, replacing the previous one.
+
+        :param points: N x 3 array of finite points in the camera's cloud frame
+        :param stamp: rospy.Time or float seconds
+        """
+        data = self._cameras[name]
+        if data['extrinsics'] is None:
+            raise ValueError("no extrinsics for camera %s" % name)
+
+        points = perception_utils.stride_downsample(points, self.max_points_per_camera)
+        num_points = len(points)
+
+        with self._lock:
+            slot = self._slot(data)[:num_points]
+            np.dot(np.asarray(points, dtype=np.float32), data['rotation_transpose'], out=slot)
+            for i in xrange(3):
+                slot[:, i] += data['extrinsics'][i, 3]
+
+            data['num_points'] = num_points
+            data['stamp'] = stamp.to_sec() if hasattr(stamp, 'to_sec') else float(stamp)
+
+    def fuse(self):
+        """
+        :return: tuple (points, stamp, cameras). points is an M x 3 float32 array
+        with the clouds of all cameras stamped within sync_tolerance of the newest one,
+        stamp is the newest stamp (float seconds) and cameras the names of the cameras
+        that went in. (None, None, []) if there are no clouds yet. Without deduping
+        points is a view of an internal buffer that is overwritten by the next call.
+        :rtype: tuple
+        """
+        with self._lock:
+            stamps = [data['stamp'] for data in self._cameras.values() if data['stamp'] is not None]
+            if not stamps:
+                return None, None, []
+
+            stamp = max(stamps)
+            cameras = []
+            num_points = 0
+            for name, data in self._cameras.items():
+                if data['stamp'] is None or stamp - data['stamp'] > self.sync_tolerance:
+                    continue
+
+                n = data['num_points']
+                self._fused_points[num_points:num_points + n] = self._slot(data)[:n]
+                num_points += n
+                cameras.append(name)
+
+            points = self._fused_points[:num_points]
+
+        if self.voxel_size is not None:
+            points = perception_utils.voxel_hash_downsample(points, self.voxel_size)
+
+        return points, stamp, cameras
+
+
+class MultiCameraFusionNode(object):
+    """
+    Subscribes to the PointCloud2 topics of several cameras and publishes
+    the fused cloud in reference_frame.
+
+    The extrinsic of each camera is looked up once and cached, either from the
+    camera_config yaml files (composed with the static TF from the calibration's
+    reference link to reference_frame, if they differ) or from TF.
+    The camera_config extrinsics are read at construction. The cloud of e.g.
+    depth_registered/points is in the rgb optical frame, so unless the camera
+    sets 'sensor', the extrinsic is the one of the sensor named in the cloud's
+    frame_id.
+    This is only right for cameras that don't move relative to reference_frame,
+    call refresh_extrinsics() after re-calibrating.
+    """
+
+    def __init__(self, cameras, reference_frame="base", output_topic="/multi_camera_fusion/points",
+                 voxel_size=0.005, sync_tolerance=0.05, tf_buffer=None):
+        """
+        :param cameras: list of dicts with keys 'name', 'topic' and optionally
+        'camera_config' (name of the camera_config folder) and 'sensor' ('depth' or 'rgb',
+        the sensor whose optical frame the cloud is in, by default taken from its frame_id).
+        Cameras without 'camera_config' get their extrinsics from TF.
+        :raises ValueError: if a camera's 'sensor' is invalid or camera_config has no
+        extrinsics for it
+        """
+        self._camera_configs = cameras
+        self.reference_frame = reference_frame
+        self.fusion = MultiCameraFusion(voxel_size=voxel_size, sync_tolerance=sync_tolerance)
+
+        if tf_buffer is None:
+            tf_buffer = tf2_ros.Buffer()
+        self._tf_buffer = tf_buffer
+        self._tf_listener = tf2_ros.TransformListener(self._tf_buffer)
+
+        self._encoder = pointcloud2_utils.PointCloud2Encoder()
+        self._publisher = rospy.Publisher(output_topic, sensor_msgs.msg.PointCloud2, queue_size=1)
+        self._last_published_stamp = None
+        self._resolved_cameras = set()
+
+        # camera name -> sensor -> (extrinsics, reference link name)
+        self._config_extrinsics = dict()
+        for camera in cameras:
+            if 'camera_config' in camera:
+                self._config_extrinsics[camera['name']] = self._load_config_extrinsics(camera)
+
+        self._subscribers = []
+        for camera in cameras:
+            self.fusion.add_camera(camera['name'])
+            self._subscribers.append(rospy.Subscriber(camera['topic'], sensor_msgs.msg.PointCloud2,
+                                                      self._on_pointcloud, callback_args=camera,
+                                                      queue_size=1))
+
+    def _lookup_static_transform(self, target_frame, source_frame):
+        T_stamped = self._tf_buffer.lookup_transform(target_frame, source_frame, rospy.Time(0),
+                                                     rospy.Duration(1.0))
+        return ros_numpy.numpify(T_stamped.transform)
+
+    @staticmethod
+    def _load_config_extrinsics(camera):
+        """
+        :return: dict sensor -> (extrinsics, reference link name) of the sensors
+        of camera['camera_config'] that have extrinsics, only camera['sensor'] if set
+        """
+        sensors = SENSOR_FILES.keys()
+        if 'sensor' in camera:
+            if camera['sensor'] not in SENSOR_FILES:
+                raise ValueError("camera %s: sensor must be one of %s, not %s"
+                                 % (camera['name'], SENSOR_FILES.keys(), camera['sensor']))
+            sensors = [camera['sensor']]
+
+        extrinsics = dict()
+        for sensor in sensors:
+            T, reference_link_name = get_camera_extrinsics(camera['camera_config'], sensor)
+            if T is not None:
+                extrinsics[sensor] = (T, reference_link_name)
+
+        if not extrinsics:
+            raise ValueError("camera %s: camera_config %s has no extrinsics for sensor %s"
+                             % (camera['name'], camera['camera_config'], " or ".join(sensors)))
+        return extrinsics
+
+    def _resolve_extrinsics(self, camera, msg):
+        """
+        :return: 4 x 4 transform from msg.header.frame_id to reference_frame
+        """
+        if 'camera_config' not in camera:
+            return self._lookup_static_transform(self.reference_frame, msg.header.frame_id)
+
+        extrinsics = self._config_extrinsics[camera['name']]
+        sensor = camera.get('sensor', sensor_from_frame_id(msg.header.frame_id))
+        if sensor is None:
+            raise ValueError("can't tell the sensor of frame %s, set 'sensor' of camera %s"
+                             % (msg.header.frame_id, camera['name']))
+        if sensor not in extrinsics:
+            raise ValueError("frame %s is the %s frame, camera_config %s has no extrinsics for it"
+                             % (msg.header.frame_id, sensor, camera['camera_config']))
+
+        T, reference_link_name = extrinsics[sensor]
+        if reference_link_name == self.reference_frame:
+            return T
+
+        T_reference_link = self._lookup_static_transform(self.reference_frame, reference_link_name)
+        return np.dot(T_reference_link, T)
+
+    def refresh_extrinsics(self):
+        """
+        Looks the extrinsics up again on the next cloud of each camera
+        """
+        self._resolved_cameras.clear()
+
+    def _on_pointcloud(self, msg, camera):
+        if camera['name'] not in self._resolved_cameras:
+            try:
+                self.fusion.set_extrinsics(camera['name'], self._resolve_extrinsics(camera, msg))
+                self._resolved_cameras.add(camera['name'])
+            except Exception as e:
+                rospy.logwarn_throttle(5.0, "couldn't get extrinsics for camera %s: %s" % (camera['name'], e))
+                return
+
+        points = pointcloud2_utils.numpy_from_pointcloud2_msg(msg, remove_nans=True)
+        self.fusion.update(camera['name'], points, msg.header.stamp)
+
+    def publish(self):
+        """
+        Fuses and publishes, unless nothing new arrived since the last call
+        :return: True if a cloud was published
+        """
+        points, stamp, cameras = self.fusion.fuse()
+        if points is None or stamp == self._last_published_stamp:
+            return False
+
+        self._last_published_stamp = stamp
+        msg = self._encoder.encode(points, frame_id=self.reference_frame, stamp=rospy.Time.from_sec(stamp))
+        self._publisher.publish(msg)
+        return True
+
+    def run(self, rate=10.0):
+        r = rospy.Rate(rate)
+        while not rospy.is_shutdown():
+            self.publish()
+            r.sleep()
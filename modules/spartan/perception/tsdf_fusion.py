@@ -0,0 +1,218 @@
+# system
+import os
+import sys
+import time
+import collections
+import numpy as np
+import cv2
+from multiprocessing.pool import ThreadPool
+
+# spartan
+import spartan.utils.utils as spartanUtils
+import spartan.utils.cameraposes as cameraposes
+
+Open3D_python_lib_dir = os.path.join(spartanUtils.getSpartanSourceDir(), "src/Open3D/build/lib")
+sys.path.append(Open3D_python_lib_dir)
+import py3d
+
+
+"""
+TSDF fusion of a processed log (images/*_rgb.png, images/*_depth.png and
+posegraph.posegraph) with Open3D.
+
+Decoding the pngs is about as expensive as integrating them, so frames are
+read on a pool of threads (cv2.imread releases the GIL) up to
+max_prefetch frames ahead of the integration, which runs on the calling
+thread. Camera poses are loaded in bulk and inverted all at once, and
+frames that barely moved since the last integrated one can be skipped
+without ever being read.
+
+Usage:
+
+    fusion = TSDFFusion(TSDFFusion.default_config())
+    mesh = fusion.run(log_dir)
+    fusion.print_stats()
+"""
+
+Frame = collections.namedtuple('Frame', ['idx', 'rgb', 'depth', 'decode_time'])
+
+
+def convert_image_idx_to_padded_string(n, numCharacters=6):
+    """
+    Converts the integer n to a padded string with leading zeros
+    """
+    t = str(n)
+    return t.rjust(numCharacters, '0')
+
+
+def select_frames_by_pose_change(positions, quaternions, min_translation, min_rotation):
+    """
+    Greedily picks the frames whose pose differs from the last picked frame
+    by at least min_translation or min_rotation. The first frame is always picked.
+
+    :param positions: N x 3 array
+    :param quaternions: N x 4 array [w,x,y,z]
+    :param min_translation: meters
+    :param min_rotation: radians
+    :return: list of frame indices
+    :rtype: list
+    """
+    num_frames = len(positions)
+    if num_frames == 0:
+        return []
+
+    if min_translation <= 0 and min_rotation <= 0:
+        return range(num_frames)
+
+    # compare cos(angle/2) = |q_a . q_b| instead of computing the angle
+    min_cos_half_angle = np.cos(min_rotation/2.0)
+    quaternions = quaternions/np.linalg.norm(quaternions, axis=1)[:, np.newaxis]
+
+    selected = [0]
+    last = 0
+    for idx in xrange(1, num_frames):
+        moved = min_translation > 0 and np.linalg.norm(positions[idx] - positions[last]) >= min_translation
+        rotated = min_rotation > 0 and abs(np.dot(quaternions[idx], quaternions[last])) <= min_cos_half_angle
+        if moved or rotated:
+            selected.append(idx)
+            last = idx
+
+    return selected
+
+
+class TSDFFusion(object):
+
+    def __init__(self, config):
+        self._config = config
+        self._camera_intrinsics = py3d.PinholeCameraIntrinsic(config['width'], config['height'],
+                                                              config['fx'], config['fy'],
+                                                              config['cx'], config['cy'])
+        self._stats = dict()
+        self.volume = None
+
+    @staticmethod
+    def default_config():
+        config = dict()
+
+        # carmine intrinsics
+        config['width'] = 640
+        config['height'] = 480
+        config['fx'] = 539.075603
+        config['fy'] = 539.782595
+        config['cx'] = 316.229489
+        config['cy'] = 236.154597
+
+        config['voxel_length'] = 4.0/512.0
+        config['sdf_trunc'] = 0.04
+
+        # depth beyond this (in meters) is ignored
+        config['depth_trunc'] = 1.0
+        config['depth_scale'] = 1000.0
+
+        # skip frames that moved less than this since the last integrated frame
+        config['min_translation'] = 0.0 # meters
+        config['min_rotation'] = 0.0 # radians
+
+        config['num_workers'] = 4
+        config['max_prefetch'] = 8
+        return config
+
+    @property
+    def stats(self):
+        return self._stats
+
+    @staticmethod
+    def _load_frame(images_dir, idx):
+        start_time = time.time()
+        prefix = convert_image_idx_to_padded_string(idx)
+        rgb = cv2.imread(os.path.join(images_dir, prefix + "_rgb.png"), cv2.IMREAD_COLOR)
+        depth = cv2.imread(os.path.join(images_dir, prefix + "_depth.png"), cv2.IMREAD_ANYDEPTH)
+        if rgb is None or depth is None:
+            raise IOError("couldn't read images for frame %s in %s" % (prefix, images_dir))
+
+        rgb = cv2.cvtColor(rgb, cv2.COLOR_BGR2RGB)
+        return Frame(idx, rgb, depth, time.time() - start_time)
+
+    def _prefetched_frames(self, images_dir, frame_indices):
+        """
+        Generator over the decoded frames in order, keeping at most
+        max_prefetch frames in flight on the thread pool
+        """
+        pool = ThreadPool(self._config['num_workers'])
+        pending = collections.deque()
+        frame_iter = iter(frame_indices)
+
+        def submit_next():
+            for idx in frame_iter:
+                pending.append(pool.apply_async(TSDFFusion._load_frame, (images_dir, idx)))
+                return
+
+        try:
+            for _ in xrange(self._config['max_prefetch']):
+                submit_next()
+
+            while pending:
+                wait_start = time.time()
+                frame = pending.popleft().get()
+                self._stats['wait_time'] += time.time() - wait_start
+                submit_next()
+                yield frame
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def run(self, log_dir, extract_mesh=True):
+        """
+        Integrates the log into a new TSDF volume
+
+        :param log_dir: processed log folder, containing posegraph.posegraph and images/
+        :return: the triangle mesh, or the volume if extract_mesh is False
+        """
+        config = self._config
+        self._stats = collections.defaultdict(float)
+        start_time = time.time()
+
+        camera_poses = cameraposes.CameraPoses(os.path.join(log_dir, "posegraph.posegraph"))
+        frame_indices = select_frames_by_pose_change(camera_poses.positions, camera_poses.quaternions,
+                                                     config['min_translation'], config['min_rotation'])
+
+        # reconstruction to camera for every frame, in one go
+        reconstruction_to_camera = cameraposes.invert_homogeneous_transforms(camera_poses.getCameraPoseMatrices())
+        self._stats['num_frames'] = len(camera_poses.poseTimes)
+        self._stats['num_integrated'] = len(frame_indices)
+
+        self.volume = py3d.ScalableTSDFVolume(voxel_length=config['voxel_length'],
+                                              sdf_trunc=config['sdf_trunc'], with_color=True)
+
+        images_dir = os.path.join(log_dir, 'images')
+        for frame in self._prefetched_frames(images_dir, frame_indices):
+            self._stats['decode_time'] += frame.decode_time
+
+            integrate_start = time.time()
+            rgbd = py3d.create_rgbd_image_from_color_and_depth(py3d.Image(frame.rgb), py3d.Image(frame.depth),
+                                                               depth_scale=config['depth_scale'],
+                                                               depth_trunc=config['depth_trunc'],
+                                                               convert_rgb_to_intensity=False)
+            self.volume.integrate(rgbd, self._camera_intrinsics, reconstruction_to_camera[frame.idx])
+            self._stats['integrate_time'] += time.time() - integrate_start
+
+        self._stats['fusion_time'] = time.time() - start_time
+
+        if not extract_mesh:
+            return self.volume
+
+        mesh_start_time = time.time()
+        mesh = self.volume.extract_triangle_mesh()
+        mesh.compute_vertex_normals()
+        self._stats['mesh_time'] = time.time() - mesh_start_time
+        return mesh
+
+    def print_stats(self):
+        stats = self._stats
+        print "integrated %d of %d frames" % (stats['num_integrated'], stats['num_frames'])
+        print "decode (summed over %d workers): %.2f seconds" % (self._config['num_workers'], stats['decode_time'])
+        print "waiting on decode: %.2f seconds" % stats['wait_time']
+        print "integration: %.2f seconds" % stats['integrate_time']
+        print "fusion total: %.2f seconds" % stats['fusion_time']
+        if 'mesh_time' in stats:
+            print "extracting triangle mesh: %.2f seconds" % stats['mesh_time']
@@ -0,0 +1,160 @@
+import numpy as np
+
+
+# voxel grids with at most this many cells per input point (plus a constant)
+# are reduced with dense lookup tables, larger ones fall back to sorting
+DENSE_VOXEL_GRID_CELLS_PER_POINT = 4
+DENSE_VOXEL_GRID_MIN_CELLS = 1 << 20
+
+
+def voxel_grid_keys(points, voxel_size):
+    """
+    Computes a single integer key per point identifying the voxel it lies in.
+
+    :param points: N x 3 array of finite points
+    :param voxel_size: edge length of a voxel, in meters
+    :return: tuple (keys, num_cells), keys is a length N np.int64 array with
+    values in [0, num_cells)
+    :rtype: tuple
+    """
+    # points are shifted to be non-negative so truncation is the same as floor
+    voxel_coords = ((points - points.min(axis=0))/voxel_size).astype(np.int64)
+    dims = voxel_coords.max(axis=0) + 1
+    keys = (voxel_coords[:, 0]*dims[1] + voxel_coords[:, 1])*dims[2] + voxel_coords[:, 2]
+    return keys, int(np.prod(dims))
+
+
+def voxel_downsample(points, voxel_size, reduction='first', return_index=False):
+    """
+    Voxel grid downsampling, keeps one point per occupied voxel.
+
+    :param points: N x 3 array of finite points
+    :param voxel_size: edge length of a voxel, in meters
+    :param reduction: 'first' keeps one of the actual points in each voxel (cheapest),
+    'mean' returns the centroid of the points in each voxel
+    :param return_index: also return the indices of the kept points ('first' only)
+    :return: M x 3 array, M <= N
+    :rtype: np.ndarray
+    """
+    if reduction not in ['first', 'mean']:
+        raise ValueError("unknown reduction %s" % reduction)
+
+    if return_index and reduction != 'first':
+        raise ValueError("return_index is only supported for reduction='first'")
+
+    num_points = len(points)
+    if num_points == 0:
+        if return_index:
+            return points, np.zeros(0, dtype=np.int64)
+        return points
+
+    keys, num_cells = voxel_grid_keys(points, voxel_size)
+    dense = num_cells <= DENSE_VOXEL_GRID_CELLS_PER_POINT*num_points + DENSE_VOXEL_GRID_MIN_CELLS
+
+    if reduction == 'first':
+        if dense:
+            # scatter point indices into a lookup table, one survives per voxel
+            table = np.full(num_cells, -1, dtype=np.int64)
+            table[keys] = np.arange(num_points)
+            index = table[table >= 0]
+        else:
+            _, index = np.unique(keys, return_index=True)
+
+        if return_index:
+            return points[index], index
+        return points[index]
+
+    # reduction == 'mean'
+    if dense:
+        bins = keys
+        num_bins = num_cells
+    else:
+        _, bins = np.unique(keys, return_inverse=True)
+        num_bins = bins.max() + 1
+
+    counts = np.bincount(bins, minlength=num_bins)
+    occupied = np.flatnonzero(counts)
+    counts = counts[occupied]
+
+    downsampled = np.empty((len(occupied), 3), dtype=points.dtype)
+    for i in range(3):
+        downsampled[:, i] = np.bincount(bins, weights=points[:, i], minlength=num_bins)[occupied]/counts
+    return downsampled
+
+
+def voxel_hash_downsample(points, voxel_size, table_size_factor=4):
+    """
+    Approximate voxel grid downsampling in linear time, for large sparse grids
+    where voxel_downsample would have to sort.
+
+    The voxel keys are hashed into a table of about table_size_factor*N slots
+    and one point survives per slot. A point whose slot was taken by a point
+    from a different voxel (a hash collision) is kept as well, so the result
+    can contain a few more points than exact downsampling, never fewer voxels.
+
+    :param points: N x 3 array of finite points
+    :param voxel_size: edge length of a voxel, in meters
+    :return: M x 3 array, M <= N
+    :rtype: np.ndarray
+    """
+    num_points = len(points)
+    if num_points == 0:
+        return points
+
+    keys, _ = voxel_grid_keys(points, voxel_size)
+
+    # multiplicative (Fibonacci) hashing, the top bits index the table
+    table_bits = int(np.ceil(np.log2(table_size_factor*num_points)))
+    slots = (keys.astype(np.uint64)*np.uint64(11400714819323198485)) >> np.uint64(64 - table_bits)
+    slots = slots.astype(np.int64)
+
+    point_index = np.arange(num_points)
+    table = np.full(1 << table_bits, -1, dtype=np.int64)
+    table[slots] = point_index
+    winners = table[slots]
+
+    keep = (winners == point_index) | (keys[winners] != keys)
+    return points[keep]
+
+
+def stride_downsample(points, max_points):
+    """
+    Keeps every k-th point so that at most max_points remain.
+
+    :param points: N x D array
+    :param max_points: maximum number of points to return
+    :return: view of points
+    :rtype: np.ndarray
+    """
+    num_points = len(points)
+    if max_points is None or num_points <= max_points:
+        return points
+
+    stride = int(np.ceil(num_points/float(max(max_points, 1))))
+    return points[::stride]
+
+
+def transform_pointcloud(pointcloud, T):
+    """
+    Applies a homogeneous transform to an N x 3 pointcloud.
+
+    :param pointcloud: N x 3 array
+    :param T: 4 x 4 homogeneous transform
+    :return: N x 3 array, same dtype as pointcloud
+    :rtype: np.ndarray
+    """
+    T = np.asarray(T, dtype=pointcloud.dtype)
+    return np.dot(pointcloud, T[:3, :3].T) + T[:3, 3]
+
+
+def scatter_max(values, index, updates):
+    """
+    In place values[index] = max(values[index], updates), with repeated
+    indices handled correctly. Plain fancy assignment would let an
+    arbitrary one of the repeated indices win.
+
+    :param values: 1D array, modified in place
+    :param index: length N integer array into values
+    :param updates: length N array
+    """
+    np.maximum.at(values, index, updates)
@@ -0,0 +1,131 @@
+# system
+import time
+import threading
+import collections
+import numpy as np
+
+# ROS
+import rospy
+import std_srvs.srv
+import std_msgs.msg
+import sensor_msgs.msg
+
+# spartan
+from spartan.teleop.teleop_engine import FixedRateScheduler, SETPOINT_TOPIC
+from spartan.teleop.latency import RECEIPT_TOPIC
+
+# spartan ROS
+import robot_msgs.msg
+import robot_msgs.srv
+
+
+"""
+Stand-in for plan_runner and the arm, for benchmarking the teleop pipeline
+without hardware.
+
+It offers the init_task_space_streaming and stop_plan services, answers
+every task space setpoint on the receipt topic like plan_runner does, and
+publishes /joint_states at state_rate. The simulated end effector starts
+following a setpoint response_delay after it was received, as a first order
+lag with time_constant. The joint positions are a fixed linear function of
+the end effector position, so they move exactly when it does.
+"""
+
+IIWA_JOINT_NAMES = ['iiwa_joint_1', 'iiwa_joint_2', 'iiwa_joint_3', 'iiwa_joint_4', 'iiwa_joint_5',
+                    'iiwa_joint_6', 'iiwa_joint_7']
+
+HOME_POSITION = [0.04486168762069299, 0.3256606458812486, -0.033502080520812445, -1.5769091802934694,
+                 0.05899249087322813, 1.246379583616529, 0.38912999977004026]
+
+
+class FakePlanRunner(object):
+
+    def __init__(self, joint_names=IIWA_JOINT_NAMES, home_position=HOME_POSITION, state_rate=200.,
+                 response_delay=0.005, time_constant=0.05):
+        """
+        :param state_rate: /joint_states rate in Hz
+        :param response_delay: seconds from setpoint receipt until the arm reacts
+        :param time_constant: seconds, of the simulated end effector tracking
+        """
+        self.joint_names = list(joint_names)
+        self.home_position = np.array(home_position, dtype=np.float64)
+        self.scheduler = FixedRateScheduler(state_rate)
+        self.response_delay = response_delay
+        self.time_constant = time_constant
+
+        # joint positions = home + jacobian * (ee position - first setpoint position)
+        self._jacobian = np.random.RandomState(0).uniform(-1., 1., (len(self.joint_names), 3))
+
+        self._lock = threading.Lock()
+        self._streaming = False
+        self._plan_number = 0
+        self._targets = collections.deque()  # (time it takes effect, position)
+        self._target = None
+        self._ee_origin = None
+        self._ee_position = None
+
+        self._joint_state = sensor_msgs.msg.JointState()
+        self._joint_state.name = self.joint_names
+        self._joint_state.position = self.home_position.tolist()
+        self._joint_state.velocity = [0.]*len(self.joint_names)
+        self._joint_state.effort = [0.]*len(self.joint_names)
+
+        self._joint_states_publisher = rospy.Publisher("/joint_states", sensor_msgs.msg.JointState, queue_size=1)
+        self._receipt_publisher = rospy.Publisher(RECEIPT_TOPIC, std_msgs.msg.Header, queue_size=10)
+        self._setpoint_subscriber = rospy.Subscriber(SETPOINT_TOPIC, robot_msgs.msg.CartesianGoalPoint,
+                                                     self._on_setpoint, queue_size=1)
+        self._init_service = rospy.Service("plan_runner/init_task_space_streaming",
+                                           robot_msgs.srv.StartStreamingPlan, self._handle_init)
+        self._stop_service = rospy.Service("plan_runner/stop_plan", std_srvs.srv.Trigger, self._handle_stop)
+
+    def _handle_init(self, req):
+        with self._lock:
+            self._streaming = True
+            self._plan_number += 1
+            response = robot_msgs.srv.StartStreamingPlanResponse()
+            response.status.status = robot_msgs.msg.PlanStatus.RUNNING
+            response.plan_number = self._plan_number
+        return response
+
+    def _handle_stop(self, req):
+        with self._lock:
+            self._streaming = False
+            self._targets.clear()
+        return std_srvs.srv.TriggerResponse(success=True, message="stopped fake task space streaming")
+
+    def _on_setpoint(self, msg):
+        now = time.time()
+        receipt = std_msgs.msg.Header()
+        receipt.seq = msg.xyz_point.header.seq
+        receipt.stamp = rospy.Time.from_sec(now)
+        receipt.frame_id = msg.ee_frame_id
+        self._receipt_publisher.publish(receipt)
+
+        p = msg.xyz_point.point
+        with self._lock:
+            if self._streaming:
+                self._targets.append((now + self.response_delay, np.array([p.x, p.y, p.z])))
+
+    def _step(self, now, dt):
+        with self._lock:
+            while self._targets and self._targets[0][0] <= now:
+                self._target = self._targets.popleft()[1]
+
+            if self._target is not None:
+                if self._ee_position is None:
+                    self._ee_origin = self._target.copy()
+                    self._ee_position = self._target.copy()
+                velocity = (self._target - self._ee_position)*min(dt/self.time_constant, 1.0)/dt
+                self._ee_position = self._ee_position + velocity*dt
+                offset = self._ee_position - self._ee_origin
+                self._joint_state.position = (self.home_position + self._jacobian.dot(offset)).tolist()
+                self._joint_state.velocity = self._jacobian.dot(velocity).tolist()
+
+        self._joint_state.header.stamp = rospy.Time.from_sec(now)
+        self._joint_states_publisher.publish(self._joint_state)
+
+    def run(self):
+        self.scheduler.reset()
+        while not rospy.is_shutdown():
+            self.scheduler.wait()
+            self._step(time.time(), self.scheduler.period)
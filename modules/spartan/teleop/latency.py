@@ -0,0 +1,183 @@
+# system
+import time
+import threading
+import collections
+import numpy as np
+import yaml
+
+# ROS
+import rospy
+import std_msgs.msg
+import sensor_msgs.msg
+
+# spartan
+import spartan.utils.utils as spartan_utils
+from spartan.utils.latency_histogram import LatencyHistogram
+
+
+"""
+End to end latency instrumentation for task space streaming teleop.
+
+Every setpoint is followed through four stamps:
+
+    input    the device input the setpoint was computed from was polled
+    publish  the setpoint went out (SetpointPublisher)
+    receipt  plan_runner received it, taken from the seq/stamp plan_runner
+             echoes on plan_runner/task_space_streaming_setpoint_receipt
+    motion   the first /joint_states message whose joint positions differ from
+             those at publish time, received after the receipt
+
+and the differences between them go into per stage histograms. All stamps
+are wall clock times, plan_runner must run on the same machine (or a synced
+clock) for the receipt stages to be meaningful. While the arm keeps moving
+the motion stamp is the first joint state after plan_runner got the setpoint,
+so receipt_to_motion is bounded below by the /joint_states period.
+
+Usage:
+
+    tracker = LatencyTracker()
+    publisher = SetpointPublisher(latency_tracker=tracker)
+    engine = TeleopEngine(device, controller, publisher=publisher, latency_tracker=tracker)
+    tracker.start_diagnostics(period=1.0)
+    engine.run()
+    tracker.dump("teleop_latency.yaml")
+"""
+
+RECEIPT_TOPIC = "/plan_runner/task_space_streaming_setpoint_receipt"
+DIAGNOSTICS_TOPIC = "/teleop/latency"
+
+STAGES = [
+    ("input_to_publish", "input", "publish"),
+    ("publish_to_receipt", "publish", "receipt"),
+    ("receipt_to_motion", "receipt", "motion"),
+    ("input_to_motion", "input", "motion"),
+]
+
+
+class LatencyTracker(object):
+
+    def __init__(self, receipt_topic=RECEIPT_TOPIC, joint_states_topic="/joint_states",
+                 motion_threshold=1e-5, max_pending=1000, bin_width=0.001, max_latency=0.5):
+        """
+        :param motion_threshold: joint position change in rad that counts as motion
+        :param max_pending: setpoints without motion stamp that are kept, older ones are dropped
+        """
+        self.motion_threshold = motion_threshold
+        self.max_pending = max_pending
+        self.histograms = collections.OrderedDict(
+            (name, LatencyHistogram(bin_width, max_latency)) for name, _, _ in STAGES)
+
+        self._lock = threading.Lock()
+        self._next_seq = 1
+        self._last_input_time = None
+        self._pending = collections.OrderedDict()  # seq -> dict of stamps
+        self._joint_positions = None
+        self.num_dropped = 0
+
+        self._receipt_subscriber = rospy.Subscriber(receipt_topic, std_msgs.msg.Header, self._on_receipt,
+                                                    queue_size=100)
+        self._joint_states_subscriber = rospy.Subscriber(joint_states_topic, sensor_msgs.msg.JointState,
+                                                         self._on_joint_state, queue_size=100)
+        self._diagnostics_publisher = None
+        self._diagnostics_timer = None
+
+    def mark_input(self, t=None):
+        """
+        Call when the device input was polled, the next setpoints are
+        attributed to it
+        """
+        self._last_input_time = t if t is not None else time.time()
+
+    def mark_publish(self, t=None):
+        """
+        Call right before a setpoint is published
+        :return: seq to put in the setpoint's xyz_point.header.seq
+        """
+        if t is None:
+            t = time.time()
+        with self._lock:
+            seq = self._next_seq
+            self._next_seq += 1
+            self._pending[seq] = {
+                'input': self._last_input_time,
+                'publish': t,
+                'joint_positions': self._joint_positions,
+            }
+            while len(self._pending) > self.max_pending:
+                self._pending.popitem(last=False)
+                self.num_dropped += 1
+        return seq
+
+    def _on_receipt(self, msg):
+        t = msg.stamp.to_sec()
+        with self._lock:
+            stamps = self._pending.get(msg.seq)
+            if stamps is not None and 'receipt' not in stamps:
+                stamps['receipt'] = t
+
+    def _on_joint_state(self, msg):
+        t = time.time()
+        positions = np.array(msg.position)
+        with self._lock:
+            self._joint_positions = positions
+            done = []
+            for seq, stamps in self._pending.iteritems():
+                if 'receipt' not in stamps:
+                    continue
+                reference = stamps['joint_positions']
+                if reference is not None and len(reference) == len(positions) \
+                        and np.max(np.abs(positions - reference)) < self.motion_threshold:
+                    continue
+                stamps['motion'] = t
+                self._record(stamps)
+                done.append(seq)
+            for seq in done:
+                del self._pending[seq]
+
+    def _record(self, stamps):
+        for name, start, end in STAGES:
+            if stamps.get(start) is not None and stamps.get(end) is not None:
+                self.histograms[name].add(stamps[end] - stamps[start])
+
+    def summary(self):
+        """
+        :return: dict stage name -> LatencyHistogram.summary()
+        """
+        with self._lock:
+            result = dict((name, h.summary()) for name, h in self.histograms.iteritems())
+            result['pending'] = len(self._pending)
+            result['dropped'] = self.num_dropped
+        return result
+
+    def print_summary(self):
+        for name, _, _ in STAGES:
+            s = self.histograms[name].summary()
+            print "%-20s n=%6d mean %6.2f  p50 %6.2f  p90 %6.2f  p99 %6.2f  max %6.2f ms" % (
+                name, s['count'], s['mean_ms'], s['p50_ms'], s['p90_ms'], s['p99_ms'], s['max_ms'])
+
+    def dump(self, filename):
+        """
+        Saves the summary and the raw histogram counts to a yaml file
+        """
+        data = self.summary()
+        with self._lock:
+            for name, h in self.histograms.iteritems():
+                data[name]['bin_width'] = h.bin_width
+                data[name]['counts'] = h.counts.tolist()
+        spartan_utils.saveToYaml(data, filename)
+
+    def start_diagnostics(self, topic=DIAGNOSTICS_TOPIC, period=1.0):
+        """
+        Publishes the summary as yaml on a std_msgs/String topic every period seconds
+        """
+        self._diagnostics_publisher = rospy.Publisher(topic, std_msgs.msg.String, queue_size=1)
+
+        def publish(event):
+            self._diagnostics_publisher.publish(std_msgs.msg.String(data=yaml.dump(self.summary())))
+
+        self._diagnostics_timer = rospy.Timer(rospy.Duration(period), publish)
+
+    def stop_diagnostics(self):
+        if self._diagnostics_timer is not None:
+            self._diagnostics_timer.shutdown()
+            self._diagnostics_timer = None
@@ -0,0 +1,268 @@
+# system
+import time
+import threading
+import collections
+import numpy as np
+
+# ROS
+import rospy
+
+# spartan
+import spartan.utils.transformations as transformations
+from spartan.teleop.teleop_engine import FixedRateScheduler, SetpointPublisher
+
+
+"""
+Task space streaming client that resamples operator targets for plan_runner.
+
+Operator targets come in at whatever rate the input device and the Python
+loop manage. TaskSpaceStreamingClient buffers them with their arrival time
+and publishes setpoints at its own fixed output rate:
+
+- the setpoint is interpolated between the two targets around
+  now - interpolation_delay, linearly for the position and by slerp for the
+  orientation, so a late or missing target doesn't show up as a step
+- the commanded position follows that reference with limited velocity and
+  acceleration (braking early enough to stop on the reference), the
+  orientation with limited angular velocity
+- xyz_d_point carries the finite difference velocity of the commanded
+  position as feed forward, instead of zero
+- a setpoint that didn't change isn't sent again until keepalive_period
+  passed, so plan_runner is left alone while the operator holds still
+
+publish() has the signature of SetpointPublisher.publish, so the client can
+stand in for it in a TeleopEngine:
+
+    client = TaskSpaceStreamingClient(output_rate=50.)
+    client.start()
+    engine = TeleopEngine(device, controller, rate=100., publisher=client)
+    engine.run()
+    client.stop()
+"""
+
+
+def quaternion_angle(quat0, quat1):
+    """
+    :return: angle of the rotation between the two unit quaternions, in [0, pi]
+    """
+    d = min(abs(np.dot(quat0, quat1)), 1.0)
+    return 2.0*np.arccos(d)
+
+
+class SetpointInterpolator(object):
+    """
+    Ring buffer of timestamped targets, sampled by linear interpolation and
+    slerp. Holds the newest target past its end, never extrapolates.
+    """
+
+    def __init__(self, max_targets=16):
+        self._targets = collections.deque(maxlen=max_targets)
+
+    def __len__(self):
+        return len(self._targets)
+
+    def clear(self):
+        self._targets.clear()
+
+    def add_target(self, t, pos, quat, rpy=None):
+        # targets must stay sorted in time
+        if self._targets and t <= self._targets[-1][0]:
+            self._targets.pop()
+        self._targets.append((t, np.array(pos, dtype=np.float64), np.array(quat, dtype=np.float64), rpy))
+
+    def sample(self, t):
+        """
+        :return: (position, quaternion w x y z, rpy) at time t, None if there is no target yet
+        """
+        targets = self._targets
+        if not targets:
+            return None
+
+        if t >= targets[-1][0]:
+            return targets[-1][1:]
+        if t <= targets[0][0]:
+            return targets[0][1:]
+
+        for i in xrange(len(targets) - 1, 0, -1):
+            t0 = targets[i-1][0]
+            if t0 <= t:
+                break
+
+        t0, pos0, quat0, _ = targets[i-1]
+        t1, pos1, quat1, rpy1 = targets[i]
+        fraction = (t - t0)/(t1 - t0)
+        pos = pos0 + fraction*(pos1 - pos0)
+        quat = transformations.quaternion_slerp(quat0, quat1, fraction)
+        return pos, quat, rpy1
+
+
+class TaskSpaceStreamingClient(object):
+
+    def __init__(self, publisher=None, output_rate=50., interpolation_delay=0.05,
+                 max_linear_velocity=0.5, max_linear_acceleration=2.0, max_angular_velocity=1.5,
+                 keepalive_period=0.5):
+        """
+        :param publisher: SetpointPublisher, a default one if None
+        :param output_rate: setpoints published per second at most
+        :param interpolation_delay: how far behind the newest target the
+        reference is sampled, about one input period
+        :param max_linear_velocity: m/s
+        :param max_linear_acceleration: m/s^2
+        :param max_angular_velocity: rad/s
+        :param keepalive_period: an unchanged setpoint is sent again after this many seconds
+        """
+        self.publisher = publisher or SetpointPublisher()
+        self.scheduler = FixedRateScheduler(output_rate)
+        self.interpolation_delay = interpolation_delay
+        self.max_linear_velocity = max_linear_velocity
+        self.max_linear_acceleration = max_linear_acceleration
+        self.max_angular_velocity = max_angular_velocity
+        self.keepalive_period = keepalive_period
+
+        self.interpolator = SetpointInterpolator()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stopped = True
+
+        self.num_published = 0
+        self.num_suppressed = 0
+        self.reset()
+
+    @property
+    def output_period(self):
+        return self.scheduler.period
+
+    def reset(self):
+        """
+        Forgets the targets and the commanded state, the next target is
+        taken over as is
+        """
+        with self._lock:
+            self.interpolator.clear()
+            self._pos = None
+            self._quat = None
+            self._vel = np.zeros(3)
+            self._rpy = None
+            self._last_step_time = None
+            self._last_publish_time = None
+            self._last_published = None
+
+    def set_target(self, pos, quat, rpy=None, t=None):
+        """
+        :param quat: w, x, y, z
+        :param t: arrival time of the target, now if None
+        """
+        if t is None:
+            t = time.time()
+        with self._lock:
+            self.interpolator.add_target(t, pos, quat, rpy)
+
+    def publish(self, pos, quat, vel=None, rpy=None, stamp=None):
+        """
+        SetpointPublisher.publish compatible, queues the target. vel and stamp
+        are ignored, the feed forward velocity is computed from the commanded
+        positions.
+        """
+        self.set_target(pos, quat, rpy=rpy)
+
+    def _limit_translation(self, reference, dt):
+        error = reference - self._pos
+        distance = np.linalg.norm(error)
+
+        # fastest speed from which we can still stop on the reference
+        speed = min(distance/dt, self.max_linear_velocity,
+                    np.sqrt(2.0*self.max_linear_acceleration*distance))
+        vel_des = error*(speed/distance) if distance > 0.0 else np.zeros(3)
+
+        dv = vel_des - self._vel
+        dv_norm = np.linalg.norm(dv)
+        max_dv = self.max_linear_acceleration*dt
+        if dv_norm > max_dv:
+            dv *= max_dv/dv_norm
+
+        step = (self._vel + dv)*dt
+        if distance > 0.0 and np.dot(step, error) >= distance**2:
+            # the step would pass the reference, stop on it instead
+            step = error
+        new_pos = self._pos + step
+        # finite difference of the commanded positions is the feed forward velocity
+        self._vel = (new_pos - self._pos)/dt
+        self._pos = new_pos
+
+    def _limit_rotation(self, reference, dt):
+        angle = quaternion_angle(self._quat, reference)
+        max_angle = self.max_angular_velocity*dt
+        if angle <= max_angle:
+            self._quat = np.array(reference)
+        else:
+            self._quat = transformations.quaternion_slerp(self._quat, reference, max_angle/angle)
+        self._quat /= np.linalg.norm(self._quat)
+
+    def step(self, now=None):
+        """
+        Advances the commanded setpoint to time now and publishes it unless
+        it didn't change
+        :return: True if a setpoint was published
+        """
+        if now is None:
+            now = time.time()
+
+        with self._lock:
+            sample = self.interpolator.sample(now - self.interpolation_delay)
+            if sample is None:
+                return False
+            reference_pos, reference_quat, self._rpy = sample
+
+            if self._pos is None:
+                self._pos = np.array(reference_pos)
+                self._quat = np.array(reference_quat)
+                self._vel = np.zeros(3)
+            else:
+                dt = now - self._last_step_time
+                if dt <= 0.0:
+                    return False
+                # don't jump after a stall, e.g. when the loop was descheduled
+                dt = min(dt, 2.0*self.output_period)
+                self._limit_translation(reference_pos, dt)
+                self._limit_rotation(reference_quat, dt)
+            self._last_step_time = now
+
+            setpoint = (self._pos.copy(), self._quat.copy(), self._vel.copy())
+            if self._last_published is not None and now - self._last_publish_time < self.keepalive_period:
+                last_pos, last_quat, last_vel = self._last_published
+                if (np.allclose(setpoint[0], last_pos, rtol=0., atol=1e-6)
+                        and np.allclose(setpoint[2], last_vel, rtol=0., atol=1e-6)
+                        and quaternion_angle(setpoint[1], last_quat) < 1e-6):
+                    self.num_suppressed += 1
+                    return False
+
+            self._last_published = setpoint
+            self._last_publish_time = now
+            rpy = self._rpy
+
+        self.publisher.publish(setpoint[0], setpoint[1], vel=setpoint[2], rpy=rpy)
+        self.num_published += 1
+        return True
+
+    def _run(self):
+        self.scheduler.reset()
+        while not self._stopped and not rospy.is_shutdown():
+            self.scheduler.wait()
+            self.step()
+
+    def start(self):
+        """
+        Publishes from a background thread at output_rate
+        """
+        if self._thread is not None:
+            return
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped = True
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
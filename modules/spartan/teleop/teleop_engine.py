@@ -0,0 +1,463 @@
+# system
+import time
+import threading
+import numpy as np
+
+# ROS
+import rospy
+import tf2_ros
+import std_srvs.srv
+import sensor_msgs.msg
+import geometry_msgs.msg
+
+# spartan
+import spartan.utils.ros_utils as ros_utils
+
+# spartan ROS
+import robot_msgs.msg
+import robot_msgs.srv
+
+
+"""
+Fixed-rate teleop engine for task space streaming to plan_runner.
+
+The teleop scripts (hydra, gamepad, mouse) differ only in how they turn
+device input into an end effector target. TeleopEngine runs the loop
+around that for all of them:
+
+- a FixedRateScheduler ticks at absolute deadlines, so the rate doesn't drift
+  with the time spent in the loop, and overruns skip ticks instead of bursting
+- the input device is polled without blocking, the controller gets the latest
+  input every tick
+- the end effector pose is looked up in TF only when a new /joint_states
+  message arrived (EndEffectorPoseCache), not every iteration
+- the setpoint goes out in one preallocated CartesianGoalPoint
+- debug frames, if enabled, are sent as a single batched tf message every
+  few ticks (DebugFrameBroadcaster)
+- slow side tasks, e.g. gripper commands, run every few ticks via add_periodic
+
+Usage:
+
+    class MyController(object):
+        def update(self, engine, inputs, dt):
+            pose = engine.get_ee_pose()
+            ...
+            return position, quaternion  # or None to not publish this tick
+
+    start_task_space_streaming()
+    engine = TeleopEngine(GamepadInput(), MyController(), rate=100.)
+    engine.run()
+"""
+
+SETPOINT_TOPIC = "plan_runner/task_space_streaming_setpoint"
+
+
+def make_cartesian_gains_msg(kp_rot, kp_trans):
+    msg = robot_msgs.msg.CartesianGain()
+
+    msg.rotation.x = kp_rot
+    msg.rotation.y = kp_rot
+    msg.rotation.z = kp_rot
+
+    msg.translation.x = kp_trans
+    msg.translation.y = kp_trans
+    msg.translation.z = kp_trans
+
+    return msg
+
+
+def make_force_guard_msg(scale, body_frame="iiwa_link_ee"):
+    msg = robot_msgs.msg.ForceGuard()
+    external_force = robot_msgs.msg.ExternalForceGuard()
+
+    force_vec = scale*np.array([-1, 0, 0])
+
+    external_force.force.header.frame_id = body_frame
+    external_force.body_frame = body_frame
+    external_force.force.vector.x = force_vec[0]
+    external_force.force.vector.y = force_vec[1]
+    external_force.force.vector.z = force_vec[2]
+
+    msg.external_force_guards.append(external_force)
+
+    return msg
+
+
+def start_task_space_streaming(force_guard_scale=20.):
+    """
+    Starts task space streaming in plan_runner
+    """
+    rospy.wait_for_service("plan_runner/init_task_space_streaming")
+    sp = rospy.ServiceProxy('plan_runner/init_task_space_streaming', robot_msgs.srv.StartStreamingPlan)
+    init = robot_msgs.srv.StartStreamingPlanRequest()
+    init.force_guard.append(make_force_guard_msg(force_guard_scale))
+    return sp(init)
+
+
+def stop_streaming_plan():
+    rospy.wait_for_service("plan_runner/stop_plan")
+    sp = rospy.ServiceProxy('plan_runner/stop_plan', std_srvs.srv.Trigger)
+    return sp(std_srvs.srv.TriggerRequest())
+
+
+class FixedRateScheduler(object):
+    """
+    Ticks at start + k*period. If a tick is late by more than a whole period
+    the missed ticks are dropped and the schedule restarts from now, so a
+    slow iteration doesn't cause a burst of catch-up ticks.
+    """
+
+    def __init__(self, rate, clock=time.time, sleep=time.sleep):
+        self.period = 1.0/rate
+        self._clock = clock
+        self._sleep = sleep
+        self._deadline = None
+
+        self.num_ticks = 0
+        self.num_skipped_ticks = 0
+        self.max_jitter = 0.0
+        self._sum_jitter = 0.0
+
+    def reset(self):
+        self._deadline = None
+
+    def wait(self):
+        """
+        Sleeps until the next tick
+        :return: the scheduled time of the tick
+        """
+        now = self._clock()
+        if self._deadline is None:
+            self._deadline = now
+        else:
+            self._deadline += self.period
+
+        if now - self._deadline > self.period:
+            missed = int((now - self._deadline)/self.period)
+            self.num_skipped_ticks += missed
+            self._deadline += missed*self.period
+
+        if self._deadline > now:
+            self._sleep(self._deadline - now)
+
+        jitter = max(self._clock() - self._deadline, 0.0)
+        self.max_jitter = max(self.max_jitter, jitter)
+        self._sum_jitter += jitter
+        self.num_ticks += 1
+        return self._deadline
+
+    @property
+    def mean_jitter(self):
+        return self._sum_jitter/max(self.num_ticks, 1)
+
+
+class EndEffectorPoseCache(object):
+    """
+    Pose of ee_frame in base_frame. The TF lookup only happens on the first
+    get_pose() after a new /joint_states message, since the pose can't
+    change in between.
+    """
+
+    def __init__(self, tf_buffer, base_frame="base", ee_frame="iiwa_link_ee", joint_states_topic="/joint_states"):
+        self.tf_buffer = tf_buffer
+        self.base_frame = base_frame
+        self.ee_frame = ee_frame
+
+        self._lock = threading.Lock()
+        self._pose = None
+        self._stale = True
+        self._subscriber = rospy.Subscriber(joint_states_topic, sensor_msgs.msg.JointState, self._on_joint_state,
+                                            queue_size=1)
+
+    def _on_joint_state(self, msg):
+        self._stale = True
+
+    def invalidate(self):
+        self._stale = True
+
+    def get_pose(self):
+        """
+        :return: (position, quaternion) with the quaternion as w, x, y, z, or
+        None if the transform isn't available (yet)
+        """
+        if not self._stale:
+            return self._pose
+
+        with self._lock:
+            self._stale = False
+            try:
+                transform = self.tf_buffer.lookup_transform(self.base_frame, self.ee_frame, rospy.Time()).transform
+            except (tf2_ros.LookupException, tf2_ros.ConnectivityException, tf2_ros.ExtrapolationException):
+                self._stale = True
+                return self._pose
+
+            pos, quat = ros_utils.poseFromROSTransformMsg(transform)
+            self._pose = (np.array(pos), np.array(quat))
+            return self._pose
+
+
+class DebugFrameBroadcaster(object):
+    """
+    Collects debug frames and sends them as one tf message every decimation
+    calls of flush(). With decimation 0 nothing is sent.
+    """
+
+    def __init__(self, decimation=10):
+        self.decimation = decimation
+        self._frames = dict()
+        self._count = 0
+        self._broadcaster = tf2_ros.TransformBroadcaster() if decimation else None
+
+    @property
+    def enabled(self):
+        return bool(self.decimation)
+
+    def set_frame(self, name, pos, quat, parent="base"):
+        """
+        :param quat: w, x, y, z
+        """
+        if not self.decimation:
+            return
+
+        msg = self._frames.get(name)
+        if msg is None:
+            msg = geometry_msgs.msg.TransformStamped()
+            msg.child_frame_id = name
+            self._frames[name] = msg
+
+        msg.header.frame_id = parent
+        t = msg.transform
+        t.translation.x, t.translation.y, t.translation.z = pos[0], pos[1], pos[2]
+        t.rotation.w, t.rotation.x, t.rotation.y, t.rotation.z = quat[0], quat[1], quat[2], quat[3]
+
+    def flush(self):
+        if not self.decimation or not self._frames:
+            return
+
+        self._count += 1
+        if self._count < self.decimation:
+            return
+        self._count = 0
+
+        stamp = rospy.Time.now()
+        for msg in self._frames.itervalues():
+            msg.header.stamp = stamp
+        self._broadcaster.sendTransform(self._frames.values())
+
+
+class SetpointPublisher(object):
+    """
+    Publishes task space setpoints, filling in a single preallocated CartesianGoalPoint
+    """
+
+    def __init__(self, topic=SETPOINT_TOPIC, ee_frame_id="iiwa_link_ee", frame_id="world", kp_rot=5., kp_trans=10.,
+                 latency_tracker=None):
+        """
+        :param latency_tracker: optional spartan.teleop.latency.LatencyTracker, stamps every publish
+        """
+        self.latency_tracker = latency_tracker
+        self._publisher = rospy.Publisher(topic, robot_msgs.msg.CartesianGoalPoint, queue_size=1)
+
+        self.msg = robot_msgs.msg.CartesianGoalPoint()
+        self.msg.xyz_point.header.frame_id = frame_id
+        self.msg.ee_frame_id = ee_frame_id
+        self.msg.gain = make_cartesian_gains_msg(kp_rot, kp_trans)
+
+    def publish(self, pos, quat, vel=None, rpy=None, stamp=None):
+        """
+        :param quat: w, x, y, z
+        :param vel: optional feed forward velocity, zero if not given
+        :param rpy: optional (roll, pitch, yaw) passed along in the message
+        """
+        msg = self.msg
+        msg.xyz_point.header.stamp = stamp or rospy.Time.now()
+        if self.latency_tracker is not None:
+            msg.xyz_point.header.seq = self.latency_tracker.mark_publish()
+
+        p = msg.xyz_point.point
+        p.x, p.y, p.z = pos[0], pos[1], pos[2]
+
+        v = msg.xyz_d_point
+        if vel is None:
+            v.x = v.y = v.z = 0.
+        else:
+            v.x, v.y, v.z = vel[0], vel[1], vel[2]
+
+        q = msg.quaternion
+        q.w, q.x, q.y, q.z = quat[0], quat[1], quat[2], quat[3]
+
+        if rpy is not None:
+            msg.roll, msg.pitch, msg.yaw = rpy
+
+        self._publisher.publish(msg)
+
+
+class InputDevice(object):
+    """
+    Interface of the input devices, poll() must not block
+    """
+
+    def start(self):
+        pass
+
+    def poll(self):
+        """
+        Overridden by the devices
+        :return: the latest input, or None if there is none (yet)
+        """
+
+    def stop(self):
+        pass
+
+
+class HydraInput(InputDevice):
+    """
+    Latest razer_hydra.msg.Hydra message
+    """
+
+    def __init__(self, topic="/hydra_calib"):
+        import razer_hydra.msg
+        self._subscriber = ros_utils.SimpleSubscriber(topic, razer_hydra.msg.Hydra)
+
+    def start(self):
+        self._subscriber.start(queue_size=1)
+
+    def poll(self):
+        return self._subscriber.last_message
+
+    def stop(self):
+        self._subscriber.stop()
+
+
+class GamepadInput(InputDevice):
+    """
+    Axes and buttons of a pygame joystick, as a dict with lists 'axes' and 'buttons'
+    """
+
+    def __init__(self, joystick_index=0):
+        import pygame
+        self._pygame = pygame
+        pygame.init()
+        pygame.joystick.init()
+        if pygame.joystick.get_count() <= joystick_index:
+            raise ValueError("found %d controllers, no controller %d" % (pygame.joystick.get_count(),
+                                                                        joystick_index))
+        self.joystick = pygame.joystick.Joystick(joystick_index)
+        self.joystick.init()
+        self._inputs = {'axes': [0.]*self.joystick.get_numaxes(), 'buttons': [0]*self.joystick.get_numbuttons()}
+
+    @property
+    def name(self):
+        return self.joystick.get_name()
+
+    def poll(self):
+        self._pygame.event.pump()
+        axes = self._inputs['axes']
+        for i in xrange(len(axes)):
+            axes[i] = self.joystick.get_axis(i)
+        buttons = self._inputs['buttons']
+        for i in xrange(len(buttons)):
+            buttons[i] = self.joystick.get_button(i)
+        return self._inputs
+
+
+class TeleopEngine(object):
+
+    def __init__(self, device, controller, rate=100., base_frame="base", ee_frame="iiwa_link_ee",
+                 publisher=None, debug_frames_decimation=0, tf_buffer=None, latency_tracker=None):
+        """
+        :param device: InputDevice
+        :param controller: object with update(engine, inputs, dt) that returns
+        (position, quaternion w x y z) of the end effector target, or None
+        :param rate: control rate in Hz
+        :param publisher: SetpointPublisher, a default one for ee_frame if None
+        :param debug_frames_decimation: send the debug frames every this many ticks, 0 disables them
+        :param latency_tracker: optional spartan.teleop.latency.LatencyTracker, stamps every input poll
+        """
+        self.device = device
+        self.controller = controller
+        self.scheduler = FixedRateScheduler(rate)
+
+        if tf_buffer is None:
+            tf_buffer = tf2_ros.Buffer()
+            self._tf_listener = tf2_ros.TransformListener(tf_buffer)
+        self.tf_buffer = tf_buffer
+        self.ee_pose_cache = EndEffectorPoseCache(tf_buffer, base_frame=base_frame, ee_frame=ee_frame)
+
+        self.publisher = publisher or SetpointPublisher(ee_frame_id=ee_frame)
+        self.debug = DebugFrameBroadcaster(debug_frames_decimation)
+        self.latency_tracker = latency_tracker
+
+        self._periodic = []
+        self._stopped = False
+
+    @property
+    def period(self):
+        return self.scheduler.period
+
+    def get_ee_pose(self):
+        """
+        :return: (position, quaternion w x y z) of the end effector, None if not available
+        """
+        return self.ee_pose_cache.get_pose()
+
+    def wait_for_ee_pose(self, timeout=None):
+        start = time.time()
+        while not rospy.is_shutdown():
+            pose = self.get_ee_pose()
+            if pose is not None:
+                return pose
+            if timeout is not None and time.time() - start > timeout:
+                return None
+            rospy.sleep(0.05)
+
+    def add_periodic(self, callback, period):
+        """
+        Calls callback(engine, inputs, dt) every period seconds (rounded to whole
+        ticks) from the control loop, after the setpoint went out
+        """
+        ticks = max(int(round(period/self.period)), 1)
+        self._periodic.append([callback, ticks, 0])
+
+    def stop(self):
+        self._stopped = True
+
+    def step(self):
+        """
+        Runs a single tick without waiting
+        :return: True if a setpoint was published
+        """
+        inputs = self.device.poll()
+        if inputs is None:
+            return False
+        if self.latency_tracker is not None:
+            self.latency_tracker.mark_input()
+
+        target = self.controller.update(self, inputs, self.period)
+        if target is not None:
+            self.publisher.publish(*target)
+
+        for entry in self._periodic:
+            entry[2] += 1
+            if entry[2] >= entry[1]:
+                entry[2] = 0
+                entry[0](self, inputs, entry[1]*self.period)
+
+        self.debug.flush()
+        return target is not None
+
+    def run(self):
+        self._stopped = False
+        self.device.start()
+        self.scheduler.reset()
+        try:
+            while not rospy.is_shutdown() and not self._stopped:
+                self.scheduler.wait()
+                self.step()
+        finally:
+            self.device.stop()
+
+    def print_stats(self):
+        s = self.scheduler
+        print "ticks: %d, skipped: %d, mean jitter: %.2f ms, max jitter: %.2f ms" % (
+            s.num_ticks, s.num_skipped_ticks, 1000*s.mean_jitter, 1000*s.max_jitter)
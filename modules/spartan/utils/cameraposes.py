@@ -0,0 +1,188 @@
+import numpy as np
+
+# director
+from director import transformUtils
+
+
+"""
+Camera poses from an ElasticFusion posegraph file.
+
+Each line of the posegraph file is
+
+    timestamp x y z qx qy qz qw
+
+where timestamp is in seconds. All poses are loaded in bulk into numpy arrays,
+and can be queried one at a time (same interface as labelfusion.cameraposes.CameraPoses)
+or for a whole array of utimes at once.
+"""
+
+
+def quaternion_slerp_batch(q0, q1, fraction):
+    """
+    Vectorized quaternion slerp, always takes the shortest path.
+
+    :param q0: N x 4 array of unit quaternions
+    :param q1: N x 4 array of unit quaternions
+    :param fraction: length N array of interpolation fractions in [0,1]
+    :return: N x 4 array of unit quaternions
+    """
+    q0 = np.asarray(q0, dtype=np.float64)
+    q1 = np.array(q1, dtype=np.float64)
+    fraction = np.asarray(fraction, dtype=np.float64)[:, np.newaxis]
+
+    d = np.sum(q0*q1, axis=1)
+    flip = d < 0
+    q1[flip] *= -1
+    d = np.abs(d)[:, np.newaxis]
+
+    # fall back to lerp where the quaternions are (nearly) identical
+    near = d[:, 0] > 1.0 - 1e-6
+    angle = np.arccos(np.clip(d, -1.0, 1.0))
+    sin_angle = np.sin(angle)
+    sin_angle[near] = 1.0
+
+    w0 = np.sin((1.0 - fraction)*angle)/sin_angle
+    w1 = np.sin(fraction*angle)/sin_angle
+    w0[near] = 1.0 - fraction[near]
+    w1[near] = fraction[near]
+
+    q = w0*q0 + w1*q1
+    q /= np.linalg.norm(q, axis=1)[:, np.newaxis]
+    return q
+
+
+def quaternion_matrix_batch(quaternions):
+    """
+    Vectorized version of transformations.quaternion_matrix
+
+    :param quaternions: N x 4 array of quaternions [w,x,y,z]
+    :return: N x 3 x 3 array of rotation matrices
+    """
+    q = np.asarray(quaternions, dtype=np.float64)
+    q = q/np.linalg.norm(q, axis=1)[:, np.newaxis]
+    w, x, y, z = q[:, 0], q[:, 1], q[:, 2], q[:, 3]
+
+    R = np.empty((len(q), 3, 3))
+    R[:, 0, 0] = 1 - 2*(y*y + z*z)
+    R[:, 0, 1] = 2*(x*y - z*w)
+    R[:, 0, 2] = 2*(x*z + y*w)
+    R[:, 1, 0] = 2*(x*y + z*w)
+    R[:, 1, 1] = 1 - 2*(x*x + z*z)
+    R[:, 1, 2] = 2*(y*z - x*w)
+    R[:, 2, 0] = 2*(x*z - y*w)
+    R[:, 2, 1] = 2*(y*z + x*w)
+    R[:, 2, 2] = 1 - 2*(x*x + y*y)
+    return R
+
+
+def homogeneous_transforms_from_pos_quat(positions, quaternions):
+    """
+    :param positions: N x 3 array
+    :param quaternions: N x 4 array [w,x,y,z]
+    :return: N x 4 x 4 array of homogeneous transforms
+    """
+    T = np.zeros((len(positions), 4, 4))
+    T[:, :3, :3] = quaternion_matrix_batch(quaternions)
+    T[:, :3, 3] = positions
+    T[:, 3, 3] = 1.0
+    return T
+
+
+def invert_homogeneous_transforms(T):
+    """
+    Inverts a stack of rigid transforms using R^T, -R^T t rather than a general matrix inverse
+    :param T: N x 4 x 4 array
+    :return: N x 4 x 4 array
+    """
+    R_transpose = np.transpose(T[:, :3, :3], (0, 2, 1))
+    T_inv = np.zeros_like(T)
+    T_inv[:, :3, :3] = R_transpose
+    T_inv[:, :3, 3] = -np.einsum('nij,nj->ni', R_transpose, T[:, :3, 3])
+    T_inv[:, 3, 3] = 1.0
+    return T_inv
+
+
+class CameraPoses(object):
+
+    def __init__(self, posegraphFile=None):
+        self.posegraphFile = posegraphFile
+        self.poseTimes = np.zeros(0, dtype=np.int64)
+        self.positions = np.zeros((0, 3))
+        self.quaternions = np.zeros((0, 4))
+
+        if self.posegraphFile is not None:
+            self.loadCameraPoses(posegraphFile)
+
+    def loadCameraPoses(self, posegraphFile):
+        data = np.loadtxt(posegraphFile, ndmin=2)
+        self.poseTimes = np.array(data[:, 0]*1e6, dtype=np.int64)
+        self.positions = data[:, 1:4].copy()
+
+        # quat data from file is ordered as x, y, z, w
+        self.quaternions = data[:, [7, 4, 5, 6]].copy()
+
+        # the posegraph should already be sorted, but searchsorted relies on it
+        order = np.argsort(self.poseTimes, kind='mergesort')
+        if np.any(order != np.arange(len(order))):
+            self.poseTimes = self.poseTimes[order]
+            self.positions = self.positions[order]
+            self.quaternions = self.quaternions[order]
+
+    @property
+    def poses(self):
+        """
+        List of (pos, quat) tuples, kept for compatibility with labelfusion.cameraposes
+        """
+        return zip(self.positions, self.quaternions)
+
+    def getCameraPose(self, idx):
+        """
+        :return: 4 x 4 homogeneous transform of camera to reconstruction frame
+        :rtype: np.ndarray
+        """
+        return homogeneous_transforms_from_pos_quat(self.positions[idx:idx+1], self.quaternions[idx:idx+1])[0]
+
+    def getCameraPoseMatrices(self):
+        """
+        :return: N x 4 x 4 array with all camera to reconstruction transforms
+        :rtype: np.ndarray
+        """
+        return homogeneous_transforms_from_pos_quat(self.positions, self.quaternions)
+
+    def getCameraPoseAtUTime(self, utime):
+        """
+        :return: camera pose at utime, interpolated between the bracketing poses
+        :rtype: vtkTransform
+        """
+        positions, quaternions = self.getCameraPosesAtUTimes([utime])
+        return transformUtils.transformFromPose(positions[0], quaternions[0])
+
+    def getCameraPosesAtUTimes(self, utimes):
+        """
+        Looks up the camera pose for a whole array of utimes at once. Poses
+        are linearly interpolated (slerp for the rotation) between the two
+        bracketing poses, utimes outside the posegraph are clamped to the
+        first/last pose.
+
+        :param utimes: length N array of utimes
+        :return: tuple (positions, quaternions) of N x 3 and N x 4 [w,x,y,z] arrays
+        :rtype: tuple
+        """
+        utimes = np.asarray(utimes, dtype=np.int64)
+        numPoses = len(self.poseTimes)
+        if numPoses == 0:
+            raise ValueError("no camera poses loaded")
+
+        upper = np.clip(np.searchsorted(self.poseTimes, utimes, side='left'), 0, numPoses - 1)
+        lower = np.clip(upper - 1, 0, numPoses - 1)
+
+        t0 = self.poseTimes[lower]
+        t1 = self.poseTimes[upper]
+        dt = (t1 - t0).astype(np.float64)
+        dt[dt == 0] = 1.0
+        fraction = np.clip((utimes - t0)/dt, 0.0, 1.0)
+
+        positions = self.positions[lower] + fraction[:, np.newaxis]*(self.positions[upper] - self.positions[lower])
+        quaternions = quaternion_slerp_batch(self.quaternions[lower], self.quaternions[upper], fraction)
+
+        return positions, quaternions
@@ -0,0 +1,114 @@
+# system
+import numpy as np
+import cv2
+
+# director
+from director import vtkNumpy as vnp
+
+
+"""
+Per point color features (HSV, Lab) of colored point clouds, for
+segmenting by color.
+
+The conversions run over the whole cloud at once, cv2.cvtColor on the
+N x 1 x 3 float32 view of the colors. addColorFeatureArrays keeps the
+resulting vtk arrays around per color array and its modification time, so
+calling it again on the same cloud, e.g. in every segmentation step, just
+re-attaches them.
+
+Usage:
+
+    addColorFeatureArrays(polyData, 'rgb_colors', features=['hsv', 'lab'])
+    polyData = segmentation.thresholdPoints(polyData, 'hue', [0.12, 0.14])
+"""
+
+# feature -> names of the point data arrays it adds
+FEATURE_ARRAY_NAMES = {
+    'hsv': ['hue', 'saturation', 'value'],
+    'lab': ['lab_l', 'lab_a', 'lab_b'],
+}
+
+
+def _toImage(rgb):
+    # N x 1 x 3 float32 in [0, 1], the layout cv2.cvtColor expects
+    return (np.asarray(rgb, dtype=np.float32)/np.float32(255.0)).reshape(-1, 1, 3)
+
+
+def rgbToHsv(rgb):
+    """
+    :param rgb: N x 3 array of 0-255 colors
+    :return: N x 3 float32 array, hue, saturation and value all in [0, 1]
+    like colorsys.rgb_to_hsv
+    :rtype: np.ndarray
+    """
+    if len(rgb) == 0:
+        return np.zeros((0, 3), dtype=np.float32)
+    hsv = cv2.cvtColor(_toImage(rgb), cv2.COLOR_RGB2HSV).reshape(-1, 3)
+    hsv[:, 0] *= 1.0/360.0
+    return hsv
+
+
+def rgbToLab(rgb):
+    """
+    :param rgb: N x 3 array of 0-255 colors
+    :return: N x 3 float32 array, L in [0, 100], a and b in about [-127, 127]
+    :rtype: np.ndarray
+    """
+    if len(rgb) == 0:
+        return np.zeros((0, 3), dtype=np.float32)
+    return cv2.cvtColor(_toImage(rgb), cv2.COLOR_RGB2Lab).reshape(-1, 3)
+
+
+_CONVERSIONS = {
+    'hsv': rgbToHsv,
+    'lab': rgbToLab,
+}
+
+# id(rgb vtk array) -> (rgb vtk array, its MTime, dict feature -> list of vtk arrays)
+_featureCache = dict()
+
+
+def _getFeatureArrays(rgbArray, feature):
+    key = id(rgbArray)
+    entry = _featureCache.get(key)
+    if entry is None or entry[0] is not rgbArray or entry[1] != rgbArray.GetMTime():
+        # holding on to the color array keeps its id valid, keep only a handful around
+        if len(_featureCache) >= 8:
+            _featureCache.clear()
+        entry = (rgbArray, rgbArray.GetMTime(), dict())
+        _featureCache[key] = entry
+
+    arrays = entry[2].get(feature)
+    if arrays is None:
+        rgb = vnp.numpy_support.vtk_to_numpy(rgbArray).reshape(-1, 3)
+        values = _CONVERSIONS[feature](rgb)
+        arrays = []
+        for i, name in enumerate(FEATURE_ARRAY_NAMES[feature]):
+            array = vnp.getVtkFromNumpy(values[:, i].copy())
+            array.SetName(name)
+            arrays.append(array)
+        entry[2][feature] = arrays
+
+    return arrays
+
+
+def addColorFeatureArrays(polyData, rgbArrayName='rgb_colors', features=('hsv',)):
+    """
+    Adds the point data arrays of the given features (see FEATURE_ARRAY_NAMES),
+    computed from the rgbArrayName colors. They are only computed again
+    once the colors change.
+
+    :param features: list with 'hsv' and/or 'lab'
+    """
+    pointData = polyData.GetPointData()
+    rgbArray = pointData.GetArray(rgbArrayName)
+    if rgbArray is None:
+        raise ValueError("polyData has no point data array %s" % rgbArrayName)
+
+    for feature in features:
+        if feature not in _CONVERSIONS:
+            raise ValueError("unknown color feature %s, must be one of %s" % (feature, _CONVERSIONS.keys()))
+
+        for array in _getFeatureArrays(rgbArray, feature):
+            if pointData.GetArray(array.GetName()) is not array:
+                pointData.AddArray(array)
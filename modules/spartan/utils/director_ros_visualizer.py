@@ -1,6 +1,8 @@
 # system
 import numpy as np
 import os
+import time
+import threading
 
 # ROS
 import rospy
@@ -22,20 +24,216 @@ import director.ioUtils as ioUtils
 from spartan.utils.taskrunner import TaskRunner
 import spartan.utils.ros_utils as ros_utils
 import spartan.utils.utils as spartan_utils
+import spartan.utils.pointcloud2_utils as pointcloud2_utils
+import spartan.perception.utils as perception_utils
+from spartan.utils.pointcloud_recorder import PointCloudRecorder
+
+
+class PointCloudWorker(object):
+    """
+    Converts the most recent message on a topic on a background thread.
+
+    The ROS callback only stores the message (latest wins, older messages that
+    haven't been converted yet are dropped). The worker thread runs convert_func
+    on it and stores the result, which the main thread picks up with pop_result().
+    If the main thread doesn't pick a result up before the next one is ready,
+    the older result is dropped as well.
+    """
+
+    def __init__(self, topic, convert_func):
+        self.topic = topic
+        self._convert_func = convert_func
+        self._lock = threading.Lock()
+        self._new_msg_event = threading.Event()
+        self._pending_msg = None
+        self._pending_receive_time = None
+        self._result = None
+        self._thread = None
+        self._running = False
+        self.enabled = True
+        self.reset_stats()
+
+    def reset_stats(self):
+        self._stats = dict()
+        self._stats['num_received'] = 0
+        self._stats['num_converted'] = 0
+        self._stats['num_rendered'] = 0
+        self._stats['num_dropped_messages'] = 0
+        self._stats['num_dropped_results'] = 0
+        self._stats['num_failed'] = 0
+        self._stats['total_conversion_time'] = 0.0
+        self._stats['max_conversion_time'] = 0.0
+        self._stats['total_latency'] = 0.0
+        self._stats['max_latency'] = 0.0
+
+    def start(self):
+        if self._running:
+            return
+
+        self._running = True
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        self._new_msg_event.set()
+
+    def on_msg(self, msg):
+        """
+        Subscriber callback, called on the ROS thread. Doesn't do any work
+        """
+        with self._lock:
+            if self._pending_msg is not None:
+                self._stats['num_dropped_messages'] += 1
+            self._pending_msg = msg
+            self._pending_receive_time = time.time()
+            self._stats['num_received'] += 1
+
+        self._new_msg_event.set()
+
+    def _run(self):
+        while self._running:
+            self._new_msg_event.wait(0.5)
+            self._new_msg_event.clear()
+            if not self._running or not self.enabled:
+                continue
+
+            with self._lock:
+                msg = self._pending_msg
+                receive_time = self._pending_receive_time
+                self._pending_msg = None
+
+            if msg is None:
+                continue
+
+            start_time = time.time()
+            try:
+                result = self._convert_func(msg)
+            except Exception as e:
+                rospy.logwarn("failed to process message on topic %s: %s", self.topic, e)
+                result = None
+
+            conversion_time = time.time() - start_time
+
+            with self._lock:
+                if result is None:
+                    self._stats['num_failed'] += 1
+                    continue
+
+                self._stats['num_converted'] += 1
+                self._stats['total_conversion_time'] += conversion_time
+                self._stats['max_conversion_time'] = max(self._stats['max_conversion_time'], conversion_time)
+
+                if self._result is not None:
+                    self._stats['num_dropped_results'] += 1
+
+                result['msg'] = msg
+                result['receive_time'] = receive_time
+                result['conversion_time'] = conversion_time
+                self._result = result
+
+    def pop_result(self):
+        """
+        Returns the latest converted result, or None if nothing new has been
+        converted since the last call. Call this from the main thread.
+        :rtype: dict
+        """
+        with self._lock:
+            result = self._result
+            self._result = None
+
+            if result is not None:
+                latency = time.time() - result['receive_time']
+                self._stats['num_rendered'] += 1
+                self._stats['total_latency'] += latency
+                self._stats['max_latency'] = max(self._stats['max_latency'], latency)
+
+        return result
+
+    def get_stats(self):
+        """
+        :return: dict of counters, plus average conversion time and latency
+        (message received to handed to the main thread) in seconds
+        :rtype: dict
+        """
+        with self._lock:
+            stats = dict(self._stats)
+
+        stats['average_conversion_time'] = stats['total_conversion_time']/max(stats['num_converted'], 1)
+        stats['average_latency'] = stats['total_latency']/max(stats['num_rendered'], 1)
+        return stats
+
+
+class PointCloudDecimator(object):
+    """
+    Level of detail stage for a single topic. Optionally voxel grid
+    downsamples the cloud, then strides it down to a maximum number of points.
+
+    lod_scale is set by the visualizer, at lod_scale = s the voxel size is
+    multiplied by s and the point budget divided by s^2.
+    """
+
+    def __init__(self, voxel_size=None, stride=1, max_points=None):
+        """
+        :param voxel_size: voxel edge length in meters, None disables voxel downsampling
+        :param stride: always keep only every stride-th point
+        :param max_points: maximum number of points, None means no limit
+        """
+        self.voxel_size = voxel_size
+        self.stride = stride
+        self.max_points = max_points
+        self.lod_scale = 1.0
+
+    def decimate(self, points):
+        """
+        :param points: N x 3 array of finite points
+        :return: M x 3 array
+        :rtype: np.ndarray
+        """
+        if self.stride > 1:
+            points = points[::self.stride]
+
+        if self.voxel_size is not None:
+            points = perception_utils.voxel_downsample(points, self.voxel_size*self.lod_scale)
+
+        if self.max_points is not None:
+            points = perception_utils.stride_downsample(points, int(self.max_points/self.lod_scale**2))
+
+        return points
+
 
 class DirectorROSVisualizer(object):
 
-    def __init__(self, tf_buffer=None):
+    # bounds on how much the level of detail is reduced when updates are too slow
+    MAX_LOD_SCALE = 8.0
+    LOD_INCREASE_FACTOR = 1.25
+    LOD_DECREASE_FACTOR = 1.05
+
+    # shared by pointcloud2_msg_from_numpy, keyed by whether rgb is encoded
+    _encoders = dict()
+    _encoder_lock = threading.Lock()
+
+    def __init__(self, tf_buffer=None, point_budget=None, adaptive_lod=True):
+        """
+        :param point_budget: total number of points shared between all visualized topics,
+        None means no limit
+        :param adaptive_lod: reduce resolution when updating takes longer than the frame budget
+        """
         self.taskRunner = TaskRunner()
 
+        self._tf_buffer = tf_buffer
         if tf_buffer is None:
             self.setup_TF()
-        else:
-            self._tf_buffer = tf_buffer
 
         self.clear_visualization()
         self._subscribers = dict()
         self._expressed_in_frame = "base"
+        self._point_budget = point_budget
+        self._adaptive_lod = adaptive_lod
+        self._lod_scale = 1.0
+        self._frame_budget = 1.0/30
+        self._recorder = None
 
     def setup_TF(self):
         """
@@ -58,20 +256,25 @@ class DirectorROSVisualizer(object):
         om.removeFromObjectModel(self._vis_container)
         self._vis_container = om.getOrCreateContainer(container_name)
 
-    def add_subscriber(self, topic, name=None, call_in_thread=True, visualize=False, msg_type=None):
+    def add_subscriber(self, topic, name=None, call_in_thread=True, visualize=False, msg_type=None,
+                       voxel_size=None, stride=1, budget_weight=1.0):
         """
         Adds a subscriber
         :param topic:
         :type topic:
         :param call_in_thread:
         :type call_in_thread:
+        :param voxel_size: voxel grid downsampling size in meters, None to disable
+        :param stride: keep only every stride-th point
+        :param budget_weight: share of the point budget this topic gets, relative to the other visualized topics
         :return:
         :rtype:
         """
 
 
         if call_in_thread:
-            self.add_subscriber(topic, name=name, call_in_thread=False, visualize=visualize, msg_type=msg_type)
+            self.add_subscriber(topic, name=name, call_in_thread=False, visualize=visualize, msg_type=msg_type,
+                                voxel_size=voxel_size, stride=stride, budget_weight=budget_weight)
             return
 
         if msg_type is None:
@@ -81,54 +284,256 @@ class DirectorROSVisualizer(object):
             name = topic
 
 
-        subscriber = ros_utils.SimpleSubscriber(topic, msg_type)
-        subscriber.start()
-
         d = dict()
-        d['subscriber'] = subscriber
         d['topic'] = topic
         d['visualize'] = visualize
         d['name'] = name
+        d['decimator'] = PointCloudDecimator(voxel_size=voxel_size, stride=stride)
+        d['budget_weight'] = budget_weight
+
+        worker = PointCloudWorker(topic, lambda msg: self._process_msg(d, msg))
+        worker.enabled = visualize
+        worker.start()
+        d['worker'] = worker
+
+        subscriber = ros_utils.SimpleSubscriber(topic, msg_type, externalCallback=worker.on_msg)
+        subscriber.start(queue_size=1)
+        d['subscriber'] = subscriber
 
         self._subscribers[topic] = d
+        self._update_point_budgets()
+
+    def set_visualize(self, topic, visualize):
+        data = self._subscribers[topic]
+        data['visualize'] = visualize
+        # a recorded topic keeps converting while hidden
+        data['worker'].enabled = visualize or data.get('record', False)
+        self._update_point_budgets()
+
+    def set_point_budget(self, point_budget):
+        """
+        :param point_budget: total number of points shared between all visualized topics
+        """
+        self._point_budget = point_budget
+        self._update_point_budgets()
+
+    def _update_point_budgets(self):
+        """
+        Splits the point budget between the visualized topics according to their budget_weight
+        """
+        visualized = [data for data in self._subscribers.values() if data['visualize']]
+        total_weight = sum(data['budget_weight'] for data in visualized)
+
+        for data in self._subscribers.values():
+            if self._point_budget is None or not data['visualize'] or total_weight <= 0:
+                data['decimator'].max_points = None
+            else:
+                data['decimator'].max_points = int(self._point_budget*data['budget_weight']/total_weight)
+
+    def _adapt_level_of_detail(self, cost):
+        """
+        Coarsens the level of detail if the cost (in seconds) of the last
+        update exceeded the frame budget, and slowly refines it again once
+        there is headroom.
+        """
+        if not self._adaptive_lod:
+            return
+
+        if cost > self._frame_budget:
+            self._lod_scale = min(self._lod_scale*DirectorROSVisualizer.LOD_INCREASE_FACTOR,
+                                  DirectorROSVisualizer.MAX_LOD_SCALE)
+        elif cost < 0.5*self._frame_budget:
+            self._lod_scale = max(self._lod_scale/DirectorROSVisualizer.LOD_DECREASE_FACTOR, 1.0)
+
+        for data in self._subscribers.values():
+            data['decimator'].lod_scale = self._lod_scale
+
+    @property
+    def lod_scale(self):
+        return self._lod_scale
+
+    def _process_msg(self, data, msg):
+        """
+        Does all the heavy lifting for a single message: TF lookup, decoding
+        and building the polydata in the expressed in frame. Called on the
+        worker thread for the topic.
+
+        :return: dict with the polydata, or None if the TF lookup failed
+        :rtype: dict
+        """
+        try:
+            T_W_pointcloud_stamped = self._tf_buffer.lookup_transform(self._expressed_in_frame, msg.header.frame_id,
+                                                                      msg.header.stamp, rospy.Duration(0.1))
+        except Exception:
+            return None
+
+        T_W_pointcloud = ros_numpy.numpify(T_W_pointcloud_stamped.transform)
+
+        recorder = self._recorder
+        if data.get('record', False) and recorder is not None:
+            recorder.record_msg(data['topic'], msg, T_W_pointcloud)
+
+        result = dict()
+        result['polydata'] = None
+        if data['visualize']:
+            pointcloud_numpy = pointcloud2_utils.numpy_from_pointcloud2_msg(msg, remove_nans=True)
+            result['polydata'] = self._make_polydata(data, pointcloud_numpy, T_W_pointcloud)
+
+        return result
+
+    def _process_recorded_frame(self, data, frame):
+        """
+        Same as _process_msg for a PointCloudFrame from a PointCloudReplayer,
+        the transform was recorded along with the points.
+        """
+        result = dict()
+        result['polydata'] = self._make_polydata(data, frame.points, frame.transform)
+        return result
+
+    def _make_polydata(self, data, pointcloud_numpy, T_W_pointcloud):
+        """
+        Decimates the points and transforms them into the expressed in frame
+        :param pointcloud_numpy: N x 3 array of finite points
+        :param T_W_pointcloud: 4 x 4 transform
+        :rtype: vtkPolyData
+        """
+        T_W_pointcloud = np.asarray(T_W_pointcloud, dtype=np.float32)
+        pointcloud_numpy = data['decimator'].decimate(pointcloud_numpy)
+
+        # transform in numpy, this also makes the contiguous copy the polydata needs
+        pointcloud_numpy = np.dot(pointcloud_numpy, T_W_pointcloud[:3, :3].T) + T_W_pointcloud[:3, 3]
+
+        return vnp.getVtkPolyDataFromNumpyPoints(pointcloud_numpy)
+
+    def start_recording(self, filename=None, topics=None):
+        """
+        Starts streaming the clouds (with their stamps and poses) of the given
+        topics to a file, see PointCloudRecorder. Replay it with
+        PointCloudReplayer(filename).play(visualizer)
+
+        :param filename: defaults to $SPARTAN_SANDBOX_DIR/pointclouds/<date>.spcr
+        :param topics: subscribed topics to record, defaults to all
+        :return: the filename
+        :rtype: str
+        """
+        self.stop_recording()
+
+        if filename is None:
+            filename = os.path.join(spartan_utils.get_sandbox_dir(), "pointclouds",
+                                    "%s.spcr" % spartan_utils.get_current_YYYY_MM_DD_hh_mm_ss())
+
+        if topics is None:
+            topics = self._subscribers.keys()
+
+        self._recorder = PointCloudRecorder(filename)
+        self._recorder.start()
+
+        for topic, data in self._subscribers.items():
+            data['record'] = topic in topics
+            data['worker'].enabled = data['visualize'] or data['record']
+
+        return filename
+
+    def stop_recording(self):
+        """
+        Stops recording and closes the file
+        """
+        recorder = self._recorder
+        if recorder is None:
+            return
+
+        self._recorder = None
+        for topic, data in self._subscribers.items():
+            data['record'] = False
+            data['worker'].enabled = data['visualize']
+
+        recorder.stop()
+        print "recorded %d point clouds to %s, dropped %d" % (recorder.num_recorded, recorder.filename,
+                                                              recorder.num_dropped)
+
+    def add_recorded_frame(self, frame):
+        """
+        Feeds a PointCloudFrame from a PointCloudReplayer through the same
+        worker/decimation/update path as live messages. Can be called from any thread.
+        The frame is shown under the topic name with " replay" appended.
+        """
+        key = ('replay', frame.topic)
+        data = self._subscribers.get(key)
+        if data is None:
+            d = dict()
+            d['topic'] = frame.topic
+            d['visualize'] = True
+            d['name'] = frame.topic + " replay"
+            d['decimator'] = PointCloudDecimator()
+            d['decimator'].lod_scale = self._lod_scale
+            d['budget_weight'] = 1.0
+            d['worker'] = PointCloudWorker(frame.topic, lambda f: self._process_recorded_frame(d, f))
+            d['worker'].start()
+            self._subscribers[key] = d
+            self._update_point_budgets()
+            data = d
+
+        data['worker'].on_msg(frame)
 
     def update(self, snapshot=False):
         """
-        Visualizes the pointclouds set to true. This should be called from the main thread
+        Swaps in the pointclouds that the worker threads have finished
+        converting. This should be called from the main thread, it doesn't
+        do any conversion itself.
         :return:
         :rtype:
         """
 
-        for topic, data in self._subscribers.iteritems():
+        start_time = time.time()
+        max_conversion_time = 0.0
+        consumed_result = False
+
+        # items() makes a copy, the replayer may add topics from its thread
+        for topic, data in self._subscribers.items():
 
             if not data['visualize']:
                 continue
 
-            msg = data['subscriber'].lastMsg
-            if msg is None:
-                continue
-
-            # get frame
-            # TransformStamped
-            # this might need to be called in thread
-            try:
-                T_W_pointcloud_stamped = self._tf_buffer.lookup_transform(self._expressed_in_frame, msg.header.frame_id, msg.header.stamp)
-            except:
-                continue
+            result = data['worker'].pop_result()
+            if result is not None and result['polydata'] is None:
+                result = None
 
+            if result is not None:
+                data['pointcloud'] = result['polydata']
+                max_conversion_time = max(max_conversion_time, result['conversion_time'])
+                consumed_result = True
 
-            T_W_pointcloud = ros_numpy.numpify(T_W_pointcloud_stamped.transform)
-            T_W_pointcloud_vtk = transformUtils.getTransformFromNumpy(T_W_pointcloud)
-            pointcloud_numpy = DirectorROSVisualizer.numpy_from_pointcloud2_msg(msg)
-            pointcloud_vtk = vnp.getVtkPolyDataFromNumpyPoints(pointcloud_numpy)
-            pointcloud_vtk = filterUtils.transformPolyData(pointcloud_vtk, T_W_pointcloud_vtk)
+            if 'pointcloud' not in data:
+                continue
 
-            data['pointcloud'] = pointcloud_vtk
             if snapshot:
                 name = data["name"] + " snapshot"
-                vis.showPolyData(pointcloud_vtk, name, parent=self._vis_container)
-            else:
-                vis.updatePolyData(pointcloud_vtk, data['name'], parent=self._vis_container)
+                vis.showPolyData(data['pointcloud'], name, parent=self._vis_container)
+            elif result is not None:
+                vis.updatePolyData(data['pointcloud'], data['name'], parent=self._vis_container)
+
+        # ticks without a new result cost nothing and say nothing about the headroom
+        if not snapshot and consumed_result:
+            self._adapt_level_of_detail(max(time.time() - start_time, max_conversion_time))
+
+    def get_stats(self):
+        """
+        :return: dict of topic -> stats dict, see PointCloudWorker.get_stats()
+        :rtype: dict
+        """
+        stats = dict()
+        for topic, data in self._subscribers.items():
+            stats[topic] = data['worker'].get_stats()
+        return stats
+
+    def print_stats(self):
+        for topic, stats in self.get_stats().iteritems():
+            print "%s: received %d, rendered %d, dropped %d messages and %d results, " \
+                  "conversion %.1f ms (max %.1f ms), latency %.1f ms (max %.1f ms)" \
+                  % (topic, stats['num_received'], stats['num_rendered'], stats['num_dropped_messages'],
+                     stats['num_dropped_results'], 1000*stats['average_conversion_time'],
+                     1000*stats['max_conversion_time'], 1000*stats['average_latency'],
+                     1000*stats['max_latency'])
 
     def start(self, rate_hz=30):
         """
@@ -138,6 +543,10 @@ class DirectorROSVisualizer(object):
         :return:
         :rtype:
         """
+        for topic, data in self._subscribers.items():
+            data['worker'].start()
+
+        self._frame_budget = 1.0/rate_hz
         self._timercallback = TimerCallback(targetFps=rate_hz, callback=self.update)
         self._timercallback.start()
 
@@ -149,6 +558,9 @@ class DirectorROSVisualizer(object):
         """
         self._timercallback.stop()
 
+        for topic, data in self._subscribers.items():
+            data['worker'].stop()
+
     def snapshot(self):
         self.update(snapshot=True)
 
@@ -157,7 +569,10 @@ class DirectorROSVisualizer(object):
         if not os.path.exists(save_dir):
             os.makedirs(save_dir)
 
-        for topic, data in self._subscribers.iteritems():
+        for topic, data in self._subscribers.items():
+            if 'pointcloud' not in data:
+                continue
+
             filename = os.path.join(save_dir, "%s.ply" %(data['name']))
             filename.replace(" ", "_")
             ioUtils.writePolyData(data['pointcloud'], filename)
@@ -166,49 +581,32 @@ class DirectorROSVisualizer(object):
     @staticmethod
     def numpy_from_pointcloud2_msg(msg):
         """
-
+        Returns an N x 3 float32 view of the points, see pointcloud2_utils
         :param msg: sensor_msgs/PointCloud2
         :type msg:
         :return:
         :rtype:
         """
 
-        pc = ros_numpy.numpify(msg)
-        num_points = msg.width * msg.height
-
-        points = np.zeros((num_points, 3))
-        points[:, 0] = pc['x'].flatten()
-        points[:, 1] = pc['y'].flatten()
-        points[:, 2] = pc['z'].flatten()
-
-        return points
+        return pointcloud2_utils.numpy_from_pointcloud2_msg(msg)
 
     @staticmethod
-    def pointcloud2_msg_from_numpy(pc_numpy):
+    def pointcloud2_msg_from_numpy(pc_numpy, rgb=None):
         """
+        Encodes the points as packed float32 (12 bytes per point, 16 with rgb),
+        see pointcloud2_utils.PointCloud2Encoder. The encoder buffers are
+        reused between calls.
 
-        :param pc_numpy: N x 3
+        :param pc_numpy: N x 3, or height x width x 3 for an organized cloud
         :type pc_numpy:
+        :param rgb: optional N x 3 uint8 colors
         :return:
-        :rtype:
+        :rtype: sensor_msgs/PointCloud2
         """
 
-        N = pc_numpy.shape[0]
-
-        pc = np.zeros(N, dtype=[('x', np.float64), ('y', np.float64), ('z', np.float64)])
-        pc['x'] = pc_numpy[:, 0]
-        pc['y'] = pc_numpy[:, 1]
-        pc['z'] = pc_numpy[:, 2]
-
-        msg = ros_numpy.msgify(sensor_msgs.msg.PointCloud2, pc)
-
-        return msg
-
-
-
-
-
-
-
-
+        with DirectorROSVisualizer._encoder_lock:
+            key = rgb is not None
+            if key not in DirectorROSVisualizer._encoders:
+                DirectorROSVisualizer._encoders[key] = pointcloud2_utils.PointCloud2Encoder(rgb=key)
 
+            return DirectorROSVisualizer._encoders[key].encode(pc_numpy, rgb=rgb)
@@ -13,9 +13,8 @@ from director import lcmUtils
 from director import utime as utimeUtil
 from director import transformUtils
 
-import ros_numpy
-
 import spartan.utils.utils as spartan_utils
+import spartan.utils.pointcloud2_utils as pointcloud2_utils
 
 
 def poseFromTransform(transform):
@@ -80,20 +79,15 @@ def getQuaternionFromDict(d):
     return quat
 
 
-def numpy_from_pointcloud2_msg(msg):
+def numpy_from_pointcloud2_msg(msg, remove_nans=False):
     """
 
     :param msg: sensor_msgs/PointCloud2
     :type msg:
-    :return:
+    :return: N x 3 float32 array, a view of msg.data unless remove_nans is True
     :rtype:
     """
-    pc = ros_numpy.numpify(msg)
-    points=np.zeros((pc.shape[0],3))
-    points[:,0]=pc['x']
-    points[:,1]=pc['y']
-    points[:,2]=pc['z']
-    return points
+    return pointcloud2_utils.numpy_from_pointcloud2_msg(msg, remove_nans=remove_nans)
 
 def save_transform_to_file(transform):
     filename = os.path.join(spartan_utils.get_sandbox_dir(), "transform.yaml")
@@ -0,0 +1,178 @@
+# system
+import xml.etree.ElementTree as ET
+import numpy as np
+
+# spartan
+import spartan.utils.transformations as transformations
+
+
+"""
+Forward kinematics of URDF robots for batches of configurations.
+
+Director's ikPlanner.getLinkFrameAtPose poses the whole robot model, VTK
+geometry included, for every configuration. BatchKinematics reads the joint
+tree of the URDF once and evaluates a link frame for an (N, nq) array of
+poses in one numpy pass per joint on the path from the root, e.g.
+
+    kinematics = BatchKinematics.fromUrdfFile(urdfFile, robotstate.getDrakePoseJointNames())
+    linkToWorld = kinematics.getLinkTransforms('iiwa_link_ee', poses)  # N x 4 x 4
+
+Poses are ordered like the joint names given to the constructor. The
+floating base joints of director poses (base_x ... base_yaw, roll pitch yaw
+in radians) place the root link, other joints missing from the URDF are
+ignored. Revolute, continuous, prismatic, fixed and mimic joints are
+supported.
+"""
+
+BASE_JOINT_NAMES = ['base_x', 'base_y', 'base_z', 'base_roll', 'base_pitch', 'base_yaw']
+
+
+def _parseVector(element, attribute, default):
+    if element is None or element.get(attribute) is None:
+        return np.array(default, dtype=np.float64)
+    return np.array([float(x) for x in element.get(attribute).split()])
+
+
+def rotationMatrices(axis, angles):
+    """
+    :param axis: unit rotation axis
+    :param angles: N angles in radians
+    :return: N x 3 x 3 rotation matrices
+    """
+    x, y, z = axis
+    K = np.array([[0, -z, y], [z, 0, -x], [-y, x, 0]], dtype=np.float64)
+    s = np.sin(angles)[:, np.newaxis, np.newaxis]
+    c = np.cos(angles)[:, np.newaxis, np.newaxis]
+    return np.eye(3) + s*K + (1.0 - c)*K.dot(K)
+
+
+def rpyMatrices(rpy):
+    """
+    :param rpy: N x 3 roll, pitch, yaw in radians, fixed axes as in URDF and drake
+    :return: N x 3 x 3 rotation matrices Rz(yaw) Ry(pitch) Rx(roll)
+    """
+    return np.matmul(rotationMatrices([0., 0., 1.], rpy[:, 2]),
+                     np.matmul(rotationMatrices([0., 1., 0.], rpy[:, 1]), rotationMatrices([1., 0., 0.], rpy[:, 0])))
+
+
+class URDFJoint(object):
+
+    def __init__(self, name, jointType, parent, child, origin, axis, mimic=None):
+        """
+        :param origin: 4 x 4 transform from the child to the parent link frame at zero position
+        :param mimic: (joint name, multiplier, offset) or None
+        """
+        self.name = name
+        self.type = jointType
+        self.parent = parent
+        self.child = child
+        self.origin = origin
+        self.axis = axis/np.linalg.norm(axis)
+        self.mimic = mimic
+
+    @staticmethod
+    def fromElement(element):
+        originElement = element.find('origin')
+        origin = transformations.euler_matrix(*_parseVector(originElement, 'rpy', [0., 0., 0.]), axes='sxyz')
+        origin[:3, 3] = _parseVector(originElement, 'xyz', [0., 0., 0.])
+
+        mimic = None
+        mimicElement = element.find('mimic')
+        if mimicElement is not None:
+            mimic = (mimicElement.get('joint'), float(mimicElement.get('multiplier', 1.0)),
+                     float(mimicElement.get('offset', 0.0)))
+
+        return URDFJoint(element.get('name'), element.get('type'), element.find('parent').get('link'),
+                         element.find('child').get('link'), origin,
+                         _parseVector(element.find('axis'), 'xyz', [1., 0., 0.]), mimic=mimic)
+
+
+class BatchKinematics(object):
+
+    def __init__(self, joints, jointNames):
+        """
+        :param joints: list of URDFJoint
+        :param jointNames: names of the pose entries, e.g. robotstate.getDrakePoseJointNames()
+        """
+        self.joints = dict((joint.child, joint) for joint in joints)
+        self.links = set([joint.parent for joint in joints] + [joint.child for joint in joints])
+        self.jointNames = list(jointNames)
+        self._poseIndex = dict((name, i) for i, name in enumerate(self.jointNames))
+        self._chains = dict()
+
+        self.baseIndices = None
+        if all(name in self._poseIndex for name in BASE_JOINT_NAMES):
+            self.baseIndices = [self._poseIndex[name] for name in BASE_JOINT_NAMES]
+
+    @staticmethod
+    def fromUrdfString(urdfString, jointNames):
+        robot = ET.fromstring(urdfString)
+        # only the joints of the kinematic tree, not those of transmissions
+        return BatchKinematics([URDFJoint.fromElement(e) for e in robot.findall('joint')], jointNames)
+
+    @staticmethod
+    def fromUrdfFile(filename, jointNames):
+        with open(filename) as f:
+            return BatchKinematics.fromUrdfString(f.read(), jointNames)
+
+    def _getChain(self, linkName):
+        """
+        Joints from the root link to linkName, with the pose index, multiplier
+        and offset of the value of each moving joint
+        """
+        if linkName not in self._chains:
+            if linkName not in self.links:
+                raise ValueError("unknown link %s" % linkName)
+            chain = []
+            link = linkName
+            while link in self.joints:
+                joint = self.joints[link]
+                source, multiplier, offset = (joint.name, 1.0, 0.0) if joint.mimic is None else joint.mimic
+                index = self._poseIndex.get(source)
+                if joint.type == 'fixed' or index is None:
+                    chain.append((joint, None, 0.0, 0.0))
+                else:
+                    chain.append((joint, index, multiplier, offset))
+                link = joint.parent
+                if len(chain) > len(self.joints):
+                    raise ValueError("the joints above link %s form a loop" % linkName)
+            self._chains[linkName] = chain[::-1]
+        return self._chains[linkName]
+
+    def getBaseTransforms(self, poses):
+        """
+        :return: N x 4 x 4 root link to world transforms
+        """
+        poses = np.asarray(poses, dtype=np.float64)
+        transforms = np.tile(np.eye(4), (len(poses), 1, 1))
+        if self.baseIndices is not None:
+            base = poses[:, self.baseIndices]
+            transforms[:, :3, :3] = rpyMatrices(base[:, 3:6])
+            transforms[:, :3, 3] = base[:, 0:3]
+        return transforms
+
+    def getLinkTransforms(self, linkName, poses):
+        """
+        :param poses: N x nq, ordered like jointNames
+        :return: N x 4 x 4 link to world transforms
+        """
+        poses = np.atleast_2d(np.asarray(poses, dtype=np.float64))
+        transforms = self.getBaseTransforms(poses)
+        for joint, index, multiplier, offset in self._getChain(linkName):
+            transforms = np.matmul(transforms, joint.origin)
+            if index is None:
+                continue
+            q = poses[:, index]*multiplier + offset
+            if joint.type == 'prismatic':
+                transforms[:, :3, 3] += np.matmul(transforms[:, :3, :3], joint.axis)*q[:, np.newaxis]
+            else:
+                transforms[:, :3, :3] = np.matmul(transforms[:, :3, :3], rotationMatrices(joint.axis, q))
+        return transforms
+
+    def getLinkPoints(self, linkName, poses, pointInLink):
+        """
+        :param pointInLink: 3 vector in the link frame
+        :return: N x 3 positions of the point in world
+        """
+        transforms = self.getLinkTransforms(linkName, poses)
+        return np.matmul(transforms[:, :3, :3], pointInLink) + transforms[:, :3, 3]
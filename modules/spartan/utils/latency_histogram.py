@@ -0,0 +1,56 @@
+# system
+import numpy as np
+
+
+"""
+Fixed bin latency histograms, shared by the teleop latency tracker and the
+robot_control service latency stats.
+"""
+
+
+class LatencyHistogram(object):
+    """
+    Fixed bin histogram of latencies in seconds, values past max_latency
+    land in the last bin
+    """
+
+    def __init__(self, bin_width=0.001, max_latency=0.5):
+        self.bin_width = bin_width
+        self.counts = np.zeros(int(np.ceil(max_latency/bin_width)) + 1, dtype=np.int64)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, latency):
+        latency = max(latency, 0.0)
+        self.counts[min(int(latency/self.bin_width), len(self.counts) - 1)] += 1
+        self.count += 1
+        self.total += latency
+        self.max = max(self.max, latency)
+
+    @property
+    def mean(self):
+        return self.total/self.count if self.count else 0.0
+
+    def percentile(self, p):
+        """
+        :return: upper edge of the bin holding the p-th percentile, p in [0, 100]
+        """
+        if not self.count:
+            return 0.0
+        rank = int(np.ceil(p/100.0*self.count))
+        index = np.searchsorted(np.cumsum(self.counts), max(rank, 1))
+        return min((index + 1)*self.bin_width, self.max)
+
+    def summary(self):
+        """
+        :return: dict of count and mean, p50, p90, p99 and max in milliseconds
+        """
+        return {
+            'count': int(self.count),
+            'mean_ms': 1000*self.mean,
+            'p50_ms': 1000*self.percentile(50),
+            'p90_ms': 1000*self.percentile(90),
+            'p99_ms': 1000*self.percentile(99),
+            'max_ms': 1000*self.max,
+        }
@@ -0,0 +1,416 @@
+# system
+import numpy as np
+
+# director
+from director import vtkAll as vtk
+from director import vtkNumpy as vnp
+
+
+"""
+Batch point to surface distance queries against a triangle mesh.
+
+vtkCellLocator.FindClosestPoint answers one point per call and most of the
+time goes into its tree search, not the python loop around it, so a native
+batch call over the same locator doesn't help much. MeshDistanceIndex
+instead only answers queries up to a maxDistance, which is all that alignment
+scoring needs, and does so for all the points at once in numpy. The work
+grows with maxDistance, keep it as small as the caller allows.
+
+Distances within maxDistance are exact, points further away get np.inf.
+
+Usage:
+
+    index = getMeshDistanceIndex(meshPolyData, maxDistance=0.05)
+    dists = index.distances(points)
+    dists, closestPoints, triangleIds = index.query(points)
+"""
+
+# queries are processed in batches of coarse cells with about this many candidate
+# triangles in total, to bound memory
+QUERY_BATCH_PAIRS = 1 << 18
+
+
+def _dot(a, b):
+    return np.einsum('ij,ij->i', a, b)
+
+
+def closest_points_on_triangles(p, a, b, c):
+    """
+    Vectorized closest point on triangle (Ericson, Real-Time Collision Detection 5.1.5)
+
+    :param p: N x 3 query points
+    :param a, b, c: N x 3 triangle vertices, triangle i is a[i], b[i], c[i]
+    :return: N x 3 closest points
+    :rtype: np.ndarray
+    """
+    ab = b - a
+    ac = c - a
+    ap = p - a
+    d1 = _dot(ab, ap)
+    d2 = _dot(ac, ap)
+
+    bp = p - b
+    d3 = _dot(ab, bp)
+    d4 = _dot(ac, bp)
+
+    cp = p - c
+    d5 = _dot(ab, cp)
+    d6 = _dot(ac, cp)
+
+    va = d3*d6 - d5*d4
+    vb = d5*d2 - d1*d6
+    vc = d1*d4 - d3*d2
+
+    # the closest point is a + s*ab + t*ac, the regions are tested in order and the first one wins
+    with np.errstate(divide='ignore', invalid='ignore'):
+        conditions = [(d1 <= 0) & (d2 <= 0),                           # vertex a
+                      (d3 >= 0) & (d4 <= d3),                          # vertex b
+                      (vc <= 0) & (d1 >= 0) & (d3 <= 0),               # edge ab
+                      (d6 >= 0) & (d5 <= d6),                          # vertex c
+                      (vb <= 0) & (d2 >= 0) & (d6 <= 0),               # edge ac
+                      (va <= 0) & (d4 - d3 >= 0) & (d5 - d6 >= 0)]     # edge bc
+
+        w_bc = (d4 - d3)/((d4 - d3) + (d5 - d6))
+        denom = va + vb + vc
+        s = np.select(conditions, [0.0, 1.0, d1/(d1 - d3), 0.0, 0.0, 1.0 - w_bc], default=vb/denom)
+        t = np.select(conditions, [0.0, 0.0, 0.0, 1.0, d2/(d2 - d6), w_bc], default=vc/denom)
+
+    # degenerate triangles can end up with NaNs, fall back to vertex a
+    s[~np.isfinite(s)] = 0.0
+    t[~np.isfinite(t)] = 0.0
+
+    return a + s[:, np.newaxis]*ab + t[:, np.newaxis]*ac
+
+
+def _expand(starts, counts):
+    """
+    :return: tuple (groupIds, index), for every group i the entries
+    starts[i], ..., starts[i] + counts[i] - 1 with group id i
+    """
+    # np.repeat is slow for many small counts, the group ids are the running
+    # count of the group ends instead
+    ends = np.cumsum(counts)
+    total = ends[-1] if len(ends) else 0
+    groupIds = np.cumsum(np.bincount(ends[:-1], minlength=total + 1)[:total])
+    index = np.arange(total)
+    index += np.take(starts - (ends - counts), groupIds)
+    return groupIds, index
+
+
+def _pairDistances(a, aIds, b, bIds):
+    """
+    :return: |a[aIds] - b[bIds]|, gathered column by column which is a lot
+    faster than fancy indexing the rows
+    """
+    d2 = np.zeros(len(aIds))
+    for i in xrange(3):
+        d = np.take(a[:, i], aIds)
+        d -= np.take(b[:, i], bIds)
+        d *= d
+        d2 += d
+    return np.sqrt(d2)
+
+
+def _groups(sortedIds):
+    """
+    :return: tuple (groupStarts, groupIndex), where each run of equal ids starts
+    and the index of the run of every entry
+    """
+    first = np.empty(len(sortedIds), dtype=np.bool_)
+    first[:1] = True
+    np.not_equal(sortedIds[1:], sortedIds[:-1], out=first[1:])
+    groupIndex = np.cumsum(first)
+    groupIndex -= 1
+    return np.flatnonzero(first), groupIndex
+
+
+class MeshDistanceIndex(object):
+    """
+    The triangles are bucketed once into a coarse uniform grid, every cell lists
+    the triangles whose bounding box grown by maxDistance overlaps it.
+
+    A query only looks at the cells that contain query points. Their candidate
+    lists are pruned with bounding spheres: a triangle can only be the closest
+    one for some point in the cell if its sphere is within a cell diagonal of
+    the nearest triangle. The occupied cells are then split in 8 and the lists
+    pruned again, down to about the triangle size. What remains are a few
+    candidates per point, which get the exact closest point test.
+    """
+
+    # stop subdividing once the cells have this few candidates on average
+    LEAF_CANDIDATES = 32
+
+    def __init__(self, vertices, triangles, maxDistance):
+        """
+        :param vertices: V x 3 array
+        :param triangles: M x 3 integer array of vertex indices
+        :param maxDistance: queries are exact up to this distance
+        """
+        self.maxDistance = float(maxDistance)
+        self._a = np.ascontiguousarray(vertices[triangles[:, 0]], dtype=np.float64)
+        self._b = np.ascontiguousarray(vertices[triangles[:, 1]], dtype=np.float64)
+        self._c = np.ascontiguousarray(vertices[triangles[:, 2]], dtype=np.float64)
+        self._buildGrid()
+
+    @property
+    def numberOfTriangles(self):
+        return len(self._a)
+
+    def _buildGrid(self):
+        # the distance to the centroid bounds the distance to the triangle from above,
+        # minus the bounding sphere radius from below
+        self._centroids = (self._a + self._b + self._c)/3.0
+        self._radii = np.sqrt(np.maximum(np.maximum(_dot(self._a - self._centroids, self._a - self._centroids),
+                                                    _dot(self._b - self._centroids, self._b - self._centroids)),
+                                         _dot(self._c - self._centroids, self._c - self._centroids)))
+
+        lower = np.minimum(np.minimum(self._a, self._b), self._c)
+        upper = np.maximum(np.maximum(self._a, self._b), self._c)
+
+        extents = (upper - lower).max(axis=1)
+        self._leafSize = max(float(np.median(extents)) if len(extents) else 0.0, 1e-6)
+
+        # cells no smaller than a typical triangle, otherwise large triangles get listed in too many cells
+        self._cellSize = max(self.maxDistance, self._leafSize)
+
+        lower -= self.maxDistance
+        upper += self.maxDistance
+        self._origin = lower.min(axis=0) if len(lower) else np.zeros(3)
+        lo = np.floor((lower - self._origin)/self._cellSize).astype(np.int64)
+        hi = np.floor((upper - self._origin)/self._cellSize).astype(np.int64)
+        self._dims = (hi.max(axis=0) + 1) if len(hi) else np.ones(3, dtype=np.int64)
+
+        # expand every triangle into the cells of its box
+        boxDims = hi - lo + 1
+        triangleIds, local = _expand(np.zeros(len(boxDims), dtype=np.int64), np.prod(boxDims, axis=1))
+        boxDims = boxDims[triangleIds]
+        k = local % boxDims[:, 2]
+        j = (local // boxDims[:, 2]) % boxDims[:, 1]
+        i = local // (boxDims[:, 2]*boxDims[:, 1])
+        cells = lo[triangleIds] + np.stack([i, j, k], axis=1)
+
+        keys = self._cellKeys(cells, self._dims)
+        order = np.argsort(keys, kind='mergesort')
+        keys = keys[order]
+        self._cellTriangles = triangleIds[order]
+
+        # CSR layout, triangles of cell self._keys[n] are self._cellTriangles[self._starts[n]:self._starts[n+1]]
+        self._keys, self._starts = np.unique(keys, return_index=True)
+        self._starts = np.append(self._starts, len(keys))
+
+    @staticmethod
+    def _cellKeys(cells, dims):
+        return (cells[:, 0]*dims[1] + cells[:, 1])*dims[2] + cells[:, 2]
+
+    def _occupiedCells(self, points, cellSize, dims):
+        """
+        :return: tuple (coords, firstPoint, pointCell), integer coordinates of the
+        occupied cells, a point in each of them and the cell of every point
+        """
+        coords = np.floor((points - self._origin)/cellSize).astype(np.int64)
+        _, firstPoint, pointCell = np.unique(self._cellKeys(coords, dims), return_index=True, return_inverse=True)
+        return coords[firstPoint], firstPoint, pointCell
+
+    def _prune(self, centers, cellSize, pairCells, pairTriangles):
+        """
+        Drops the (cell, triangle) pairs where the triangle can't be the closest
+        one within maxDistance for any point in the cell. Pairs are grouped by cell.
+        """
+        if len(pairCells) == 0:
+            return pairCells, pairTriangles
+
+        d = _pairDistances(centers, pairCells, self._centroids, pairTriangles)
+        keep = self._boundsFilter(centers, d, pairCells, pairTriangles, 0.5*np.sqrt(3.0)*cellSize)
+        return pairCells[keep], pairTriangles[keep]
+
+    def _boundsFilter(self, points, d, groupIds, triangleIds, radius):
+        """
+        Bounding sphere test of (point, triangle) pairs grouped by point.
+        The exact distance to the triangle with the nearest centroid bounds the
+        distance to the mesh from above, triangles whose bounding sphere is
+        further away than that can't be the closest one.
+
+        :param points: the points, or the centers of cells with the given radius
+        :param d: the distances from points[groupIds] to the centroids of triangleIds
+        :return: mask of the pairs to keep
+        """
+        groupStarts, groupIndex = _groups(groupIds)
+        nearest = np.flatnonzero(d == np.take(np.minimum.reduceat(d, groupStarts), groupIndex))
+        nearest = nearest[np.r_[True, groupIds[nearest[1:]] != groupIds[nearest[:-1]]]]
+
+        p = points[groupIds[nearest]]
+        t = triangleIds[nearest]
+        q = closest_points_on_triangles(p, self._a[t], self._b[t], self._c[t])
+        upperBounds = np.minimum(np.sqrt(_dot(p - q, p - q)) + radius, self.maxDistance)
+
+        return d - np.take(self._radii, triangleIds) - radius <= np.take(upperBounds, groupIndex)
+
+    def _queryLeaves(self, points, starts, counts, candidates):
+        """
+        Exact closest points, the candidates of point i are candidates[starts[i]:starts[i] + counts[i]]
+        """
+        numPoints = len(points)
+        distances2 = np.full(numPoints, np.inf)
+        closestPoints = np.full((numPoints, 3), np.nan)
+        closestTriangles = np.full(numPoints, -1, dtype=np.int64)
+
+        pointIds, index = _expand(starts, counts)
+        if len(pointIds) == 0:
+            return distances2, closestPoints, closestTriangles
+
+        triangleIds = candidates[index]
+
+        # same bounds per point, only the survivors get the exact test
+        d = _pairDistances(points, pointIds, self._centroids, triangleIds)
+        keep = self._boundsFilter(points, d, pointIds, triangleIds, 0.0)
+        pointIds = pointIds[keep]
+        triangleIds = triangleIds[keep]
+        if len(pointIds) == 0:
+            return distances2, closestPoints, closestTriangles
+        p = points[pointIds]
+
+        q = closest_points_on_triangles(p, self._a[triangleIds], self._b[triangleIds], self._c[triangleIds])
+        d2 = _dot(p - q, p - q)
+
+        groupStarts, _ = _groups(pointIds)
+        distances2[pointIds[groupStarts]] = np.minimum.reduceat(d2, groupStarts)
+
+        # any pair attaining the min will do
+        best = np.flatnonzero(d2 == distances2[pointIds])
+        closestPoints[pointIds[best]] = q[best]
+        closestTriangles[pointIds[best]] = triangleIds[best]
+
+        return distances2, closestPoints, closestTriangles
+
+    def _refine(self, points, pointCell, cellCoords, pairCells, pairTriangles):
+        """
+        Splits the occupied cells until they have about LEAF_CANDIDATES candidates
+        each or are a quarter of the typical triangle size, then runs the exact test.
+
+        :param pointCell: coarse cell of every point, an index into cellCoords
+        :param pairCells: the cell of every (cell, triangle) pair, sorted
+        :return: tuple (squaredDistances, closestPoints, triangleIds) of the points
+        """
+        cellSize = self._cellSize
+        dims = self._dims.copy()
+
+        while cellSize/2 >= 0.25*self._leafSize and len(pairTriangles) > self.LEAF_CANDIDATES*len(cellCoords):
+            numCells = len(cellCoords)
+            parentCounts = np.bincount(pairCells, minlength=numCells)
+            parentStarts = np.cumsum(parentCounts) - parentCounts
+
+            cellSize /= 2
+            dims *= 2
+            cellCoords, firstPoint, childCell = self._occupiedCells(points, cellSize, dims)
+            parents = pointCell[firstPoint]
+            pointCell = childCell
+
+            pairCells, index = _expand(parentStarts[parents], parentCounts[parents])
+            pairTriangles = pairTriangles[index]
+
+            centers = self._origin + (cellCoords + 0.5)*cellSize
+            pairCells, pairTriangles = self._prune(centers, cellSize, pairCells, pairTriangles)
+
+        cellCounts = np.bincount(pairCells, minlength=len(cellCoords))
+        cellStarts = np.cumsum(cellCounts) - cellCounts
+        return self._queryLeaves(points, cellStarts[pointCell], cellCounts[pointCell], pairTriangles)
+
+    def query(self, points):
+        """
+        :param points: N x 3 array
+        :return: tuple (distances, closestPoints, triangleIds). Points further than
+        maxDistance from the mesh get distance np.inf, closest point NaN and triangle id -1.
+        :rtype: tuple
+        """
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+        distances = np.full(len(points), np.inf)
+        closestPoints = np.full((len(points), 3), np.nan)
+        triangleIds = np.full(len(points), -1, dtype=np.int64)
+
+        # points outside the grid are further than maxDistance from every triangle
+        coords = np.floor((points - self._origin)/self._cellSize)
+        inside = np.flatnonzero(np.all((coords >= 0) & (coords < self._dims), axis=1))
+        if len(inside) == 0 or len(self._keys) == 0:
+            return distances, closestPoints, triangleIds
+
+        # candidates of the occupied coarse cells
+        cellCoords, _, pointCell = self._occupiedCells(points[inside], self._cellSize, self._dims)
+        keys = self._cellKeys(cellCoords, self._dims)
+        n = np.clip(np.searchsorted(self._keys, keys), 0, len(self._keys) - 1)
+        counts = np.where(self._keys[n] == keys, self._starts[n + 1] - self._starts[n], 0)
+        pairCells, index = _expand(self._starts[n], counts)
+        pairTriangles = self._cellTriangles[index]
+
+        centers = self._origin + (cellCoords + 0.5)*self._cellSize
+        pairCells, pairTriangles = self._prune(centers, self._cellSize, pairCells, pairTriangles)
+
+        # refine batches of coarse cells with about QUERY_BATCH_PAIRS candidates, the
+        # candidate lists grow a few times over before the pruning catches up
+        numCells = len(cellCoords)
+        order = np.argsort(pointCell, kind='mergesort')
+        cellPointStarts = np.searchsorted(pointCell[order], np.arange(numCells + 1))
+        cellPairStarts = np.searchsorted(pairCells, np.arange(numCells + 1))
+        boundaries = np.searchsorted(cellPairStarts, np.arange(0, len(pairCells), QUERY_BATCH_PAIRS), side='right')
+        boundaries = np.unique(np.r_[0, boundaries, numCells].clip(0, numCells))
+
+        for first, last in zip(boundaries[:-1], boundaries[1:]):
+            batch = order[cellPointStarts[first]:cellPointStarts[last]]
+            pairs = slice(cellPairStarts[first], cellPairStarts[last])
+            ids = inside[batch]
+            distances2, closestPoints[ids], triangleIds[ids] = \
+                self._refine(points[ids], pointCell[batch] - first, cellCoords[first:last],
+                             pairCells[pairs] - first, pairTriangles[pairs])
+            distances[ids] = np.sqrt(distances2)
+
+        beyond = distances > self.maxDistance
+        distances[beyond] = np.inf
+        closestPoints[beyond] = np.nan
+        triangleIds[beyond] = -1
+        return distances, closestPoints, triangleIds
+
+    def distances(self, points):
+        """
+        :return: length N array of distances to the mesh, np.inf beyond maxDistance
+        :rtype: np.ndarray
+        """
+        return self.query(points)[0]
+
+    @staticmethod
+    def fromPolyData(polyData, maxDistance):
+        """
+        Builds the index from the polygons of polyData, they are triangulated first
+        """
+        f = vtk.vtkTriangleFilter()
+        f.SetInputData(polyData)
+        f.PassVertsOff()
+        f.PassLinesOff()
+        f.Update()
+        triangulated = f.GetOutput()
+
+        vertices = vnp.getNumpyFromVtk(triangulated, 'Points')
+        polys = vnp.numpy_support.vtk_to_numpy(triangulated.GetPolys().GetData())
+        triangles = polys.reshape(-1, 4)[:, 1:]
+        return MeshDistanceIndex(vertices, triangles, maxDistance)
+
+
+_indexCache = dict()
+
+
+def getMeshDistanceIndex(meshPolyData, maxDistance):
+    """
+    Returns the MeshDistanceIndex for meshPolyData, building it only the first time
+    and again when the mesh was modified
+    :rtype: MeshDistanceIndex
+    """
+    key = (id(meshPolyData), float(maxDistance))
+    entry = _indexCache.get(key)
+    if entry is not None and entry[0] is meshPolyData and entry[1] == meshPolyData.GetMTime():
+        return entry[2]
+
+    # the mesh is held on to so its id stays valid, keep only a handful around
+    if len(_indexCache) >= 8:
+        _indexCache.clear()
+
+    index = MeshDistanceIndex.fromPolyData(meshPolyData, maxDistance)
+    _indexCache[key] = (meshPolyData, meshPolyData.GetMTime(), index)
+    return index
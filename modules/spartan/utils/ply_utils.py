@@ -0,0 +1,268 @@
+# system
+import numpy as np
+
+
+"""
+Reading PLY point clouds (e.g. the surfel maps ElasticFusion saves) into numpy
+and writing them out as VTP, without vtk or any intermediate files.
+
+Binary PLY files are memory mapped, the vertices are a structured numpy
+array over the file and the x/y/z, normals and colors are strided views of
+it, so loading is instant and nothing is read until it's used.
+
+Usage:
+
+    vertices = load_ply_vertices("log.lcmlog.ply")
+    arrays = vertex_arrays(vertices)  # dict with 'points', 'normals', 'colors', 'radius'
+    write_vtp("reconstructed_pointcloud.vtp", arrays['points'], normals=arrays['normals'],
+              colors=arrays['colors'], point_arrays={'radius': arrays['radius']})
+"""
+
+# PLY property type -> numpy type
+PLY_DATATYPES = {
+    'char': 'i1', 'int8': 'i1',
+    'uchar': 'u1', 'uint8': 'u1',
+    'short': 'i2', 'int16': 'i2',
+    'ushort': 'u2', 'uint16': 'u2',
+    'int': 'i4', 'int32': 'i4',
+    'uint': 'u4', 'uint32': 'u4',
+    'float': 'f4', 'float32': 'f4',
+    'double': 'f8', 'float64': 'f8',
+}
+
+PLY_FORMATS = {
+    'binary_little_endian': '<',
+    'binary_big_endian': '>',
+    'ascii': '=',
+}
+
+# numpy type -> VTK XML type name
+VTK_DATATYPES = {
+    np.dtype('int8'): 'Int8',
+    np.dtype('uint8'): 'UInt8',
+    np.dtype('int16'): 'Int16',
+    np.dtype('uint16'): 'UInt16',
+    np.dtype('int32'): 'Int32',
+    np.dtype('uint32'): 'UInt32',
+    np.dtype('int64'): 'Int64',
+    np.dtype('uint64'): 'UInt64',
+    np.dtype('float32'): 'Float32',
+    np.dtype('float64'): 'Float64',
+}
+
+# arrays are written to the VTP file in chunks of this many rows
+WRITE_CHUNK_SIZE = 1 << 20
+
+
+def read_ply_header(f):
+    """
+    Parses the header of a PLY file.
+
+    :param f: file object opened in binary mode, positioned at the start of the file
+    :return: tuple (format, elements, header_size). elements is a list of
+    (name, count, properties) tuples, properties a list of (name, type) tuples,
+    where type is a numpy type string or None for list properties
+    :rtype: tuple
+    """
+    if f.readline().strip() != 'ply':
+        raise ValueError("not a PLY file")
+
+    ply_format = None
+    elements = []
+    while True:
+        line = f.readline()
+        if not line:
+            raise ValueError("PLY header has no end_header")
+
+        tokens = line.split()
+        if not tokens or tokens[0] in ['comment', 'obj_info']:
+            continue
+
+        if tokens[0] == 'end_header':
+            break
+        elif tokens[0] == 'format':
+            if tokens[1] not in PLY_FORMATS:
+                raise ValueError("unknown PLY format %s" % tokens[1])
+            ply_format = tokens[1]
+        elif tokens[0] == 'element':
+            elements.append((tokens[1], int(tokens[2]), []))
+        elif tokens[0] == 'property':
+            if tokens[1] == 'list':
+                elements[-1][2].append((tokens[-1], None))
+            else:
+                elements[-1][2].append((tokens[2], PLY_DATATYPES[tokens[1]]))
+
+    return ply_format, elements, f.tell()
+
+
+def load_ply_vertices(filename, mmap=True):
+    """
+    Loads the vertex element of a PLY file as a structured array, one field per property.
+
+    :param mmap: memory map binary files instead of reading them
+    :return: structured np.ndarray (a np.memmap if mmap is True and the file is binary)
+    :rtype: np.ndarray
+    """
+    with open(filename, 'rb') as f:
+        ply_format, elements, header_size = read_ply_header(f)
+
+        if not elements or elements[0][0] != 'vertex':
+            raise ValueError("%s doesn't start with a vertex element" % filename)
+
+        _, num_vertices, properties = elements[0]
+        if any(datatype is None for _, datatype in properties):
+            raise ValueError("list properties in the vertex element aren't supported")
+
+        byte_order = PLY_FORMATS[ply_format]
+        dtype = np.dtype([(name, byte_order + datatype) for name, datatype in properties])
+
+        if ply_format == 'ascii':
+            return np.loadtxt(f, dtype=dtype, ndmin=1)[:num_vertices]
+
+        if not mmap:
+            f.seek(header_size)
+            return np.fromfile(f, dtype=dtype, count=num_vertices)
+
+    return np.memmap(filename, dtype=dtype, mode='r', offset=header_size, shape=(num_vertices,))
+
+
+def field_block_view(vertices, names):
+    """
+    Returns an (N, len(names)) view of consecutive fields of the same type,
+    e.g. ['x', 'y', 'z']. Falls back to a stacked copy if they aren't consecutive.
+
+    :param vertices: structured array from load_ply_vertices
+    :rtype: np.ndarray
+    """
+    fields = vertices.dtype.fields
+    dtype, offset = fields[names[0]][:2]
+    consecutive = all(fields[name][0] == dtype and fields[name][1] == offset + i*dtype.itemsize
+                      for i, name in enumerate(names))
+
+    if not consecutive:
+        return np.stack([vertices[name] for name in names], axis=-1)
+
+    return np.ndarray(shape=(len(vertices), len(names)), dtype=dtype, buffer=vertices,
+                      offset=offset, strides=(vertices.strides[0], dtype.itemsize))
+
+
+def vertex_arrays(vertices):
+    """
+    :param vertices: structured array from load_ply_vertices
+    :return: dict with 'points' (N x 3) and where present 'normals' (N x 3),
+    'colors' (N x 3 uint8) and 'radius' (N), all views of vertices if possible
+    :rtype: dict
+    """
+    names = vertices.dtype.names
+    arrays = dict()
+    arrays['points'] = field_block_view(vertices, ['x', 'y', 'z'])
+
+    if 'nx' in names:
+        arrays['normals'] = field_block_view(vertices, ['nx', 'ny', 'nz'])
+    if 'red' in names:
+        arrays['colors'] = field_block_view(vertices, ['red', 'green', 'blue'])
+    if 'radius' in names:
+        arrays['radius'] = vertices['radius']
+
+    return arrays
+
+
+def save_npz(filename, vertices):
+    """
+    Saves the vertex_arrays of vertices to an npz file
+    """
+    np.savez(filename, **vertex_arrays(vertices))
+
+
+def _native(array):
+    dtype = array.dtype.newbyteorder('<') if array.dtype.byteorder == '>' else array.dtype
+    return np.dtype(dtype.type)
+
+
+def _write_appended_array(f, array):
+    # raw appended data is a UInt64 byte count followed by the little endian values
+    array = array.reshape(len(array), -1)
+    dtype = np.dtype('<' + _native(array).str[1:])
+    f.write(np.uint64(array.size*dtype.itemsize).astype('<u8').tobytes())
+    for start in xrange(0, len(array), WRITE_CHUNK_SIZE):
+        f.write(np.ascontiguousarray(array[start:start + WRITE_CHUNK_SIZE], dtype=dtype).tobytes())
+
+
+def write_vtp(filename, points, normals=None, colors=None, point_arrays=None):
+    """
+    Writes a point cloud as VTK XML PolyData with raw appended data, with a
+    vertex cell per point so it renders as is in director. The arrays are
+    written in chunks, they can be (views of) memory mapped files.
+
+    :param points: N x 3 array
+    :param normals: N x 3 array, written as the 'Normals' point data
+    :param colors: N x 3 uint8 array, written as the 'RGB' point data (as vtkPLYReader names it)
+    :param point_arrays: dict of additional N or N x k point data arrays
+    """
+    num_points = len(points)
+
+    data_arrays = []
+    if colors is not None:
+        data_arrays.append(('RGB', colors))
+    if normals is not None:
+        data_arrays.append(('Normals', normals))
+    for name, array in sorted((point_arrays or dict()).items()):
+        data_arrays.append((name, array))
+
+    # connectivity and offsets of the vertex cells, generated chunk by chunk when writing
+    cells = [('connectivity', 0), ('offsets', 1)]
+
+    def array_nbytes(array):
+        return 8 + array.size*array.dtype.itemsize
+
+    offset = 0
+    xml = []
+    xml.append('<?xml version="1.0"?>')
+    xml.append('<VTKFile type="PolyData" version="1.0" byte_order="LittleEndian" header_type="UInt64">')
+    xml.append('  <PolyData>')
+    xml.append('    <Piece NumberOfPoints="%d" NumberOfVerts="%d" NumberOfLines="0" NumberOfStrips="0" '
+               'NumberOfPolys="0">' % (num_points, num_points))
+
+    attributes = ''
+    if colors is not None:
+        attributes += ' Scalars="RGB"'
+    if normals is not None:
+        attributes += ' Normals="Normals"'
+    xml.append('      <PointData%s>' % attributes)
+    for name, array in data_arrays:
+        num_components = 1 if array.ndim == 1 else array.shape[1]
+        xml.append('        <DataArray type="%s" Name="%s" NumberOfComponents="%d" format="appended" offset="%d"/>'
+                   % (VTK_DATATYPES[_native(array)], name, num_components, offset))
+        offset += array_nbytes(array)
+    xml.append('      </PointData>')
+
+    xml.append('      <Points>')
+    xml.append('        <DataArray type="%s" NumberOfComponents="3" format="appended" offset="%d"/>'
+               % (VTK_DATATYPES[_native(points)], offset))
+    offset += array_nbytes(points)
+    xml.append('      </Points>')
+
+    xml.append('      <Verts>')
+    for name, _ in cells:
+        xml.append('        <DataArray type="Int64" Name="%s" format="appended" offset="%d"/>' % (name, offset))
+        offset += 8 + 8*num_points
+    xml.append('      </Verts>')
+
+    xml.append('    </Piece>')
+    xml.append('  </PolyData>')
+    xml.append('  <AppendedData encoding="raw">')
+
+    with open(filename, 'wb') as f:
+        f.write('\n'.join(xml) + '\n   _')
+
+        for _, array in data_arrays:
+            _write_appended_array(f, array)
+        _write_appended_array(f, points)
+
+        for _, start in cells:
+            f.write(np.uint64(8*num_points).astype('<u8').tobytes())
+            for chunk_start in xrange(0, num_points, WRITE_CHUNK_SIZE):
+                chunk_end = min(chunk_start + WRITE_CHUNK_SIZE, num_points)
+                f.write(np.arange(chunk_start + start, chunk_end + start, dtype='<i8').tobytes())
+
+        f.write('\n  </AppendedData>\n</VTKFile>\n')
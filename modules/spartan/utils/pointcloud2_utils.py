@@ -0,0 +1,326 @@
+# system
+import numpy as np
+
+# ROS
+import sensor_msgs.msg
+
+
+"""
+Fast conversion between sensor_msgs/PointCloud2 and numpy.
+
+Decoding doesn't go through ros_numpy. The returned arrays are strided views
+directly over msg.data, built from the field offsets and point_step, so
+no data is copied unless NaN filtering is requested. Note that the views are
+read-only and share memory with the message.
+
+See http://www.ros.org/reps/rep-0118.html and sensor_msgs/PointField for the
+layout of the message.
+"""
+
+# PointField datatype -> numpy type
+POINTFIELD_DATATYPES = {
+    sensor_msgs.msg.PointField.INT8: np.int8,
+    sensor_msgs.msg.PointField.UINT8: np.uint8,
+    sensor_msgs.msg.PointField.INT16: np.int16,
+    sensor_msgs.msg.PointField.UINT16: np.uint16,
+    sensor_msgs.msg.PointField.INT32: np.int32,
+    sensor_msgs.msg.PointField.UINT32: np.uint32,
+    sensor_msgs.msg.PointField.FLOAT32: np.float32,
+    sensor_msgs.msg.PointField.FLOAT64: np.float64,
+}
+
+
+def get_pointfield(msg, name):
+    """
+    :param msg: sensor_msgs/PointCloud2
+    :param name: name of the field, e.g. 'x'
+    :return: the PointField with that name, or None
+    :rtype: sensor_msgs/PointField
+    """
+    for field in msg.fields:
+        if field.name == name:
+            return field
+    return None
+
+
+def _get_numpy_dtype(msg, field):
+    dtype = np.dtype(POINTFIELD_DATATYPES[field.datatype])
+    if msg.is_bigendian:
+        dtype = dtype.newbyteorder('>')
+    else:
+        dtype = dtype.newbyteorder('<')
+    return dtype
+
+
+def _strided_view(msg, offset, dtype, num_components, component_stride):
+    """
+    Builds an (height, width, num_components) view over msg.data. Rows
+    are addressed with row_step so padded rows are handled correctly.
+    """
+    return np.ndarray(shape=(msg.height, msg.width, num_components), dtype=dtype,
+                      buffer=msg.data, offset=offset,
+                      strides=(msg.row_step, msg.point_step, component_stride))
+
+
+def _flatten_view(view, keep_organized):
+    if keep_organized:
+        return view
+
+    # this is still a view (no copy) unless rows are padded
+    return view.reshape(-1, view.shape[-1])
+
+
+def field_view_from_pointcloud2_msg(msg, name, keep_organized=False):
+    """
+    Returns a view of a single field of the message
+    :param msg: sensor_msgs/PointCloud2
+    :param name: name of the field
+    :param keep_organized: if True returns (height, width, count) array, otherwise (N, count)
+    :return: read-only np.ndarray viewing msg.data
+    :rtype: np.ndarray
+    """
+    field = get_pointfield(msg, name)
+    if field is None:
+        raise ValueError("PointCloud2 message has no field %s" % name)
+
+    dtype = _get_numpy_dtype(msg, field)
+    count = max(field.count, 1)
+    view = _strided_view(msg, field.offset, dtype, count, dtype.itemsize)
+    return _flatten_view(view, keep_organized)
+
+
+def _get_xyz_fields(msg):
+    """
+    :return: tuple (fields, dtype, consecutive), consecutive is True if x, y, z
+    are stored next to each other with the same type
+    """
+    fields = [get_pointfield(msg, name) for name in ['x', 'y', 'z']]
+    if None in fields:
+        raise ValueError("PointCloud2 message doesn't have x, y and z fields")
+
+    dtype = _get_numpy_dtype(msg, fields[0])
+    consecutive = all(f.datatype == fields[0].datatype for f in fields) and \
+                  fields[1].offset == fields[0].offset + dtype.itemsize and \
+                  fields[2].offset == fields[0].offset + 2*dtype.itemsize
+
+    return fields, dtype, consecutive
+
+
+def xyz_view_from_pointcloud2_msg(msg, keep_organized=False):
+    """
+    Returns an (N, 3) view of the x, y, z fields. If the fields are
+    consecutive and of the same type (which is the case for all the drivers
+    we use) this doesn't copy anything, otherwise the fields are stacked.
+
+    :param msg: sensor_msgs/PointCloud2
+    :param keep_organized: if True returns (height, width, 3) array
+    :rtype: np.ndarray
+    """
+    fields, dtype, consecutive = _get_xyz_fields(msg)
+
+    if consecutive:
+        view = _strided_view(msg, fields[0].offset, dtype, 3, dtype.itemsize)
+    else:
+        view = np.concatenate([_strided_view(msg, f.offset, _get_numpy_dtype(msg, f), 1, 1) for f in fields],
+                              axis=2)
+
+    return _flatten_view(view, keep_organized)
+
+
+def _gather_valid_xyz(msg, points, valid):
+    """
+    Copies out the valid points. When x, y, z are consecutive each point is
+    viewed as a single 3-vector record, gathering whole records is
+    considerably faster than gathering rows of a strided float view.
+    """
+    fields, dtype, consecutive = _get_xyz_fields(msg)
+    if not consecutive:
+        return points[valid]
+
+    records = np.ndarray(shape=(msg.height, msg.width), dtype=np.dtype([('xyz', dtype, 3)]),
+                         buffer=msg.data, offset=fields[0].offset,
+                         strides=(msg.row_step, msg.point_step))
+    return records.reshape(-1)[valid]['xyz']
+
+
+def rgb_view_from_pointcloud2_msg(msg, keep_organized=False):
+    """
+    Returns an (N, 3) uint8 view of the colors, in r, g, b order. Handles
+    both the packed float 'rgb' field and the uint32 'rgba' field, which
+    are both laid out as b, g, r, a bytes (little endian).
+
+    :param msg: sensor_msgs/PointCloud2
+    :param keep_organized: if True returns (height, width, 3) array
+    :rtype: np.ndarray
+    """
+    field = get_pointfield(msg, 'rgb')
+    if field is None:
+        field = get_pointfield(msg, 'rgba')
+    if field is None:
+        raise ValueError("PointCloud2 message has no rgb or rgba field")
+
+    if msg.is_bigendian:
+        # bytes are a, r, g, b
+        view = _strided_view(msg, field.offset + 1, np.uint8, 3, 1)
+    else:
+        # bytes are b, g, r, a. Start at r and walk backwards
+        view = _strided_view(msg, field.offset + 2, np.uint8, 3, -1)
+
+    return _flatten_view(view, keep_organized)
+
+
+def numpy_from_pointcloud2_msg(msg, remove_nans=False, keep_organized=False, return_rgb=False):
+    """
+    Decodes a PointCloud2 into numpy arrays.
+
+    Without remove_nans this does no copying at all. With remove_nans the
+    validity mask is computed once from the xyz view and the points (and
+    colors) are gathered in one pass into new contiguous arrays, the
+    result is then always unorganized.
+
+    :param msg: sensor_msgs/PointCloud2
+    :param remove_nans: drop points with non-finite coordinates
+    :param keep_organized: return (height, width, 3) arrays, ignored if remove_nans is True
+    :param return_rgb: also return the colors
+    :return: points, or tuple (points, rgb) if return_rgb is True
+    :rtype: np.ndarray
+    """
+    points = xyz_view_from_pointcloud2_msg(msg, keep_organized=(keep_organized and not remove_nans))
+    rgb = None
+    if return_rgb:
+        rgb = rgb_view_from_pointcloud2_msg(msg, keep_organized=(keep_organized and not remove_nans))
+
+    if remove_nans:
+        # the sum propagates NaN/inf, so one mask covers all three coordinates
+        valid = np.isfinite(points[:, 0] + points[:, 1] + points[:, 2])
+        points = _gather_valid_xyz(msg, points, valid)
+        if return_rgb:
+            rgb = rgb[valid]
+
+    if return_rgb:
+        return points, rgb
+
+    return points
+
+
+class PointCloud2Encoder(object):
+    """
+    Encodes numpy point clouds into sensor_msgs/PointCloud2 with packed float32
+    fields (12 bytes per point for xyz, vs 24 for the float64 clouds ros_numpy.msgify
+    produces from float64 arrays).
+
+    The points are written straight into a preallocated buffer that is reused
+    (and grown as needed) across calls, msg.data is then made with a single
+    copy of the used part of the buffer. An encoder isn't thread safe, use one
+    per publisher/thread.
+
+    Usage:
+
+        encoder = PointCloud2Encoder(rgb=True)
+        msg = encoder.encode(points, rgb=colors, frame_id="base")
+    """
+
+    def __init__(self, rgb=False, normals=False, intensity=False):
+        """
+        :param rgb: add a packed 'rgb' field (float32 holding b, g, r, 0 bytes, as PCL does)
+        :param normals: add normal_x, normal_y, normal_z fields
+        :param intensity: add an intensity field
+        """
+        self.has_rgb = rgb
+        self.has_normals = normals
+        self.has_intensity = intensity
+
+        names = ['x', 'y', 'z']
+        if normals:
+            names += ['normal_x', 'normal_y', 'normal_z']
+        if rgb:
+            names += ['rgb']
+        if intensity:
+            names += ['intensity']
+
+        # every field is 4 bytes so a point is point_step/4 float32 slots
+        self._offsets = dict()
+        self.fields = []
+        for i, name in enumerate(names):
+            self._offsets[name] = 4*i
+            self.fields.append(sensor_msgs.msg.PointField(name=name, offset=4*i,
+                                                          datatype=sensor_msgs.msg.PointField.FLOAT32, count=1))
+
+        self.point_step = 4*len(names)
+        self._buffer = bytearray(0)
+        self._capacity = 0
+
+    def _reserve(self, num_points):
+        if num_points > self._capacity:
+            self._capacity = max(num_points, int(1.5*self._capacity))
+            self._buffer = bytearray(self._capacity*self.point_step)
+
+        # (num_points, point_step/4) float32 view of the start of the buffer
+        floats = np.frombuffer(self._buffer, dtype='<f4', count=num_points*self.point_step//4)
+        return floats.reshape(num_points, self.point_step//4)
+
+    def encode(self, points, rgb=None, normals=None, intensity=None, frame_id=None, stamp=None, msg=None):
+        """
+        :param points: N x 3 array, or height x width x 3 for an organized cloud
+        :param rgb: N x 3 (or height x width x 3) uint8 colors in r, g, b order
+        :param normals: N x 3 (or height x width x 3) normals
+        :param intensity: length N (or height x width) intensities
+        :param frame_id: header.frame_id
+        :param stamp: header.stamp
+        :param msg: sensor_msgs/PointCloud2 to fill in, a new one is made if None
+        :return: sensor_msgs/PointCloud2
+        """
+        points = np.asarray(points)
+        if points.ndim == 3:
+            height, width = points.shape[:2]
+        else:
+            height, width = 1, points.shape[0]
+
+        num_points = height*width
+        floats = self._reserve(num_points)
+
+        floats[:, 0:3] = points.reshape(num_points, 3)
+
+        if self.has_normals:
+            if normals is None:
+                raise ValueError("encoder was created with normals=True but no normals were passed")
+            i = self._offsets['normal_x']//4
+            floats[:, i:i+3] = np.asarray(normals).reshape(num_points, 3)
+
+        if self.has_rgb:
+            if rgb is None:
+                raise ValueError("encoder was created with rgb=True but no colors were passed")
+            # little endian bytes b, g, r, 0
+            rgb = np.asarray(rgb).reshape(num_points, 3)
+            offset = self._offsets['rgb']
+            bytes_view = floats.view(np.uint8)
+            bytes_view[:, offset] = rgb[:, 2]
+            bytes_view[:, offset + 1] = rgb[:, 1]
+            bytes_view[:, offset + 2] = rgb[:, 0]
+            bytes_view[:, offset + 3] = 0
+
+        if self.has_intensity:
+            if intensity is None:
+                raise ValueError("encoder was created with intensity=True but no intensity was passed")
+            floats[:, self._offsets['intensity']//4] = np.asarray(intensity).reshape(num_points)
+
+        if msg is None:
+            msg = sensor_msgs.msg.PointCloud2()
+
+        if frame_id is not None:
+            msg.header.frame_id = frame_id
+        if stamp is not None:
+            msg.header.stamp = stamp
+
+        msg.height = height
+        msg.width = width
+        msg.fields = self.fields
+        msg.is_bigendian = False
+        msg.point_step = self.point_step
+        msg.row_step = self.point_step*width
+        msg.is_dense = bool(np.isfinite(floats[:, 0:3]).all())
+
+        # genpy needs a str for uint8[] in python 2, this is the only copy
+        msg.data = floats.tobytes()
+
+        return msg
@@ -0,0 +1,206 @@
+# system
+import numpy as np
+
+# director
+from director import vtkAll as vtk
+from director import vtkNumpy as vnp
+from director import transformUtils
+
+
+"""
+Spatial index for cropping the same point cloud over and over.
+
+director's segmentation.cropToBox/cropToLineSegment/thresholdPoints run the
+whole cloud through a vtk pipeline for every crop. PointCloudIndex sorts the
+points into a uniform grid once (a CSR layout, point ids grouped by cell), a
+crop then looks up the cells overlapping its bounding box in the sorted cell
+keys and only tests their points.
+
+getPointCloudIndex builds the index on first use and keeps it until the
+cloud's points change, so e.g. repeated fits against the 'openni point cloud'
+only pay for the points near the query.
+
+Usage:
+
+    polyData = cropToBox(pointCloud, t, [0.3, 0.3, 0.5])
+    polyData = cropToCylinder(pointCloud, p1, p2, radius=0.1)
+
+    index = getPointCloudIndex(pointCloud)
+    ids = index.pointsInSphere(center, 0.05)
+"""
+
+DEFAULT_CELL_SIZE = 0.02
+
+
+def _toMatrix(transform):
+    if isinstance(transform, vtk.vtkTransform):
+        return transformUtils.getNumpyFromTransform(transform)
+    return np.asarray(transform, dtype=np.float64)
+
+
+class PointCloudIndex(object):
+
+    def __init__(self, points, cellSize=DEFAULT_CELL_SIZE):
+        """
+        :param points: N x 3 array, non finite points (e.g. of organized clouds) are left out
+        :param cellSize: edge length of the grid cells
+        """
+        self.points = points
+        self.cellSize = float(cellSize)
+
+        ids = np.flatnonzero(np.all(np.isfinite(points), axis=1))
+        valid = np.asarray(points[ids], dtype=np.float64)
+        self._origin = valid.min(axis=0) if len(valid) else np.zeros(3)
+
+        coords = np.floor((valid - self._origin)/self.cellSize).astype(np.int64)
+        self._dims = (coords.max(axis=0) + 1) if len(coords) else np.ones(3, dtype=np.int64)
+        keys = (coords[:, 0]*self._dims[1] + coords[:, 1])*self._dims[2] + coords[:, 2]
+
+        order = np.argsort(keys, kind='mergesort')
+
+        # CSR layout, the points of cell n are self._pointIds[self._starts[n]:self._starts[n+1]]
+        self._pointIds = ids[order]
+        self._cellKeys, self._starts = np.unique(keys[order], return_index=True)
+        self._starts = np.append(self._starts, len(order))
+
+    @property
+    def numberOfPoints(self):
+        return len(self._pointIds)
+
+    def _candidateIds(self, lower, upper):
+        """
+        :return: ids of the points in the cells overlapping the box [lower, upper]
+        """
+        lo = np.maximum(np.floor((np.asarray(lower) - self._origin)/self.cellSize), 0).astype(np.int64)
+        hi = np.minimum(np.floor((np.asarray(upper) - self._origin)/self.cellSize), self._dims - 1).astype(np.int64)
+        if np.any(hi < lo):
+            return np.zeros(0, dtype=np.int64)
+
+        # the keys of the covered cells with the same x and y are one contiguous
+        # range, look up the occupied cells of each of those ranges in the sorted keys
+        x, y = np.meshgrid(np.arange(lo[0], hi[0] + 1), np.arange(lo[1], hi[1] + 1), indexing='ij')
+        rowKeys = ((x*self._dims[1] + y)*self._dims[2]).ravel()
+        first = np.searchsorted(self._cellKeys, rowKeys + lo[2], side='left')
+        last = np.searchsorted(self._cellKeys, rowKeys + hi[2], side='right')
+        rowCounts = last - first
+        if rowCounts.sum() == 0:
+            return np.zeros(0, dtype=np.int64)
+        cells = np.repeat(first, rowCounts) + \
+            (np.arange(rowCounts.sum()) - np.repeat(np.cumsum(rowCounts) - rowCounts, rowCounts))
+
+        counts = self._starts[cells + 1] - self._starts[cells]
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        return self._pointIds[np.repeat(self._starts[cells], counts) + offsets]
+
+    def pointsInBox(self, transform, dimensions):
+        """
+        :param transform: pose of the box center, vtkTransform or 4 x 4 array
+        :param dimensions: edge lengths of the box along its x, y and z axes
+        :return: ids of the points inside the box, ascending
+        :rtype: np.ndarray
+        """
+        T = _toMatrix(transform)
+        halfDims = 0.5*np.asarray(dimensions, dtype=np.float64)
+
+        # bounding box of the oriented box
+        extent = np.abs(T[:3, :3]).dot(halfDims)
+        ids = self._candidateIds(T[:3, 3] - extent, T[:3, 3] + extent)
+
+        local = (np.asarray(self.points[ids], dtype=np.float64) - T[:3, 3]).dot(T[:3, :3])
+        inside = np.all(np.abs(local) <= halfDims, axis=1)
+        return np.sort(ids[inside])
+
+    def pointsInCylinder(self, p1, p2, radius):
+        """
+        :return: ids of the points within radius of the segment p1 p2 whose
+        projection onto the axis falls between p1 and p2, ascending
+        :rtype: np.ndarray
+        """
+        p1 = np.asarray(p1, dtype=np.float64)
+        p2 = np.asarray(p2, dtype=np.float64)
+        axis = p2 - p1
+        length = np.linalg.norm(axis)
+        axis /= length
+
+        # bounding box of the cylinder
+        extent = radius*np.sqrt(np.clip(1.0 - axis**2, 0.0, 1.0))
+        ids = self._candidateIds(np.minimum(p1, p2) - extent, np.maximum(p1, p2) + extent)
+
+        d = np.asarray(self.points[ids], dtype=np.float64) - p1
+        along = d.dot(axis)
+        d -= np.outer(along, axis)
+        inside = (along >= 0.0) & (along <= length) & (np.einsum('ij,ij->i', d, d) <= radius**2)
+        return np.sort(ids[inside])
+
+    def pointsInSphere(self, center, radius):
+        """
+        :return: ids of the points within radius of center, ascending
+        :rtype: np.ndarray
+        """
+        center = np.asarray(center, dtype=np.float64)
+        ids = self._candidateIds(center - radius, center + radius)
+
+        d = np.asarray(self.points[ids], dtype=np.float64) - center
+        return np.sort(ids[np.einsum('ij,ij->i', d, d) <= radius**2])
+
+
+def extractPoints(polyData, ids):
+    """
+    Returns a new polyData with the points ids of polyData and their point data arrays
+    """
+    pointData = polyData.GetPointData()
+    arrays = dict()
+    for i in xrange(pointData.GetNumberOfArrays()):
+        name = pointData.GetArrayName(i)
+        if name:
+            arrays[name] = vnp.getNumpyFromVtk(polyData, name)[ids]
+
+    return vnp.numpyToPolyData(vnp.getNumpyFromVtk(polyData, 'Points')[ids], pointData=arrays)
+
+
+_indexCache = dict()
+
+
+def getPointCloudIndex(polyData, cellSize=DEFAULT_CELL_SIZE):
+    """
+    Returns the PointCloudIndex of polyData, building it only the first time
+    and again when its points were modified
+    :rtype: PointCloudIndex
+    """
+    points = polyData.GetPoints()
+    key = (id(polyData), float(cellSize))
+    entry = _indexCache.get(key)
+    if entry is not None and entry[0] is polyData and entry[1] is points and entry[2] == points.GetMTime():
+        return entry[3]
+
+    # the cloud is held on to so its id stays valid, keep only a handful around
+    if len(_indexCache) >= 8:
+        _indexCache.clear()
+
+    index = PointCloudIndex(vnp.getNumpyFromVtk(polyData, 'Points'), cellSize)
+    _indexCache[key] = (polyData, points, points.GetMTime(), index)
+    return index
+
+
+def cropToBox(polyData, transform, dimensions):
+    """
+    Like segmentation.cropToBox, answered from the cached index of polyData
+    """
+    if not polyData.GetNumberOfPoints():
+        return polyData
+    return extractPoints(polyData, getPointCloudIndex(polyData).pointsInBox(transform, dimensions))
+
+
+def cropToCylinder(polyData, p1, p2, radius):
+    """
+    Keeps the points within radius of the segment p1 p2, between its end caps
+    """
+    if not polyData.GetNumberOfPoints():
+        return polyData
+    return extractPoints(polyData, getPointCloudIndex(polyData).pointsInCylinder(p1, p2, radius))
+
+
+def cropToSphere(polyData, center, radius):
+    if not polyData.GetNumberOfPoints():
+        return polyData
+    return extractPoints(polyData, getPointCloudIndex(polyData).pointsInSphere(center, radius))
@@ -0,0 +1,391 @@
+# system
+import os
+import time
+import zlib
+import struct
+import bisect
+import threading
+import Queue
+import collections
+import numpy as np
+
+# spartan
+import spartan.utils.pointcloud2_utils as pointcloud2_utils
+
+
+"""
+Streaming recorder/replayer for point clouds, e.g. from DirectorROSVisualizer.
+
+File layout:
+
+    file header: MAGIC, version
+    chunk: chunk header (CHUNK_HEADER_FORMAT), zlib compressed payload
+    chunk: ...
+
+A chunk payload is a sequence of frames, each one is a frame header
+(FRAME_HEADER_FORMAT), the topic and frame_id strings, the 4 x 4 float64
+transform from the cloud frame to the expressed in frame, the N x 3 float32
+points and optionally the N x 3 uint8 colors.
+
+The chunk headers hold the time range of their frames, so the replayer
+builds its index by hopping from header to header without decompressing
+anything, and seeking only has to decompress a single chunk.
+"""
+
+MAGIC = 'SPCR'
+VERSION = 1
+FILE_HEADER_FORMAT = '<4sI'
+
+# compressed size, uncompressed size, number of frames, min stamp, max stamp
+CHUNK_HEADER_FORMAT = '<QQIdd'
+
+# stamp, number of points, topic length, frame_id length, has rgb
+FRAME_HEADER_FORMAT = '<dIHHB'
+
+PointCloudFrame = collections.namedtuple('PointCloudFrame',
+                                         ['topic', 'stamp', 'frame_id', 'transform', 'points', 'rgb'])
+
+
+def _encode_frame(frame):
+    topic = str(frame.topic)
+    frame_id = str(frame.frame_id)
+    points = np.ascontiguousarray(frame.points, dtype='<f4').reshape(-1, 3)
+    has_rgb = frame.rgb is not None
+
+    parts = [struct.pack(FRAME_HEADER_FORMAT, frame.stamp, len(points), len(topic), len(frame_id), has_rgb),
+             topic, frame_id,
+             np.ascontiguousarray(frame.transform, dtype='<f8').tobytes(),
+             points.tobytes()]
+
+    if has_rgb:
+        parts.append(np.ascontiguousarray(frame.rgb, dtype=np.uint8).reshape(-1, 3).tobytes())
+
+    return ''.join(parts)
+
+
+def _decode_frames(payload):
+    """
+    Generator over the frames in an uncompressed chunk payload. The arrays
+    are views into payload.
+    """
+    header_size = struct.calcsize(FRAME_HEADER_FORMAT)
+    offset = 0
+    while offset < len(payload):
+        stamp, num_points, topic_len, frame_id_len, has_rgb = \
+            struct.unpack_from(FRAME_HEADER_FORMAT, payload, offset)
+        offset += header_size
+
+        topic = payload[offset:offset + topic_len]
+        offset += topic_len
+        frame_id = payload[offset:offset + frame_id_len]
+        offset += frame_id_len
+
+        transform = np.frombuffer(payload, dtype='<f8', count=16, offset=offset).reshape(4, 4)
+        offset += 16*8
+
+        points = np.frombuffer(payload, dtype='<f4', count=3*num_points, offset=offset).reshape(-1, 3)
+        offset += 12*num_points
+
+        rgb = None
+        if has_rgb:
+            rgb = np.frombuffer(payload, dtype=np.uint8, count=3*num_points, offset=offset).reshape(-1, 3)
+            offset += 3*num_points
+
+        yield PointCloudFrame(topic, stamp, frame_id, transform, points, rgb)
+
+
+class PointCloudRecorder(object):
+    """
+    Records point clouds to a file on a background thread.
+
+    record() / record_msg() can be called from any thread and only enqueue the
+    frame. Decoding, compression and disk writes all happen on the writer
+    thread. If the writer falls behind by more than max_queue_size frames,
+    new frames are dropped and counted in num_dropped.
+    """
+
+    def __init__(self, filename, chunk_size_bytes=16*1024*1024, chunk_duration=2.0, compression_level=1,
+                 max_queue_size=30):
+        """
+        :param chunk_size_bytes: flush a chunk once it holds this many uncompressed bytes
+        :param chunk_duration: or once it spans this many seconds
+        :param compression_level: zlib level, 1 is fast and already does well on point clouds
+        """
+        self.filename = filename
+        self.chunk_size_bytes = chunk_size_bytes
+        self.chunk_duration = chunk_duration
+        self.compression_level = compression_level
+
+        self._queue = Queue.Queue(maxsize=max_queue_size)
+        self._thread = None
+        self._file = None
+
+        self._chunk_parts = []
+        self._chunk_size = 0
+        self._chunk_num_frames = 0
+        self._chunk_min_stamp = None
+        self._chunk_max_stamp = None
+
+        self.num_recorded = 0
+        self.num_dropped = 0
+        self.num_bytes_written = 0
+
+    def start(self):
+        directory = os.path.dirname(self.filename)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+
+        self._file = open(self.filename, 'wb')
+        self._file.write(struct.pack(FILE_HEADER_FORMAT, MAGIC, VERSION))
+
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """
+        Writes out everything still queued and closes the file
+        """
+        if self._thread is None:
+            return
+
+        self._queue.put(None)
+        self._thread.join()
+        self._thread = None
+
+    def record(self, frame):
+        """
+        :param frame: PointCloudFrame
+        :return: False if the frame was dropped
+        :rtype: bool
+        """
+        try:
+            self._queue.put_nowait(frame)
+            return True
+        except Queue.Full:
+            self.num_dropped += 1
+            return False
+
+    def record_msg(self, topic, msg, transform):
+        """
+        Records a sensor_msgs/PointCloud2. The message is decoded on the writer thread.
+        :param transform: 4 x 4 transform from msg.header.frame_id to the expressed in frame
+        """
+        return self.record((topic, msg, transform))
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+
+            if isinstance(item, PointCloudFrame):
+                frame = item
+            else:
+                topic, msg, transform = item
+                frame = PointCloudRecorder.frame_from_msg(topic, msg, transform)
+
+            self._add_frame(frame)
+
+        self._flush_chunk()
+        self._file.close()
+        self._file = None
+
+    @staticmethod
+    def frame_from_msg(topic, msg, transform):
+        """
+        :return: PointCloudFrame with the NaN points removed
+        """
+        has_rgb = (pointcloud2_utils.get_pointfield(msg, 'rgb') is not None or
+                   pointcloud2_utils.get_pointfield(msg, 'rgba') is not None)
+
+        rgb = None
+        if has_rgb:
+            points, rgb = pointcloud2_utils.numpy_from_pointcloud2_msg(msg, remove_nans=True, return_rgb=True)
+        else:
+            points = pointcloud2_utils.numpy_from_pointcloud2_msg(msg, remove_nans=True)
+
+        return PointCloudFrame(topic, msg.header.stamp.to_sec(), msg.header.frame_id, transform, points, rgb)
+
+    def _add_frame(self, frame):
+        data = _encode_frame(frame)
+        self._chunk_parts.append(data)
+        self._chunk_size += len(data)
+        self._chunk_num_frames += 1
+
+        if self._chunk_min_stamp is None:
+            self._chunk_min_stamp = frame.stamp
+            self._chunk_max_stamp = frame.stamp
+        else:
+            self._chunk_min_stamp = min(self._chunk_min_stamp, frame.stamp)
+            self._chunk_max_stamp = max(self._chunk_max_stamp, frame.stamp)
+
+        self.num_recorded += 1
+
+        if (self._chunk_size >= self.chunk_size_bytes or
+                self._chunk_max_stamp - self._chunk_min_stamp >= self.chunk_duration):
+            self._flush_chunk()
+
+    def _flush_chunk(self):
+        if self._chunk_num_frames == 0:
+            return
+
+        payload = ''.join(self._chunk_parts)
+        compressed = zlib.compress(payload, self.compression_level)
+        header = struct.pack(CHUNK_HEADER_FORMAT, len(compressed), len(payload), self._chunk_num_frames,
+                             self._chunk_min_stamp, self._chunk_max_stamp)
+        self._file.write(header)
+        self._file.write(compressed)
+        self._file.flush()
+        self.num_bytes_written += len(header) + len(compressed)
+
+        self._chunk_parts = []
+        self._chunk_size = 0
+        self._chunk_num_frames = 0
+        self._chunk_min_stamp = None
+        self._chunk_max_stamp = None
+
+
+class PointCloudReplayer(object):
+    """
+    Reads a file written by PointCloudRecorder.
+
+    Usage:
+
+        replayer = PointCloudReplayer(filename)
+        for frame in replayer.frames(start_time=replayer.start_time + 5.0):
+            ...
+
+        # or feed a DirectorROSVisualizer in real time
+        replayer.play(ros_visualizer, start_time=..., rate=0.5)
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._file = open(filename, 'rb')
+        magic, version = struct.unpack(FILE_HEADER_FORMAT, self._file.read(struct.calcsize(FILE_HEADER_FORMAT)))
+        if magic != MAGIC:
+            raise ValueError("%s is not a point cloud recording" % filename)
+        if version != VERSION:
+            raise ValueError("unsupported point cloud recording version %d" % version)
+
+        self._build_index()
+        self._play_thread = None
+        self._playing = False
+
+    def _build_index(self):
+        """
+        Reads all the chunk headers, skipping over the payloads
+        """
+        self._chunks = []
+        header_size = struct.calcsize(CHUNK_HEADER_FORMAT)
+        while True:
+            header = self._file.read(header_size)
+            if len(header) < header_size:
+                break
+
+            compressed_size, uncompressed_size, num_frames, min_stamp, max_stamp = \
+                struct.unpack(CHUNK_HEADER_FORMAT, header)
+
+            d = dict()
+            d['offset'] = self._file.tell()
+            d['compressed_size'] = compressed_size
+            d['num_frames'] = num_frames
+            d['min_stamp'] = min_stamp
+            d['max_stamp'] = max_stamp
+            self._chunks.append(d)
+            self._file.seek(compressed_size, os.SEEK_CUR)
+
+        # a chunk may start before the previous one ends (stamps from
+        # different topics aren't ordered), so search on the running max
+        self._running_max_stamps = []
+        running_max = -np.inf
+        for chunk in self._chunks:
+            running_max = max(running_max, chunk['max_stamp'])
+            self._running_max_stamps.append(running_max)
+
+    @property
+    def num_frames(self):
+        return sum(chunk['num_frames'] for chunk in self._chunks)
+
+    @property
+    def start_time(self):
+        return min(chunk['min_stamp'] for chunk in self._chunks) if self._chunks else None
+
+    @property
+    def end_time(self):
+        return max(chunk['max_stamp'] for chunk in self._chunks) if self._chunks else None
+
+    def _read_chunk(self, index):
+        chunk = self._chunks[index]
+        self._file.seek(chunk['offset'])
+        return zlib.decompress(self._file.read(chunk['compressed_size']))
+
+    def frames(self, start_time=None, end_time=None, topics=None):
+        """
+        Generator over the recorded frames in recording order.
+
+        :param start_time: skip frames stamped before this, only the chunks from
+        there on are read
+        :param end_time: stop at frames stamped after this
+        :param topics: only return frames on these topics
+        """
+        first_chunk = 0
+        if start_time is not None:
+            first_chunk = bisect.bisect_left(self._running_max_stamps, start_time)
+
+        for index in xrange(first_chunk, len(self._chunks)):
+            if end_time is not None and self._chunks[index]['min_stamp'] > end_time:
+                return
+
+            for frame in _decode_frames(self._read_chunk(index)):
+                if start_time is not None and frame.stamp < start_time:
+                    continue
+                if end_time is not None and frame.stamp > end_time:
+                    continue
+                if topics is not None and frame.topic not in topics:
+                    continue
+                yield frame
+
+    def play(self, visualizer, start_time=None, end_time=None, topics=None, rate=1.0):
+        """
+        Feeds the frames into visualizer (DirectorROSVisualizer.add_recorded_frame)
+        on a background thread, paced by their stamps.
+
+        :param rate: playback speed, 1.0 is real time
+        """
+        self.stop()
+        self._playing = True
+
+        def run():
+            wall_start = None
+            stamp_start = None
+            for frame in self.frames(start_time=start_time, end_time=end_time, topics=topics):
+                if not self._playing:
+                    break
+
+                if wall_start is None:
+                    wall_start = time.time()
+                    stamp_start = frame.stamp
+
+                delay = (frame.stamp - stamp_start)/rate - (time.time() - wall_start)
+                if delay > 0:
+                    time.sleep(delay)
+
+                visualizer.add_recorded_frame(frame)
+
+            self._playing = False
+
+        self._play_thread = threading.Thread(target=run)
+        self._play_thread.daemon = True
+        self._play_thread.start()
+
+    def stop(self):
+        self._playing = False
+        if self._play_thread is not None:
+            self._play_thread.join()
+            self._play_thread = None
+
+    def close(self):
+        self.stop()
+        self._file.close()
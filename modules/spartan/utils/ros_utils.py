@@ -4,6 +4,7 @@ import time
 import random
 import os
 import math
+import threading
 import numpy as np
 
 import cv2
@@ -12,6 +13,7 @@ import cv2
 # ROS
 import rospy
 import actionlib
+import std_msgs.msg
 import geometry_msgs.msg
 import sensor_msgs.msg
 from cv_bridge import CvBridge
@@ -347,17 +349,23 @@ class JointStateSubscriber(object):
         self.joint_velocities = {}
         self.joint_efforts = {}
         self.joint_timestamps = {}
+        self.joint_receive_times = {}  # wall clock time the value arrived
+        self._condition = threading.Condition()
         self.subscriber = SimpleSubscriber(
             self.topic, sensor_msgs.msg.JointState, self.callback)
         self.subscriber.start()
 
     def callback(self, msg):
         stamp = msg.header.stamp
-        for i, name in enumerate(msg.name):
-            self.joint_positions[name] = msg.position[i]
-            self.joint_velocities[name] = msg.velocity[i]
-            self.joint_efforts[name] = msg.effort[i]
-            self.joint_timestamps[name] = stamp
+        now = time.time()
+        with self._condition:
+            for i, name in enumerate(msg.name):
+                self.joint_positions[name] = msg.position[i]
+                self.joint_velocities[name] = msg.velocity[i]
+                self.joint_efforts[name] = msg.effort[i]
+                self.joint_timestamps[name] = stamp
+                self.joint_receive_times[name] = now
+            self._condition.notify_all()
 
     def get_position_vector_from_joint_names(self, joint_name_list):
         q = np.zeros(len(joint_name_list))
@@ -383,6 +391,52 @@ class JointStateSubscriber(object):
             e[i] = self.joint_efforts[name]
         return e
 
+    def _state_age(self, joint_name_list, now):
+        # age of the oldest of the joints, None if one was never received
+        oldest = None
+        for name in joint_name_list:
+            t = self.joint_receive_times.get(name)
+            if t is None:
+                return None
+            oldest = t if oldest is None else min(oldest, t)
+        return now - oldest
+
+    def get_state_vectors_from_joint_names(self, joint_name_list, max_age=None, timeout=None):
+        '''
+        Position, velocity and effort of the joints, from the cached state if
+        every joint was updated within the last max_age seconds, otherwise
+        after waiting for messages until it is.
+
+        :param max_age: seconds, None always waits for the next message
+        :param timeout: seconds to wait at most, None waits forever
+        :return: position, velocity and effort arrays ordered like joint_name_list
+        '''
+        start = time.time()
+        with self._condition:
+            max_age = max_age or 0.0
+            while not rospy.is_shutdown():
+                now = time.time()
+                age = self._state_age(joint_name_list, now)
+                # fresh enough, or all joints were updated since we started waiting
+                if age is not None and age <= max(max_age, now - start):
+                    break
+                if timeout is not None and now - start > timeout:
+                    raise ValueError("No state for joints %s within %.2f seconds" % (joint_name_list, timeout))
+                # woken up by callback, the timeout only bounds the rospy shutdown check
+                self._condition.wait(0.1 if timeout is None else min(0.1, max(timeout - (now - start), 0.0)))
+            else:
+                # ROS shut down, whatever was received is the best there is
+                if self._state_age(joint_name_list, time.time()) is None:
+                    raise ValueError("No state for joints %s, ROS shut down" % joint_name_list)
+
+            n = len(joint_name_list)
+            q, v, e = np.zeros(n), np.zeros(n), np.zeros(n)
+            for i, name in enumerate(joint_name_list):
+                q[i] = self.joint_positions[name]
+                v[i] = self.joint_velocities[name]
+                e[i] = self.joint_efforts[name]
+        return q, v, e
+
 
 '''
 Simple wrapper around the robot_control/MoveToJointPosition service
@@ -419,6 +473,61 @@ class RobotService(object):
         
         return response
 
+    def moveThroughJointPositions(self, qs, dwellTimes=None, maxJointDegreesPerSecond=30, onWaypointReached=None,
+                                  timeout=10, connectTimeout=1.0, gracePeriod=1.0):
+        """
+        Moves through all joint positions in one blended plan, only stopping at
+        the last one and at those with a dwell time
+        :param qs: list of joint positions
+        :param dwellTimes: seconds to rest at each joint position, None to pass through all of them
+        :param onWaypointReached: called with the index of each joint position when the robot gets there
+        :param connectTimeout: seconds to wait for the waypoint reached subscriber to connect
+        :param gracePeriod: seconds to wait for the last waypoint reached message after the move finished
+        """
+        for q in qs:
+            assert len(q) == self.numJoints
+
+        if self._use_debug_speed:
+            maxJointDegreesPerSecond = min(maxJointDegreesPerSecond, self._debug_speed)
+
+        jointStates = [RobotService.jointPositionToJointStateMsg(self.jointNames, q) for q in qs]
+        if dwellTimes is None:
+            dwellTimes = []
+
+        subscriber = None
+        lastReached = threading.Event()
+        if onWaypointReached is not None:
+            def callback(msg):
+                onWaypointReached(msg.data)
+                if msg.data == len(qs) - 1:
+                    lastReached.set()
+
+            subscriber = rospy.Subscriber('robot_control/waypoint_reached', std_msgs.msg.Int32, callback,
+                                          queue_size=len(qs) + 1)
+
+        try:
+            rospy.wait_for_service('robot_control/MoveThroughJointPositions', timeout=timeout)
+
+            # messages published before the connection is up are lost
+            if subscriber is not None:
+                start = time.time()
+                while subscriber.get_num_connections() == 0 and time.time() - start < connectTimeout \
+                        and not rospy.is_shutdown():
+                    rospy.sleep(0.01)
+
+            s = rospy.ServiceProxy('robot_control/MoveThroughJointPositions',
+                                   robot_msgs.srv.MoveThroughJointPositions)
+            response = s(jointStates, dwellTimes, maxJointDegreesPerSecond)
+
+            # the last waypoint is published about when the service returns
+            if subscriber is not None and response.success and len(qs) > 0:
+                lastReached.wait(gracePeriod)
+        finally:
+            if subscriber is not None:
+                subscriber.unregister()
+
+        return response
+
     def moveToCartesianPosition(self, poseStamped, maxJointDegreesPerSecond=30, timeout=10):
 
         ikServiceName = 'robot_control/IkService'
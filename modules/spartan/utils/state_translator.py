@@ -0,0 +1,345 @@
+# system
+import time
+import select
+import threading
+import importlib
+import numpy as np
+
+# ROS
+import rospy
+import sensor_msgs.msg
+
+# LCM
+import lcm
+import bot_core as lcmbotcore
+
+# spartan
+import spartan.utils.utils as spartanUtils
+import spartan.utils.transformations as transformations
+
+
+"""
+Declarative translation of robot state between LCM and ROS.
+
+Each translator owns a joint state (preallocated position, velocity and
+effort arrays over its joints) that one or more inputs write into and that
+is published on its output whenever an input marked publish receives a
+message. The mappings are declared in a yaml config, e.g.
+
+    translators:
+      - name: joint_states
+        output: {transport: ros, topic: /joint_states}
+        joints: [iiwa_joint_1, ..., iiwa_joint_7, wsg_50_base_joint_gripper_left, wsg_50_base_joint_gripper_right]
+        inputs:
+          - transport: lcm
+            channel: IIWA_STATUS
+            type: drake.lcmt_iiwa_status
+            joints: [iiwa_joint_1, ..., iiwa_joint_7]   # defaults to all joints
+            position: {field: joint_position_measured}
+            velocity: {field: joint_velocity_estimated, slice: [0, 7]}
+            effort: {field: joint_torque_external}
+          - transport: ros
+            topic: /wsg50_driver/wsg50/status
+            type: wsg_50_common.msg.Status
+            joints: [wsg_50_base_joint_gripper_left, wsg_50_base_joint_gripper_right]
+            position: {field: width, scale: [-0.5, 0.5]}   # scalar fields are broadcast
+            publish: false                                   # only update the state
+
+      - name: est_robot_state
+        output: {transport: lcm, channel: EST_ROBOT_STATE, type: robot_state, base_position: [0, 0, 0, 0, 0, 0]}
+        ...
+
+Outputs are sensor_msgs/JointState on a ROS topic ('ros') or
+bot_core.robot_state_t on an LCM channel ('lcm'). A field mapping copies
+msg.<field>[slice] * scale + offset into the input's joints.
+
+All translators of a config run in one StateTranslatorNode: every LCM channel
+and ROS topic is subscribed once and decoded once, however many translators
+read it. LCM is handled on one thread blocking in select() on the LCM file
+descriptor, ROS messages arrive on the rospy subscriber threads. Outgoing
+messages are allocated once and point at the translators' arrays, nothing
+is allocated per message besides the decoded input.
+"""
+
+STATE_FIELDS = ['position', 'velocity', 'effort']
+
+
+def importType(name):
+    """
+    :param name: dotted name, e.g. 'drake.lcmt_iiwa_status' or 'wsg_50_common.msg.Status'
+    """
+    moduleName, typeName = name.rsplit('.', 1)
+    return getattr(importlib.import_module(moduleName), typeName)
+
+
+class FieldMapping(object):
+
+    def __init__(self, field, numJoints, fieldSlice=None, scale=None, offset=None):
+        """
+        :param field: attribute of the input message, a scalar or an array
+        :param fieldSlice: [start, stop] of the array field, defaults to the first numJoints entries
+        :param scale: scalar or one per joint
+        :param offset: scalar or one per joint
+        """
+        self.field = field
+        start, stop = fieldSlice if fieldSlice is not None else (0, numJoints)
+        if stop - start != numJoints:
+            raise ValueError("slice %s of field %s doesn't match %d joints" % (fieldSlice, field, numJoints))
+        self.start = start
+        self.stop = stop
+        self.scale = None if scale is None else np.asarray(scale, dtype=np.float64)
+        self.offset = None if offset is None else np.asarray(offset, dtype=np.float64)
+
+    @staticmethod
+    def fromConfig(config, numJoints):
+        if not isinstance(config, dict):
+            config = {'field': config}
+        return FieldMapping(config['field'], numJoints, fieldSlice=config.get('slice'), scale=config.get('scale'),
+                            offset=config.get('offset'))
+
+    def apply(self, msg, out):
+        """
+        Writes the mapped field of msg into out in place
+        """
+        value = getattr(msg, self.field)
+        if np.isscalar(value):
+            out.fill(value)
+        else:
+            out[:] = value[self.start:self.stop]
+        if self.scale is not None:
+            out *= self.scale
+        if self.offset is not None:
+            out += self.offset
+
+
+class TranslatorInput(object):
+
+    def __init__(self, translator, jointNames, mappings, publish=True):
+        """
+        :param mappings: dict state field -> FieldMapping
+        :param publish: publish the translator's output after every message
+        """
+        self.translator = translator
+        self.publish = publish
+        self.mappings = mappings
+
+        indices = np.array([translator.jointNames.index(name) for name in jointNames], dtype=np.int64)
+        contiguous = len(indices) > 0 and np.array_equal(indices, np.arange(indices[0], indices[0] + len(indices)))
+
+        # contiguous joints are written straight into a view of the state arrays,
+        # others through a buffer that is scattered afterwards
+        self._targets = []
+        for name, mapping in mappings.iteritems():
+            array = translator.arrays[name]
+            if contiguous:
+                self._targets.append((mapping, array[indices[0]:indices[0] + len(indices)], None, None))
+            else:
+                self._targets.append((mapping, np.zeros(len(indices)), array, indices))
+
+    def handle(self, msg):
+        translator = self.translator
+        with translator.lock:
+            for mapping, out, array, indices in self._targets:
+                mapping.apply(msg, out)
+                if array is not None:
+                    array[indices] = out
+            if self.publish:
+                translator.output.publish()
+
+
+class JointStateOutput(object):
+    """
+    sensor_msgs/JointState on a ROS topic
+    """
+
+    def __init__(self, translator, publisher):
+        self.publisher = publisher
+        self.msg = sensor_msgs.msg.JointState()
+        self.msg.name = translator.jointNames
+        self.msg.position = translator.arrays['position']
+        self.msg.velocity = translator.arrays['velocity']
+        self.msg.effort = translator.arrays['effort']
+
+    def publish(self):
+        self.msg.header.stamp = rospy.Time.now()
+        # rospy serializes right away, the arrays may change after this returns
+        self.publisher.publish(self.msg)
+
+
+class RobotStateOutput(object):
+    """
+    bot_core.robot_state_t on an LCM channel
+    """
+
+    def __init__(self, translator, lc, channel, basePosition=None):
+        self.lc = lc
+        self.channel = channel
+
+        basePosition = np.zeros(6) if basePosition is None else np.asarray(basePosition, dtype=np.float64)
+        quat = transformations.quaternion_from_euler(*basePosition[3:6])
+
+        m = lcmbotcore.robot_state_t()
+        m.pose = lcmbotcore.position_3d_t()
+        m.pose.translation = lcmbotcore.vector_3d_t()
+        m.pose.translation.x, m.pose.translation.y, m.pose.translation.z = basePosition[0:3]
+        m.pose.rotation = lcmbotcore.quaternion_t()
+        m.pose.rotation.w, m.pose.rotation.x, m.pose.rotation.y, m.pose.rotation.z = quat
+        m.twist = lcmbotcore.twist_t()
+        m.twist.linear_velocity = lcmbotcore.vector_3d_t()
+        m.twist.angular_velocity = lcmbotcore.vector_3d_t()
+        m.num_joints = len(translator.jointNames)
+        m.joint_name = translator.jointNames
+        m.joint_position = translator.arrays['position']
+        m.joint_velocity = translator.arrays['velocity']
+        m.joint_effort = translator.arrays['effort']
+        m.force_torque = lcmbotcore.force_torque_t()
+        m.force_torque.l_hand_force = np.zeros(3)
+        m.force_torque.l_hand_torque = np.zeros(3)
+        m.force_torque.r_hand_force = np.zeros(3)
+        m.force_torque.r_hand_torque = np.zeros(3)
+        self.msg = m
+
+    def publish(self):
+        self.msg.utime = int(time.time()*1e6)
+        self.lc.publish(self.channel, self.msg.encode())
+
+
+class StateTranslator(object):
+
+    def __init__(self, name, jointNames):
+        self.name = name
+        self.jointNames = list(jointNames)
+        self.arrays = dict((field, np.zeros(len(self.jointNames))) for field in STATE_FIELDS)
+        self.lock = threading.Lock()
+        self.inputs = []
+        self.output = None
+
+    def addInput(self, jointNames, mappings, publish=True):
+        """
+        :param mappings: dict state field -> FieldMapping
+        :rtype: TranslatorInput
+        """
+        translatorInput = TranslatorInput(self, jointNames, mappings, publish=publish)
+        self.inputs.append(translatorInput)
+        return translatorInput
+
+
+class StateTranslatorNode(object):
+
+    def __init__(self, lc=None):
+        self.lc = lc or lcm.LCM()
+        self.translators = []
+
+        self._lcmHandlers = dict()  # channel -> (type, list of handlers)
+        self._rosHandlers = dict()  # topic -> (type, list of handlers)
+        self._rosSubscribers = []
+        self._rosPublishers = dict()
+        self._stopped = False
+        self._thread = None
+
+    @staticmethod
+    def fromConfig(config):
+        """
+        :param config: dict with a 'translators' list, see the module docstring
+        """
+        node = StateTranslatorNode()
+        for translatorConfig in config['translators']:
+            node.addTranslatorFromConfig(translatorConfig)
+        return node
+
+    @staticmethod
+    def fromYamlFile(filename):
+        return StateTranslatorNode.fromConfig(spartanUtils.getDictFromYamlFilename(filename))
+
+    def addTranslatorFromConfig(self, config):
+        translator = StateTranslator(config['name'], config['joints'])
+
+        outputConfig = config['output']
+        if outputConfig['transport'] == 'ros':
+            translator.output = JointStateOutput(translator, self.getRosPublisher(outputConfig['topic']))
+        elif outputConfig['transport'] == 'lcm':
+            if outputConfig.get('type', 'robot_state') != 'robot_state':
+                raise ValueError("unsupported lcm output type %s" % outputConfig['type'])
+            translator.output = RobotStateOutput(translator, self.lc, outputConfig['channel'],
+                                                 basePosition=outputConfig.get('base_position'))
+        else:
+            raise ValueError("unknown transport %s of translator %s" % (outputConfig['transport'], translator.name))
+
+        for inputConfig in config['inputs']:
+            jointNames = inputConfig.get('joints', translator.jointNames)
+            mappings = dict()
+            for field in STATE_FIELDS:
+                if field in inputConfig:
+                    mappings[field] = FieldMapping.fromConfig(inputConfig[field], len(jointNames))
+            translatorInput = translator.addInput(jointNames, mappings, publish=inputConfig.get('publish', True))
+
+            msgType = importType(inputConfig['type'])
+            if inputConfig['transport'] == 'lcm':
+                self._addHandler(self._lcmHandlers, inputConfig['channel'], msgType, translatorInput.handle)
+            elif inputConfig['transport'] == 'ros':
+                self._addHandler(self._rosHandlers, inputConfig['topic'], msgType, translatorInput.handle)
+            else:
+                raise ValueError("unknown transport %s of translator %s" % (inputConfig['transport'], translator.name))
+
+        self.translators.append(translator)
+        return translator
+
+    def getRosPublisher(self, topic):
+        """
+        Translators publishing on the same topic share the publisher
+        """
+        if topic not in self._rosPublishers:
+            self._rosPublishers[topic] = rospy.Publisher(topic, sensor_msgs.msg.JointState, queue_size=1)
+        return self._rosPublishers[topic]
+
+    def _addHandler(self, handlers, name, msgType, handler):
+        if name in handlers:
+            if handlers[name][0] is not msgType:
+                raise ValueError("%s is read as both %s and %s" % (name, handlers[name][0], msgType))
+            handlers[name][1].append(handler)
+        else:
+            handlers[name] = (msgType, [handler])
+
+    def _subscribe(self):
+        for channel, (msgType, handlers) in self._lcmHandlers.iteritems():
+            def onLcmMessage(channel, data, msgType=msgType, handlers=handlers):
+                msg = msgType.decode(data)
+                for handler in handlers:
+                    handler(msg)
+            self.lc.subscribe(channel, onLcmMessage)
+
+        for topic, (msgType, handlers) in self._rosHandlers.iteritems():
+            def onRosMessage(msg, handlers=handlers):
+                for handler in handlers:
+                    handler(msg)
+            self._rosSubscribers.append(rospy.Subscriber(topic, msgType, onRosMessage, queue_size=1))
+
+    def _runLcm(self):
+        fileno = self.lc.fileno()
+        while not self._stopped and not rospy.is_shutdown():
+            # the timeout only bounds how long stop() takes
+            readable, _, _ = select.select([fileno], [], [], 0.1)
+            if readable:
+                self.lc.handle()
+
+    def start(self):
+        self._subscribe()
+        self._stopped = False
+        if self._lcmHandlers:
+            self._thread = threading.Thread(target=self._runLcm)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        self._stopped = True
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        for subscriber in self._rosSubscribers:
+            subscriber.unregister()
+        self._rosSubscribers = []
+
+    def run(self):
+        self.start()
+        rospy.spin()
+        self.stop()
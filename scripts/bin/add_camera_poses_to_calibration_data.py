@@ -5,7 +5,7 @@ import os
 import yaml
 import os
 
-import spartan.perception.handeyecalibration as handeyecalibration
+import spartan.calibration.handeyecalibration as handeyecalibration
 
 
 if __name__=="__main__":
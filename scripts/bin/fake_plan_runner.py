@@ -0,0 +1,26 @@
+#!/usr/bin/env python
+
+import argparse
+
+# ROS
+import rospy
+
+# spartan
+from spartan.teleop.fake_plan_runner import FakePlanRunner
+
+"""
+Runs a stand-in for plan_runner and the arm, to benchmark teleop latency
+without hardware, e.g. together with teleop_latency_benchmark.py
+"""
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--state_rate", type=float, default=200.0, help="/joint_states rate in Hz")
+    parser.add_argument("--response_delay", type=float, default=0.005, help="seconds until the arm reacts to a setpoint")
+    parser.add_argument("--time_constant", type=float, default=0.05, help="seconds, of the simulated tracking")
+    args = parser.parse_args()
+
+    rospy.init_node("fake_plan_runner")
+    planRunner = FakePlanRunner(state_rate=args.state_rate, response_delay=args.response_delay,
+                                time_constant=args.time_constant)
+    planRunner.run()
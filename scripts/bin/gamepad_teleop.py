@@ -6,8 +6,6 @@ import os
 import numpy as np
 import time
 import socket
-# Using pygame for gamepad interface
-import pygame
 
 # ROS
 import rospy
@@ -29,6 +27,8 @@ import spartan.utils.utils as spartan_utils
 import spartan.utils.transformations as transformations
 import robot_control.control_utils as control_utils
 from spartan.utils.schunk_driver import SchunkDriver
+from spartan.teleop.teleop_engine import TeleopEngine, GamepadInput, make_cartesian_gains_msg, make_force_guard_msg
+import spartan.teleop.teleop_engine as teleop_engine
 # spartan ROS
 import robot_msgs.msg
 
@@ -76,37 +76,6 @@ def make_cartesian_trajectory_goal_world_frame(pos, quat, duration):
 
     return goal
 
-def make_cartesian_gains_msg(kp_rot, kp_trans):
-    msg = robot_msgs.msg.CartesianGain()
-
-    msg.rotation.x = kp_rot
-    msg.rotation.y = kp_rot
-    msg.rotation.z = kp_rot
-
-    msg.translation.x = kp_trans
-    msg.translation.y = kp_trans
-    msg.translation.z = kp_trans
-
-    return msg
-
-def make_force_guard_msg(scale):
-    msg = robot_msgs.msg.ForceGuard()
-    external_force = robot_msgs.msg.ExternalForceGuard()
-
-    body_frame = "iiwa_link_ee"
-    expressed_in_frame = "iiwa_link_ee"
-    force_vec = scale*np.array([-1,0,0])
-
-    external_force.force.header.frame_id = expressed_in_frame
-    external_force.body_frame = body_frame
-    external_force.force.vector.x = force_vec[0]
-    external_force.force.vector.y = force_vec[1]
-    external_force.force.vector.z = force_vec[2]
-
-    msg.external_force_guards.append(external_force)
-
-    return msg
-    
 def make_move_goal(trans, quat, duration):
     goal = make_cartesian_trajectory_goal_world_frame(
         pos = trans,
@@ -148,13 +117,64 @@ def build_rbt_from_ros_environment():
         robot)
     return robot
 
+class GamepadTeleopController(object):
+    """
+    Integrates the sticks into an end effector target, starting from the
+    end effector pose at the first update.
+
+    Gamepad: Logitech 310
+    DPad: Axis 1 +1 is down
+          Axis 0 +1 is right
+    Left stick: Axis 7 +1 is down
+                Axis 6 +1 is right
+    Right stick: Axis 3 +1 is right
+                 Axis 4 +1 is down
+    Left bumper: Button 4
+    Right bumper: Button 5
+    """
+
+    def __init__(self, hand_driver):
+        self.hand_driver = hand_driver
+        self.gripper_goal_pos = 0.1
+        self.tf_ee = None
+
+    def update_gripper(self, engine, inputs, dt):
+        buttons = inputs['buttons']
+        # steps by one main loop period per update, like the loop this replaced,
+        # not by the 0.2 s between updates
+        self.gripper_goal_pos += (buttons[5] - buttons[4])*engine.period*0.05
+        self.gripper_goal_pos = max(min(self.gripper_goal_pos, 0.1), 0.0)
+        self.hand_driver.sendGripperCommand(self.gripper_goal_pos, speed=0.1, timeout=0.01)
+        print "Gripper goal pos: ", self.gripper_goal_pos
+
+    def update(self, engine, inputs, dt):
+        if self.tf_ee is None:
+            current_pose_ee = engine.get_ee_pose()
+            if current_pose_ee is None:
+                print("Troubling looking up tf...")
+                return None
+            self.tf_ee = tf_matrix_from_pose(current_pose_ee)
+
+        axes = inputs['axes']
+        tf_ee = self.tf_ee
+        tf_ee[0, 3] += -1.*axes[7]*dt*0.25
+        tf_ee[1, 3] += -1.*axes[6]*dt*0.25
+        tf_ee[2, 3] += -1.*axes[4]*dt*0.25
+
+        dr = -1.*axes[0]*dt
+        dp = 1.*axes[1]*dt
+        dy = -1.*axes[3]*dt
+        tf_ee = tf_ee.dot(transformations.euler_matrix(dr, 0., 0.))
+        tf_ee = tf_ee.dot(transformations.euler_matrix(0, dp, 0.))
+        tf_ee = tf_ee.dot(transformations.euler_matrix(0., 0., dy))
+        self.tf_ee = tf_ee
+
+        return tf_ee[:3, 3], transformations.quaternion_from_matrix(tf_ee)
+
+
 def do_main():
     rospy.init_node('gamepad_teleop', anonymous=True)
 
-    tfBuffer = tf2_ros.Buffer()
-    listener = tf2_ros.TransformListener(tfBuffer)
-    robotSubscriber = JointStateSubscriber("/joint_states")
-    
     robotSubscriber = ros_utils.JointStateSubscriber("/joint_states")
     rospy.loginfo("Waiting for full kuka state...")
     while len(robotSubscriber.joint_positions.keys()) < 3:
@@ -162,19 +182,14 @@ def do_main():
     rospy.loginfo("got full state")
 
     rospy.loginfo("Grabbing controller...")
-    pygame.init()
-    pygame.joystick.init()
-    joysticks = [pygame.joystick.Joystick(x) for x in range(pygame.joystick.get_count())]
-    rospy.loginfo("Found %d controllers" % len(joysticks))
-    if len(joysticks) == 0:
-        rospy.logerr("Didn't find a controller :(.")
+    try:
+        gamepadInput = GamepadInput(0)
+    except ValueError as e:
+        rospy.logerr("Didn't find a controller :(. %s" % e)
         sys.exit(-1)
-    joystick = joysticks[0]
-    joystick.init()
-    rospy.loginfo("Using joystick %s" % joystick.get_name())
+    rospy.loginfo("Using joystick %s" % gamepadInput.name)
 
     handDriver = SchunkDriver()
-    gripper_goal_pos = 0.1
 
     # Start by moving to an above-table pregrasp pose that we know
     # EE control will work well from (i.e. far from singularity)
@@ -183,117 +198,33 @@ def do_main():
     success = robotService.moveToJointPosition(above_table_pre_grasp, timeout=5)
     print("Moved to position")
     # Then kick off task space streaming
-    sp = rospy.ServiceProxy('plan_runner/init_task_space_streaming',
-        robot_msgs.srv.StartStreamingPlan)
-    init = robot_msgs.srv.StartStreamingPlanRequest()
-    init.force_guard.append(make_force_guard_msg(20.))
-    print sp(init)
+    print teleop_engine.start_task_space_streaming(force_guard_scale=20.)
     print("Started task space streaming")
 
-
-    pub = rospy.Publisher('plan_runner/task_space_streaming_setpoint',
-        robot_msgs.msg.CartesianGoalPoint, queue_size=1)
-
-    tf_ee = None
-
     def cleanup():
-        rospy.wait_for_service("plan_runner/stop_plan")
-        sp = rospy.ServiceProxy('plan_runner/stop_plan',
-            std_srvs.srv.Trigger)
-        init = std_srvs.srv.TriggerRequest()
-        print sp(init)
+        print teleop_engine.stop_streaming_plan()
         print("Done cleaning up and stopping streaming plan")
 
+    rospy.on_shutdown(cleanup)
+
     frame_name = "iiwa_link_ee"
+    controller = GamepadTeleopController(handDriver)
+    engine = TeleopEngine(gamepadInput, controller, rate=100., ee_frame=frame_name, debug_frames_decimation=10)
+    engine.add_periodic(controller.update_gripper, 0.2)
+
     # origin_tf, in the above EE frame
     origin_tf = transformations.euler_matrix(0.0, 0., 0.)
     origin_tf[0:3, 3] = np.array([0.15, 0.0, 0.0])
-    origin_tf_inv = np.linalg.inv(origin_tf)
-
-    rospy.on_shutdown(cleanup)
-    br = tf.TransformBroadcaster()
+    engine.debug.set_frame("origin_tf", origin_tf[0:3, 3], transformations.quaternion_from_matrix(origin_tf),
+                           parent=frame_name)
 
     try:
-        last_gripper_update_time = time.time()
-        last_update_time = time.time()
-        while not rospy.is_shutdown():
-            #for axis_i in range(joystick.get_numaxes()):
-            #    rospy.loginfo("Axis %d: %f" % (axis_i, joystick.get_axis(axis_i)))
-            #for button_i in range(joystick.get_numbuttons()):
-            #    rospy.loginfo("Button %d: %f" % (button_i, joystick.get_button(button_i)))
-            #time.sleep(0.5)
-
-            # Gamepad: Logitech 310
-            # DPad: Axis 1 +1 is down
-            #       Axis 0 +1 is right
-            # Left stick: Axis 7 +1 is down
-            #             Axis 6 +1 is right
-            # Right stick: Axis 3 +1 is right
-            #              Axis 4 +1 is down 
-            # Left bumper: Button 4
-            # Right bumper: Button 5
-            gripper_dt = time.time() - last_gripper_update_time
-            dt = time.time() - last_update_time
-            pygame.event.pump()
-            if gripper_dt > 0.2:
-                last_gripper_update_time = time.time()
-                gripper_goal_pos += (joystick.get_button(5) - joystick.get_button(4))*dt*0.05
-                gripper_goal_pos = max(min(gripper_goal_pos, 0.1), 0.0)
-                handDriver.sendGripperCommand(gripper_goal_pos, speed=0.1, timeout=0.01)
-                print "Gripper goal pos: ", gripper_goal_pos
-                br.sendTransform(origin_tf[0:3, 3],
-                                 ro(transformations.quaternion_from_matrix(origin_tf)),
-                                 rospy.Time.now(),
-                                 "origin_tf",
-                                 frame_name)
-
-            try:
-                current_pose_ee = ros_utils.poseFromROSTransformMsg(
-                    tfBuffer.lookup_transform("base", frame_name, rospy.Time()).transform)
-            except (tf2_ros.LookupException, tf2_ros.ConnectivityException, tf2_ros.ExtrapolationException):
-                print("Troubling looking up tf...")
-                rate.sleep()
-                continue
-
-            if dt > 0.01:
-                last_update_time = time.time()
-                if tf_ee is None:
-                    tf_ee = tf_matrix_from_pose(current_pose_ee)
-                    
-
-                tf_ee[0, 3] += -1.*joystick.get_axis(7)*dt*0.25
-                tf_ee[1, 3] += -1.*joystick.get_axis(6)*dt*0.25
-                tf_ee[2, 3] += -1.*joystick.get_axis(4)*dt*0.25
-
-                dr = -1.*joystick.get_axis(0)*dt
-                dp = 1.*joystick.get_axis(1)*dt
-                dy = -1.*joystick.get_axis(3)*dt
-                tf_ee = tf_ee.dot(transformations.euler_matrix(dr, 0., 0.))
-                tf_ee = tf_ee.dot(transformations.euler_matrix(0, dp, 0.))
-                tf_ee = tf_ee.dot(transformations.euler_matrix(0., 0., dy))
-
-                target_trans_ee = tf_ee[:3, 3]
-                target_quat_ee = transformations.quaternion_from_matrix(tf_ee)
-
-                new_msg = robot_msgs.msg.CartesianGoalPoint()
-                new_msg.xyz_point.header.frame_id = "world"
-                new_msg.xyz_point.point.x = target_trans_ee[0]
-                new_msg.xyz_point.point.y = target_trans_ee[1]
-                new_msg.xyz_point.point.z = target_trans_ee[2]
-                new_msg.xyz_d_point.x = 0.
-                new_msg.xyz_d_point.y = 0.
-                new_msg.xyz_d_point.z = 0.0
-                new_msg.quaternion.w = target_quat_ee[0]
-                new_msg.quaternion.x = target_quat_ee[1]
-                new_msg.quaternion.y = target_quat_ee[2]
-                new_msg.quaternion.z = target_quat_ee[3]
-                new_msg.gain = make_cartesian_gains_msg(5., 10.)
-                new_msg.ee_frame_id = frame_name
-                pub.publish(new_msg)
-
+        engine.run()
     except Exception as e:
         print "Suffered exception ", e
 
+    engine.print_stats()
+
 
 if __name__ == "__main__":
     do_main()
@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+
+import argparse
+
+# ROS
+import rospy
+
+# spartan
+import spartan.utils.utils as spartanUtils
+from spartan.perception.multi_camera_fusion import MultiCameraFusionNode
+
+"""
+Publishes the fused point cloud of several cameras. The config file lists the cameras, e.g.
+
+    reference_frame: base
+    output_topic: /multi_camera_fusion/points
+    voxel_size: 0.005
+    sync_tolerance: 0.05
+    cameras:
+      - name: d415_01
+        topic: /camera_d415_01/depth_registered/points
+        camera_config: d415_01
+        sensor: rgb # optional, by default the sensor named in the cloud's frame_id
+      - name: d415_02
+        topic: /camera_d415_02/depth_registered/points # extrinsics from TF
+"""
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-c", "--config", type=str, required=True, help="yaml file listing the cameras")
+    parser.add_argument("-r", "--rate", type=float, default=10.0, help="publishing rate in Hz")
+    args = parser.parse_args()
+
+    config = spartanUtils.getDictFromYamlFilename(args.config)
+
+    rospy.init_node("multi_camera_fusion")
+    node = MultiCameraFusionNode(config['cameras'],
+                                 reference_frame=config.get('reference_frame', 'base'),
+                                 output_topic=config.get('output_topic', '/multi_camera_fusion/points'),
+                                 voxel_size=config.get('voxel_size', 0.005),
+                                 sync_tolerance=config.get('sync_tolerance', 0.05))
+    node.run(rate=args.rate)
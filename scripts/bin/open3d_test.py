@@ -5,6 +5,7 @@ import numpy as np
 
 
 import spartan.utils.cameraposes as cameraposes
+from spartan.perception.tsdf_fusion import TSDFFusion
 
 spartan_source_dir = os.getenv("SPARTAN_SOURCE_DIR")
 Open3D_python_lib_dir = os.path.join(spartan_source_dir, "src/Open3D/build/lib")
@@ -78,55 +79,12 @@ def convert_image_idx_to_padded_string(n, numCharacters=6):
     return t.rjust(numCharacters, '0')
 
 def rgbd_integration(log_dir):
-    posegraph_file = os.path.join(log_dir, "posegraph.posegraph")
-    camera_poses = cameraposes.CameraPoses(posegraph_file)
-    num_images = len(camera_poses.poses)
-
-    width = 640
-    height = 480
-    fx = 539.075603
-    cx = 316.229489
-    fy = 539.782595
-    cy = 236.154597
-    camera_intrinsics = PinholeCameraIntrinsic(width, height, fx, fy, cx, cy)
+    config = TSDFFusion.default_config()
+    config['depth_trunc'] = 1.0
 
-    
-    start_time = time.time()
-    volume = ScalableTSDFVolume(voxel_length = 4.0 / 512.0,
-            sdf_trunc = 0.04, with_color = True)
-
-    # num_images = 500 # stay with a small number of images for now
-    idx_list = [0,500]
-    idx_list = range(0,num_images)
-    for idx in idx_list:
-        print("Integrate {:d}-th image into the volume.".format(idx))
-        prefix = convert_image_idx_to_padded_string(idx)
-        color_image_filename = os.path.join(log_dir, 'images', prefix + "_rgb.png")
-        depth_image_filename = os.path.join(log_dir, 'images', prefix + "_depth.png")
-
-        
-        color = py3d.read_image(color_image_filename)
-        depth = py3d.read_image(depth_image_filename)
-
-        rgbd = create_rgbd_image_from_color_and_depth(color, depth, convert_rgb_to_intensity=False, depth_trunc=1.0)
-
-        camera_to_reconstruction = camera_poses.getCameraPose(idx)
-        reconstruction_to_camera = np.linalg.inv(camera_to_reconstruction)
-        
-
-        volume.integrate(rgbd, camera_intrinsics, reconstruction_to_camera)
-
-    print "integrating images into tsdf took %d seconds" %(time.time() - start_time)
-
-    mesh_start_time = time.time()
-    print("Extract a triangle mesh from the volume and visualize it.")
-    mesh = volume.extract_triangle_mesh()
-    mesh.compute_vertex_normals()
-    print("Done extracting triangle mesh")
-    
-    print "extracting triangle mesh took %d seconds" %(time.time() - mesh_start_time)
-
-    print "reconstruction took %d seconds " %(time.time() - start_time)
+    fusion = TSDFFusion(config)
+    mesh = fusion.run(log_dir)
+    fusion.print_stats()
     draw_geometries([mesh])
 
 
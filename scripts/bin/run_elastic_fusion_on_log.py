@@ -2,14 +2,16 @@
 
 import argparse
 import os
+import time
 import yaml
 
+import spartan.utils.ply_utils as ply_utils
+
 # Instructions:
 # Run this script from the log folder from which you want to process data
 
-def runElasticFusion(lcmlog_filename):
+def runElasticFusion(lcmlog_filename, npz_filename=None):
     # ------------------------------
-    path_to_labelfusion = os.environ['LABELFUSION_SOURCE_DIR']
 
     # Check if needs to run
     if os.path.isfile("./reconstructed_pointcloud.vtp"):
@@ -41,63 +43,42 @@ def runElasticFusion(lcmlog_filename):
 
     print "finished ElasticFusion"
 
-    ###################################################
-    # Convert from binary to ascii .ply, then to .vtp #
-    ###################################################
-
-    # install ply if do not already have it
-    path_to_ply = path_to_labelfusion + "/src/ply"
-    if not (os.path.isdir(path_to_ply)):
-     	os.system("cd " + path_to_labelfusion + " && mkdir src && cd src && git clone https://github.com/peteflorence/ply.git")	
-     	os.system("cd " + path_to_ply + " && make")	
+    ###############################################
+    # Convert the binary .ply straight to .vtp    #
+    ###############################################
 
     ply_binary_filename = lcmlog_filename + ".ply"
+    convertPlyToVtp(ply_binary_filename, "reconstructed_pointcloud.vtp", npz_filename=npz_filename)
+
+
+def convertPlyToVtp(ply_filename, vtp_filename, npz_filename=None):
+    """
+    Memory maps the ElasticFusion surfel map and writes it out directly, no
+    ascii conversion or intermediate files
+    """
+    start_time = time.time()
+    vertices = ply_utils.load_ply_vertices(ply_filename)
+    arrays = ply_utils.vertex_arrays(vertices)
+
+    point_arrays = dict()
+    if 'radius' in arrays:
+        point_arrays['radius'] = arrays['radius']
+
+    ply_utils.write_vtp(vtp_filename, arrays['points'], normals=arrays.get('normals'),
+                        colors=arrays.get('colors'), point_arrays=point_arrays)
 
+    if npz_filename is not None:
+        ply_utils.save_npz(npz_filename, vertices)
 
-    # call ply2ascii
-    os.system(path_to_ply + "/ply2ascii <./" + ply_binary_filename + "> ./converted_to_ascii.ply")
-
-
-
-    # change header to be compatible with Director
-    # TODO: make so Director accepts other header?
-    line_elements_vertex = ""
-    with open("./converted_to_ascii_modified_header.ply", 'w') as outfile:
-        with open("./converted_to_ascii.ply") as infile:
-            counter = 0
-            for line in infile:
-                counter +=1
-                if counter == 3:
-                    line_elements_vertex = line
-                    break
-        with open(path_to_labelfusion + "/scripts/correct_ply_header.txt") as infile:
-            counter = 0
-            for line in infile:
-                counter += 1
-                if counter == 4:
-                    outfile.write(line_elements_vertex)
-                    continue
-                outfile.write(line)
-        with open("./converted_to_ascii.ply") as infile:
-        	num_skip = 14
-        	counter = 0
-        	for line in infile:
-        		counter += 1
-        		if counter <= 14:
-        			continue
-        		outfile.write(line)
-
-    # convert to vtp
-    os.system("directorPython " + path_to_labelfusion + "/scripts/convertPlyToVtp.py " +  "./converted_to_ascii_modified_header.ply")
-
-    # clean up and rename
-    # os.system("rm *.ply *.freiburg")
-    os.system("mv converted_to_ascii_modified_header.vtp reconstructed_pointcloud.vtp")
+    print "converted %d points from %s to %s in %.2f seconds" % (len(vertices), ply_filename, vtp_filename,
+                                                                time.time() - start_time)
 
 
 if __name__=="__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("-l", "--log_name", type=str, default="spartan", required=True, help="name of the lcmlog")
+    parser.add_argument("--npz", type=str, default=None, required=False,
+                        help="also save the points, normals, colors and radii to this .npz file")
     args = parser.parse_args()
-    runElasticFusion(args.log_name)
+    runElasticFusion(args.log_name, npz_filename=args.npz)
     print "ElasticFusion reconstruction exited successfully"
\ No newline at end of file
@@ -0,0 +1,27 @@
+#!/usr/bin/env python
+
+import argparse
+
+# ROS
+import rospy
+
+# spartan
+from spartan.utils.state_translator import StateTranslatorNode
+
+"""
+Runs all LCM/ROS state translators of a config in one process, e.g.
+
+    state_translators.py -c $SPARTAN_SOURCE_DIR/apps/iiwa/state_translators_sim.yaml
+
+See spartan.utils.state_translator for the config format.
+"""
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-c", "--config", type=str, required=True, help="yaml file listing the translators")
+    args = parser.parse_args()
+
+    rospy.init_node("state_translators")
+    node = StateTranslatorNode.fromYamlFile(args.config)
+    print "Running translators", ", ".join(t.name for t in node.translators)
+    node.run()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+
+import argparse
+import time
+import numpy as np
+
+# ROS
+import rospy
+
+# spartan
+from spartan.teleop.teleop_engine import TeleopEngine, InputDevice, SetpointPublisher
+from spartan.teleop.streaming_client import TaskSpaceStreamingClient
+from spartan.teleop.latency import LatencyTracker
+import spartan.teleop.teleop_engine as teleop_engine
+
+"""
+Drives task space streaming with a synthetic circular motion and reports
+the per stage latencies (input -> publish -> plan_runner receipt -> first
+joint state that moved). Run it against plan_runner, or without hardware
+against fake_plan_runner.py:
+
+    fake_plan_runner.py &
+    teleop_latency_benchmark.py --duration 10 --output teleop_latency.yaml
+"""
+
+
+class CircleInput(InputDevice):
+    """
+    Pretends to be an input device whose reading is the time since start
+    """
+
+    def start(self):
+        self.start_time = time.time()
+
+    def poll(self):
+        return time.time() - self.start_time
+
+
+class CircleController(object):
+
+    def __init__(self, center, radius=0.05, period=2.0):
+        self.center = np.array(center)
+        self.radius = radius
+        self.omega = 2*np.pi/period
+        self.quat = np.array([0., 1., 0., 0.])
+
+    def update(self, engine, t, dt):
+        offset = self.radius*np.array([np.cos(self.omega*t), np.sin(self.omega*t), 0.])
+        return self.center + offset, self.quat
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rate", type=float, default=100.0, help="teleop loop rate in Hz")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds")
+    parser.add_argument("--streaming_client_rate", type=float, default=0.0,
+                        help="publish through a TaskSpaceStreamingClient at this rate, 0 publishes directly")
+    parser.add_argument("--output", type=str, default=None, help="yaml file for the histograms")
+    args = parser.parse_args()
+
+    rospy.init_node("teleop_latency_benchmark")
+
+    tracker = LatencyTracker()
+    tracker.start_diagnostics()
+    publisher = SetpointPublisher(latency_tracker=tracker)
+    streamingClient = None
+    if args.streaming_client_rate > 0:
+        streamingClient = TaskSpaceStreamingClient(publisher=publisher, output_rate=args.streaming_client_rate)
+        streamingClient.start()
+
+    print teleop_engine.start_task_space_streaming()
+    engine = TeleopEngine(CircleInput(), CircleController(center=[0.55, 0., 0.4]), rate=args.rate,
+                          publisher=streamingClient or publisher, latency_tracker=tracker)
+    rospy.Timer(rospy.Duration(args.duration), lambda event: engine.stop(), oneshot=True)
+    engine.run()
+
+    if streamingClient is not None:
+        streamingClient.stop()
+    print teleop_engine.stop_streaming_plan()
+    # let the last setpoints arrive
+    rospy.sleep(0.5)
+
+    engine.print_stats()
+    tracker.print_summary()
+    if args.output:
+        tracker.dump(args.output)
@@ -0,0 +1,82 @@
+import sys
+import time
+import numpy as np
+
+from spartan.perception.heightmap import HeightMap
+
+
+"""
+Times HeightMap.insert_pointcloud_into_heightmap on synthetic 640 x 480
+clouds of a table with a few objects on it, as seen from a camera above.
+At 30 Hz an insert has to stay below 33 ms, the benchmark exits non-zero
+if the 95th percentile doesn't, and also checks that the decimated
+heightmap matches one built from every point.
+"""
+
+
+BUDGET_MS = 1000.0/30
+
+
+def make_synthetic_pointcloud(width=640, height=480, nan_fraction=0.1):
+    u, v = np.meshgrid(np.linspace(0.3, 0.9, width), np.linspace(-0.4, 0.4, height))
+    z = np.zeros_like(u)
+
+    # a couple of boxes on the table
+    z[(np.abs(u - 0.5) < 0.05) & (np.abs(v - 0.1) < 0.08)] = 0.12
+    z[(np.abs(u - 0.7) < 0.03) & (np.abs(v + 0.2) < 0.03)] = 0.05
+    z += np.random.normal(scale=0.002, size=z.shape)
+
+    points = np.stack([u, v, z], axis=-1).reshape(-1, 3).astype(np.float32)
+    points[np.random.rand(len(points)) < nan_fraction] = np.nan
+    return points
+
+
+def benchmark(num_frames=100):
+    hm = HeightMap.make_default()
+    print "heightmap shape", hm.shape
+
+    clouds = [make_synthetic_pointcloud() for _ in range(5)]
+    T = np.eye(4)
+
+    times = []
+    for i in range(num_frames):
+        start = time.time()
+        hm.insert_pointcloud_into_heightmap(clouds[i % len(clouds)], T)
+        times.append(time.time() - start)
+
+    times = np.array(times)*1000
+    p95 = np.percentile(times, 95)
+    print "insert: mean %.2f ms, median %.2f ms, p95 %.2f ms, max %.2f ms (budget %.0f ms)" \
+          % (times.mean(), np.median(times), p95, times.max(), BUDGET_MS)
+
+    start = time.time()
+    pc_hm = hm.heightmap_to_pointcloud()
+    print "heightmap_to_pointcloud: %.2f ms, %d points" % ((time.time() - start)*1000, len(pc_hm))
+
+    # the decimated heightmap against one built from every point
+    config = HeightMap.default_config()
+    config['max_points_per_cell'] = None
+    hm_full = HeightMap(config)
+    hm_decimated = HeightMap.make_default()
+    hm_full.insert_pointcloud_into_heightmap(clouds[0], T)
+    hm_decimated.insert_pointcloud_into_heightmap(clouds[0], T)
+    full = hm_full.get_heightmap()
+    decimated = hm_decimated.get_heightmap()
+    missing = np.isfinite(full) & ~np.isfinite(decimated)
+    both = np.isfinite(full) & np.isfinite(decimated)
+    error = np.abs(full[both] - decimated[both])
+    print "decimated vs all points: %d of %d cells missing, height error p99 %.1f mm, max %.1f mm" \
+          % (missing.sum(), np.isfinite(full).sum(), 1000*np.percentile(error, 99), 1000*error.max())
+
+    ok = True
+    if p95 > BUDGET_MS:
+        print "FAILED: p95 insert time %.2f ms is over the %.0f ms budget" % (p95, BUDGET_MS)
+        ok = False
+    if missing.sum() > 0.01*np.isfinite(full).sum():
+        print "FAILED: decimation leaves more than 1% of the cells empty"
+        ok = False
+    return ok
+
+
+if __name__ == "__main__":
+    sys.exit(0 if benchmark() else 1)
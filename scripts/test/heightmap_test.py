@@ -81,10 +81,9 @@ def test():
     hm.insert_pointcloud_into_heightmap(pc, T_H_pc)
 
     pc_hm = hm.heightmap_to_pointcloud()
-    pc2 = ros_numpy.point_cloud2.array_to_pointcloud2(pc_hm)
+    print pc_hm.shape
 
-    pc2.header.stamp = rospy.Time.now()
-    pc2.header.frame_id = "base"
+    pc2 = hm.heightmap_to_pointcloud2_msg(frame_id="base", stamp=rospy.Time.now())
 
     # now publish this in loop
     pub = rospy.Publisher('heightmap_pointcloud', sensor_msgs.msg.PointCloud2,
@@ -2,6 +2,7 @@
 
 #include "ros/ros.h"
 #include "robot_msgs/CartesianGoalPoint.h"
+#include "std_msgs/Header.h"
 
 #include <drake/math/roll_pitch_yaw.h>
 #include <drake/math/rigid_transform.h>
@@ -22,6 +23,11 @@ public:
       nh.subscribe(
         "/plan_runner/task_space_streaming_setpoint", 1,
         &TaskSpaceStreamingPlan::HandleSetpoint, this));
+    // echoes the seq of every setpoint with the time it was received,
+    // for measuring teleop latency
+    receipt_publisher_ = std::make_shared<ros::Publisher>(
+      nh.advertise<std_msgs::Header>(
+        "/plan_runner/task_space_streaming_setpoint_receipt", 10));
   }
 
   // Current robot state x = [q,v]
@@ -47,6 +53,7 @@ public:
     bool have_goal_;
 
     std::shared_ptr<ros::Subscriber> setpoint_subscriber_;
+    std::shared_ptr<ros::Publisher> receipt_publisher_;
 
     drake::TwistMatrix<double> J_ee_E_;
     drake::TwistMatrix<double> J_ee_W_;
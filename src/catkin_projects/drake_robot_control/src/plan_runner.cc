@@ -730,10 +730,22 @@ void RobotPlanRunner::ExecuteJointTrajectoryAction(
   std::map<std::string, int> name_to_idx =
       tree_->computePositionNameToIndexMap();
 
+  // If every knot comes with velocities and some interior knot has a
+  // non-zero one the plan follows them (cubic Hermite). Otherwise it's a
+  // cubic spline at rest at both ends, also for clients that fill in zero
+  // velocities and expect to pass smoothly through the interior knots.
+  std::vector<Eigen::MatrixXd> knots_dot(num_knot_points,
+                                         Eigen::MatrixXd::Zero(kNumJoints_, 1));
+  bool have_velocities = true;
+  bool have_interior_velocities = false;
+
   std::vector<double> input_time;
   for (int i = 0; i < num_knot_points; ++i) {
     const trajectory_msgs::JointTrajectoryPoint &traj_point =
         trajectory.points[i];
+    if (traj_point.velocities.size() != trajectory.joint_names.size()) {
+      have_velocities = false;
+    }
     for (int j = 0; j < trajectory.joint_names.size(); ++j) {
       std::string joint_name = trajectory.joint_names[j];
       if (name_to_idx.count(joint_name) == 0) {
@@ -749,6 +761,13 @@ void RobotPlanRunner::ExecuteJointTrajectoryAction(
       } else {
         knots[i](joint_idx, 0) = traj_point.positions[j];
       }
+      if (have_velocities) {
+        knots_dot[i](joint_idx, 0) = traj_point.velocities[j];
+        if (i > 0 && i < num_knot_points - 1 &&
+            traj_point.velocities[j] != 0.0) {
+          have_interior_velocities = true;
+        }
+      }
     }
 
     input_time.push_back(traj_point.time_from_start.toSec());
@@ -758,7 +777,9 @@ void RobotPlanRunner::ExecuteJointTrajectoryAction(
 
   const Eigen::MatrixXd knot_dot = Eigen::MatrixXd::Zero(kNumJoints_, 1);
   auto plan_local = std::make_shared<JointSpaceTrajectoryPlan>(
-      tree_, PPType::Cubic(input_time, knots, knot_dot, knot_dot));
+      tree_, (have_velocities && have_interior_velocities)
+                 ? PPType::Cubic(input_time, knots, knots_dot)
+                 : PPType::Cubic(input_time, knots, knot_dot, knot_dot));
 
   // Add ForceGuards if specified
   if (goal->force_guard.size() > 0) {
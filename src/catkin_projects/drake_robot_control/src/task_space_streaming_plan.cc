@@ -126,7 +126,8 @@ void TaskSpaceStreamingPlan::Step(
   TwistVectord T_WEr_Er;
 
   T_WEr_Er.head(3) = Eigen::Vector3d::Zero(); // hack for now
-  T_WEr_Er.tail(3) = R_WEr * xyz_d_ee_goal_;
+  // xyz_d_ee_goal_ is expressed in world, rotate it into Er
+  T_WEr_Er.tail(3) = R_ErW * xyz_d_ee_goal_;
   
   Eigen::Matrix<double, 6, 6> Ad_H_EEr =
       spartan::drake_robot_control::utils::AdjointSE3(H_EEr.linear(),
@@ -172,6 +173,12 @@ void TaskSpaceStreamingPlan::Step(
 
 void TaskSpaceStreamingPlan::HandleSetpoint(
     const robot_msgs::CartesianGoalPoint::ConstPtr& msg) {
+  std_msgs::Header receipt;
+  receipt.seq = msg->xyz_point.header.seq;
+  receipt.stamp = ros::Time::now();
+  receipt.frame_id = msg->ee_frame_id;
+  receipt_publisher_->publish(receipt);
+
   if (this->is_stopped()){
     std::cout << "In callback, but plan is stopped... forcefully unregistering." << std::endl;
     this->setpoint_subscriber_->shutdown();
@@ -1,10 +1,14 @@
 #!/usr/bin/env python
 
 # system
+import time
+import yaml
+import collections
 import numpy as np
 
 # ROS
 import rospy
+import std_msgs.msg
 import sensor_msgs.msg
 import actionlib
 from trajectory_msgs.msg import JointTrajectory, JointTrajectoryPoint
@@ -13,9 +17,15 @@ from trajectory_msgs.msg import JointTrajectory, JointTrajectoryPoint
 import robot_msgs.srv
 import robot_msgs.msg
 import robot_control.control_utils as controlUtils
+import robot_control.trajectory_generation as trajectoryGeneration
 
 
 from spartan.utils.ros_utils import JointStateSubscriber
+from spartan.utils.latency_histogram import LatencyHistogram
+
+
+# service latency stages, all measured from when the request came in
+LATENCY_STAGES = ['state', 'planning', 'send']
 
 
 class RobotMovementService(object):
@@ -29,6 +39,7 @@ class RobotMovementService(object):
         self.setupActionClients()
         self.setupRobot()
         self.setupSubscribers()
+        self.setupLatencyStats()
 
     def setupActionClients(self):
         """
@@ -49,19 +60,64 @@ class RobotMovementService(object):
         s = JointStateSubscriber(topic=self.config['joint_states_topic'])
         self.subscribers['joint_states'] = s
 
+        self.waypointReachedPublisher = rospy.Publisher(
+            self.config.get('waypoint_reached_topic', '/robot_control/waypoint_reached'), std_msgs.msg.Int32,
+            queue_size=10)
+
     def setupRobot(self):
         self.jointNames = controlUtils.getIiwaJointNames()
 
+        # per joint limits for the trajectories, the requested speed can only lower the velocity limits
+        self.jointVelocityLimits = np.deg2rad(self.config.get('joint_velocity_limits_degrees_per_second',
+                                                              [85, 85, 100, 75, 130, 135, 135]))
+        self.jointAccelerationLimits = np.deg2rad(
+            self.config.get('joint_acceleration_limits_degrees_per_second_squared', [240]*len(self.jointNames)))
+        self.knotSpacing = self.config.get('trajectory_knot_spacing', 0.05)
+
+        # a joint state at most this old is used as the start of a plan without waiting for the next one
+        self.jointStateMaxAge = self.config.get('joint_state_max_age', 0.05)
+        self.jointStateTimeout = self.config.get('joint_state_timeout', 1.0)
+
+    def setupLatencyStats(self):
+        """
+        Per service histograms of the time from request to state, to plan and
+        to sending the plan, published as yaml on the latency topic
+        """
+        self.latencyHistograms = collections.OrderedDict()
+        self.latencyStatsPublisher = rospy.Publisher(
+            self.config.get('latency_stats_topic', '/robot_control/latency'), std_msgs.msg.String, queue_size=1)
+        period = self.config.get('latency_stats_period', 5.0)
+        self.latencyStatsTimer = rospy.Timer(rospy.Duration(period), self.publishLatencyStats)
+
+    def recordLatency(self, service, startTime, stage):
+        if service not in self.latencyHistograms:
+            self.latencyHistograms[service] = collections.OrderedDict(
+                (name, LatencyHistogram(bin_width=0.001, max_latency=1.0)) for name in LATENCY_STAGES)
+        self.latencyHistograms[service][stage].add(time.time() - startTime)
+
+    def getLatencyStats(self):
+        """
+        :return: dict service -> stage -> LatencyHistogram.summary()
+        """
+        return dict((service, dict((stage, h.summary()) for stage, h in histograms.iteritems()))
+                    for service, histograms in self.latencyHistograms.iteritems())
+
+    def publishLatencyStats(self, event=None):
+        if self.latencyHistograms:
+            self.latencyStatsPublisher.publish(std_msgs.msg.String(data=yaml.dump(self.getLatencyStats())))
+
     def getRobotState(self):
-        self.subscribers['joint_states'].subscriber.waitForNextMessage()
+        """
+        The cached joint state if it is at most joint_state_max_age seconds old,
+        otherwise the next one that arrives
+        """
+        position, velocity, effort = self.subscribers['joint_states'].get_state_vectors_from_joint_names(
+            self.jointNames, max_age=self.jointStateMaxAge, timeout=self.jointStateTimeout)
         reduced_state = sensor_msgs.msg.JointState()
         reduced_state.name = self.jointNames
-        reduced_state.position = self.subscribers['joint_states']\
-            .get_position_vector_from_joint_names(self.jointNames)
-        reduced_state.velocity = self.subscribers['joint_states']\
-            .get_velocity_vector_from_joint_names(self.jointNames)
-        reduced_state.effort = self.subscribers['joint_states']\
-            .get_effort_vector_from_joint_names(self.jointNames)
+        reduced_state.position = position
+        reduced_state.velocity = velocity
+        reduced_state.effort = effort
         return reduced_state
 
     """
@@ -71,62 +127,125 @@ class RobotMovementService(object):
         """
         Callback for the MoveToJointPosition service
 
-        Constructs a joint space trajectory plan that interpolates from the current position to
-        the desired position in joint space
+        Constructs a joint space trajectory plan that moves from the current position to
+        the desired position on a straight line in joint space, as fast as the joint velocity
+        and acceleration limits allow
         :param req: robot_msgs.srv.MoveToJointPositionRequest
         :type req:
         :return:
         :rtype:
         """
     
+        startTime = time.time()
         jointStateFinal = req.joint_state
         jointStateStart = self.getRobotState()
+        self.recordLatency('move_to_joint_position', startTime, 'state')
     
         rospy.loginfo("moving robot to joint position %s", str(jointStateFinal.position))
 
-        # figure out the duration based on max joint degrees per second
-        print "jointStateStart \n", jointStateStart
-        print "jointStateFinal \n", jointStateFinal
-        print "jointStateStart.position = ", jointStateStart.position
         q_start = np.array(jointStateStart.position)
         q_end = np.array(jointStateFinal.position)
 
-        minPlanTime = 1.0
-        maxDeltaRadians = np.max(np.abs(q_end - q_start))
-        duration = maxDeltaRadians/np.deg2rad(req.max_joint_degrees_per_second)
-        duration = max(duration, minPlanTime)
+        maxVelocities = np.minimum(self.jointVelocityLimits, np.deg2rad(req.max_joint_degrees_per_second))
+        times, positions, velocities, accelerations = trajectoryGeneration.timeOptimalLinearTrajectory(
+            q_start, q_end, maxVelocities, self.jointAccelerationLimits, knotSpacing=self.knotSpacing)
+
+        rospy.loginfo("plan duration is %.2f seconds, %d knots", times[-1], len(times))
+
+        trajectory = trajectoryGeneration.makeJointTrajectory(self.jointNames, times, positions, velocities,
+                                                              accelerations)
+        self.recordLatency('move_to_joint_position', startTime, 'planning')
+
+        joint_traj_action_goal = robot_msgs.msg.JointTrajectoryGoal()
+        joint_traj_action_goal.trajectory = trajectory
+
+
+        self.joint_space_trajectory_action.send_goal(joint_traj_action_goal)
+        self.recordLatency('move_to_joint_position', startTime, 'send')
+        self.joint_space_trajectory_action.wait_for_result()
+        result = self.joint_space_trajectory_action.get_result()
 
-        rospy.loginfo("rescaled plan duration is %.2f seconds", duration)
+        finished_normally = (result.status.status == result.status.FINISHED_NORMALLY)
+        return finished_normally
+
+    def moveThroughJointPositions(self, req):
+        """
+        Callback for the MoveThroughJointPositions service
+
+        Constructs one joint space trajectory plan from the current position through all
+        requested positions, see trajectoryGeneration.blendedTrajectory. The robot only stops
+        at the last position and at positions with a dwell time, the others are blended
+        through. The index of every position is published on the waypoint reached topic
+        when the robot gets there, e.g. to capture data at each of them.
+        :param req: robot_msgs.srv.MoveThroughJointPositionsRequest
+        :type req:
+        :return:
+        :rtype:
+        """
+        numWaypoints = len(req.joint_states)
+        if numWaypoints == 0:
+            return True
 
+        if len(req.dwell_times) not in (0, numWaypoints):
+            rospy.logerr("got %d dwell times for %d joint positions", len(req.dwell_times), numWaypoints)
+            return False
 
-        trajectory = JointTrajectory()
-        trajectory.header.stamp = rospy.Time.now()
+        startTime = time.time()
+        jointStateStart = self.getRobotState()
+        self.recordLatency('move_through_joint_positions', startTime, 'state')
+        waypoints = [jointStateStart.position] + [jointState.position for jointState in req.joint_states]
+        dwellTimes = None
+        if len(req.dwell_times) > 0:
+            dwellTimes = [0.0] + list(req.dwell_times)
 
-        startTime = rospy.Duration.from_sec(0)
-        endTime = rospy.Duration.from_sec(duration)
+        rospy.loginfo("moving robot through %d joint positions", numWaypoints)
 
-        startPoint = RobotMovementService.jointTrajectoryPointFromJointState(jointStateStart, startTime)
-        endPoint = RobotMovementService.jointTrajectoryPointFromJointState(jointStateFinal, endTime)
+        maxVelocities = np.minimum(self.jointVelocityLimits, np.deg2rad(req.max_joint_degrees_per_second))
+        times, positions, velocities, accelerations, reachedTimes = trajectoryGeneration.blendedTrajectory(
+            waypoints, maxVelocities, self.jointAccelerationLimits, dwellTimes=dwellTimes,
+            knotSpacing=self.knotSpacing)
 
+        rospy.loginfo("plan duration is %.2f seconds, %d knots", times[-1], len(times))
 
-        trajectory.points = [startPoint, endPoint]
-        trajectory.joint_names = self.jointNames
+        trajectory = trajectoryGeneration.makeJointTrajectory(self.jointNames, times, positions, velocities,
+                                                              accelerations)
+        self.recordLatency('move_through_joint_positions', startTime, 'planning')
 
         joint_traj_action_goal = robot_msgs.msg.JointTrajectoryGoal()
         joint_traj_action_goal.trajectory = trajectory
 
-
         self.joint_space_trajectory_action.send_goal(joint_traj_action_goal)
+        self.recordLatency('move_through_joint_positions', startTime, 'send')
+
+        # the waypoint timers run relative to when the plan was sent
+        timers = []
+        for index, reachedTime in enumerate(reachedTimes[1:]):
+            if reachedTime <= 0:
+                # already there, e.g. the current position, rospy.Timer can't fire after 0 seconds
+                self.waypointReachedPublisher.publish(std_msgs.msg.Int32(data=index))
+                continue
+
+            def onWaypointReached(event, index=index):
+                self.waypointReachedPublisher.publish(std_msgs.msg.Int32(data=index))
+            timers.append(rospy.Timer(rospy.Duration(reachedTime), onWaypointReached, oneshot=True))
+
         self.joint_space_trajectory_action.wait_for_result()
         result = self.joint_space_trajectory_action.get_result()
 
         finished_normally = (result.status.status == result.status.FINISHED_NORMALLY)
+        if not finished_normally:
+            # don't report waypoints of a plan that was cut short
+            for timer in timers:
+                timer.shutdown()
         return finished_normally
 
     # send this out over the TrajectoryService, wait for response then respond
     def advertiseServices(self):
         rospy.loginfo("advertising services")
         self.moveToJointPositionService = rospy.Service(self.config['move_to_joint_position_service_name'], robot_msgs.srv.MoveToJointPosition, self.moveToJointPosition)
+        self.moveThroughJointPositionsService = rospy.Service(
+            self.config.get('move_through_joint_positions_service_name', '/robot_control/MoveThroughJointPositions'),
+            robot_msgs.srv.MoveThroughJointPositions, self.moveThroughJointPositions)
 
     """
     timeFromStart is a rospy.Duration object
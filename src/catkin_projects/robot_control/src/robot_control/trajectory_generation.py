@@ -0,0 +1,323 @@
+#!/usr/bin/env python
+
+# system
+import numpy as np
+
+# ROS
+import rospy
+from trajectory_msgs.msg import JointTrajectory, JointTrajectoryPoint
+
+
+"""
+Velocity and acceleration limited joint space trajectories.
+
+A move from q_start to q_end follows the straight line in joint space,
+q(s) = q_start + s*(q_end - q_start) with s going from 0 to 1 on a
+trapezoidal profile: accelerate at the largest rate any joint allows,
+cruise at the largest speed any joint allows, decelerate. Every joint stays
+within its own velocity and acceleration limit and the joint with the
+tightest limit relative to its displacement saturates, which is the time
+optimal way to traverse that path.
+
+blendedTrajectory goes through a list of waypoints in one go, with linear
+segments and parabolic blends that keep the robot moving through the
+waypoints and only stop at the end and at waypoints with a dwell time.
+
+The trajectories are sampled into dense knots (positions, velocities and
+accelerations) so plan_runner's spline through them reproduces the profile.
+"""
+
+
+class TrapezoidalProfile(object):
+    """
+    Rest to rest motion over distance with peak velocity and acceleration
+    limits. If the distance is too short to reach maxVelocity the profile is
+    triangular.
+    """
+
+    def __init__(self, distance, maxVelocity, maxAcceleration):
+        self.distance = float(distance)
+        self.acceleration = float(maxAcceleration)
+
+        # distance needed to reach maxVelocity and brake again
+        if maxVelocity**2/maxAcceleration <= self.distance:
+            self.peakVelocity = float(maxVelocity)
+        else:
+            self.peakVelocity = np.sqrt(self.distance*maxAcceleration)
+
+        self.accelerationTime = self.peakVelocity/self.acceleration if self.peakVelocity > 0 else 0.0
+        accelerationDistance = 0.5*self.peakVelocity*self.accelerationTime
+        cruiseDistance = max(self.distance - 2*accelerationDistance, 0.0)
+        self.cruiseTime = cruiseDistance/self.peakVelocity if self.peakVelocity > 0 else 0.0
+        self.duration = 2*self.accelerationTime + self.cruiseTime
+
+    @property
+    def switchingTimes(self):
+        """
+        :return: times at which the acceleration changes
+        """
+        return [self.accelerationTime, self.accelerationTime + self.cruiseTime]
+
+    def sample(self, t):
+        """
+        :param t: array of times, clipped to [0, duration]
+        :return: position, velocity and acceleration arrays at t
+        """
+        t = np.clip(np.asarray(t, dtype=np.float64), 0.0, self.duration)
+        a, v, t1 = self.acceleration, self.peakVelocity, self.accelerationTime
+        t2 = t1 + self.cruiseTime
+
+        accelerating = t < t1
+        decelerating = t >= t2
+        tr = self.duration - t  # time remaining, for the braking phase
+
+        s = np.where(accelerating, 0.5*a*t**2,
+                     np.where(decelerating, self.distance - 0.5*a*tr**2, 0.5*v*t1 + v*(t - t1)))
+        sd = np.where(accelerating, a*t, np.where(decelerating, a*tr, v))
+        sdd = np.where(accelerating, a, np.where(decelerating, -a, 0.0))
+
+        # at rest at the end
+        end = t >= self.duration
+        sd[end] = 0.0
+        sdd[end] = 0.0
+        return s, sd, sdd
+
+
+def sampleTimes(duration, knotSpacing, extraTimes=()):
+    """
+    :return: sorted knot times every knotSpacing seconds from 0 to duration,
+    plus extraTimes, e.g. the switching times of a profile
+    """
+    numIntervals = max(int(np.ceil(duration/knotSpacing)), 1)
+    times = np.concatenate([np.linspace(0.0, duration, numIntervals + 1),
+                            np.clip(np.asarray(extraTimes, dtype=np.float64), 0.0, duration)])
+    times = np.unique(times)
+    # drop knots that nearly coincide, they only make the spline stiff
+    keep = np.concatenate([[True], np.diff(times) > 1e-3*knotSpacing])
+    times = times[keep]
+    times[-1] = duration
+    return times
+
+
+def timeOptimalLinearTrajectory(qStart, qEnd, maxVelocities, maxAccelerations, knotSpacing=0.05,
+                                minDuration=0.1):
+    """
+    Straight line from qStart to qEnd in joint space, as fast as the per
+    joint limits allow
+
+    :param maxVelocities: per joint velocity limits, rad/s
+    :param maxAccelerations: per joint acceleration limits, rad/s^2
+    :param knotSpacing: seconds between knots
+    :param minDuration: tiny moves are stretched to take at least this long
+    :return: times, positions, velocities, accelerations; times is N,
+    the others N x numJoints
+    """
+    qStart = np.asarray(qStart, dtype=np.float64)
+    qEnd = np.asarray(qEnd, dtype=np.float64)
+    delta = qEnd - qStart
+    absDelta = np.abs(delta)
+    moving = absDelta > 1e-9
+
+    if not np.any(moving):
+        times = np.array([0.0, minDuration])
+        positions = np.tile(qEnd, (2, 1))
+        zeros = np.zeros_like(positions)
+        return times, positions, zeros, zeros.copy()
+
+    # limits of the path parameter s in [0, 1]
+    maxVelocity = np.min(np.asarray(maxVelocities, dtype=np.float64)[moving]/absDelta[moving])
+    maxAcceleration = np.min(np.asarray(maxAccelerations, dtype=np.float64)[moving]/absDelta[moving])
+
+    if minDuration > 0:
+        # a triangular profile over s = 1 takes 2/sqrt(a), slow it down if that's too short
+        maxAcceleration = min(maxAcceleration, 4.0/minDuration**2)
+
+    profile = TrapezoidalProfile(1.0, maxVelocity, maxAcceleration)
+    times = sampleTimes(profile.duration, knotSpacing, profile.switchingTimes)
+    s, sd, sdd = profile.sample(times)
+
+    positions = qStart + np.outer(s, delta)
+    velocities = np.outer(sd, delta)
+    accelerations = np.outer(sdd, delta)
+    positions[-1] = qEnd
+    return times, positions, velocities, accelerations
+
+
+class BlendedSegments(object):
+    """
+    Linear segments with parabolic blends through waypoints, starting and
+    ending at rest.
+
+    Segment k moves from waypoint k to k+1 at constant velocity, timed so the
+    joint with the tightest velocity limit cruises at it. Where two segments
+    meet, the velocity changes linearly over a blend centered at the
+    waypoint time, as short as the acceleration limits allow. The first and
+    last waypoint are blended with the robot at rest, so those are hit
+    exactly; the blends round off the interior waypoints, passing within
+    |dv|*tb/8 of them.
+    """
+
+    def __init__(self, waypoints, maxVelocities, maxAccelerations, maxIterations=50):
+        waypoints = np.asarray(waypoints, dtype=np.float64)
+        delta = np.diff(waypoints, axis=0)
+        numSegments = len(delta)
+
+        # fastest segment durations, then stretched where the blends would overlap
+        durations = np.maximum(np.max(np.abs(delta)/maxVelocities, axis=1), 1e-6)
+        for iteration in xrange(maxIterations):
+            velocities = np.zeros((numSegments + 2, waypoints.shape[1]))
+            velocities[1:-1] = delta/durations[:, np.newaxis]
+            blendTimes = np.max(np.abs(np.diff(velocities, axis=0))/maxAccelerations, axis=1)
+
+            needed = 0.5*(blendTimes[:-1] + blendTimes[1:])
+            if np.all(durations >= needed*(1.0 - 1e-9)):
+                break
+            durations = np.maximum(durations, needed)
+
+        self.waypoints = waypoints
+        self.velocities = velocities  # segment velocities, with rest before and after
+        self.blendTimes = blendTimes  # one per waypoint
+
+        # waypoint times, the trajectory starts when the first blend does
+        self.waypointTimes = 0.5*blendTimes[0] + np.concatenate([[0.], np.cumsum(durations)])
+        self.duration = self.waypointTimes[-1] + 0.5*blendTimes[-1]
+
+        # piecewise quadratic: start time, position, velocity and acceleration of every piece
+        starts, positions, pieceVelocities, accelerations = [], [], [], []
+        q = waypoints[0].copy()
+        t = 0.0
+        for k in xrange(len(waypoints)):
+            tb = blendTimes[k]
+            if tb > 0:
+                acceleration = (velocities[k+1] - velocities[k])/tb
+                starts.append(t)
+                positions.append(q.copy())
+                pieceVelocities.append(velocities[k].copy())
+                accelerations.append(acceleration)
+                q = q + velocities[k]*tb + 0.5*acceleration*tb**2
+                t += tb
+
+            if k < numSegments:
+                linearTime = self.waypointTimes[k+1] - 0.5*blendTimes[k+1] - t
+                if linearTime > 0:
+                    starts.append(t)
+                    positions.append(q.copy())
+                    pieceVelocities.append(velocities[k+1].copy())
+                    accelerations.append(np.zeros_like(q))
+                    q = q + velocities[k+1]*linearTime
+                    t += linearTime
+
+        self._starts = np.array(starts)
+        self._positions = np.array(positions)
+        self._velocities = np.array(pieceVelocities)
+        self._accelerations = np.array(accelerations)
+
+    @property
+    def switchingTimes(self):
+        return self._starts
+
+    def sample(self, t):
+        """
+        :return: position, velocity and acceleration arrays at the times t
+        """
+        t = np.clip(np.asarray(t, dtype=np.float64), 0.0, self.duration)
+        piece = np.clip(np.searchsorted(self._starts, t, side='right') - 1, 0, len(self._starts) - 1)
+        dt = (t - self._starts[piece])[:, np.newaxis]
+        a = self._accelerations[piece]
+        v = self._velocities[piece]
+        q = self._positions[piece] + v*dt + 0.5*a*dt**2
+        qd = v + a*dt
+        # exactly at rest at the last waypoint
+        end = t >= self.duration
+        q[end] = self.waypoints[-1]
+        qd[end] = 0.0
+        a = a.copy()
+        a[end] = 0.0
+        return q, qd, a
+
+
+def blendedTrajectory(waypoints, maxVelocities, maxAccelerations, dwellTimes=None, knotSpacing=0.05):
+    """
+    One trajectory through all waypoints (see BlendedSegments) that starts
+    and ends at rest. Waypoints with a dwell time are stopped at exactly,
+    for that long; the others are blended through with continuous velocity.
+
+    :param waypoints: M x numJoints, the first is the current position
+    :param dwellTimes: M, seconds to rest at each waypoint, None passes through all of them
+    :return: times, positions, velocities, accelerations (see
+    timeOptimalLinearTrajectory) and the time at which each waypoint is reached,
+    or passed closest for blended ones
+    """
+    waypoints = np.asarray(waypoints, dtype=np.float64)
+    maxVelocities = np.asarray(maxVelocities, dtype=np.float64)
+    maxAccelerations = np.asarray(maxAccelerations, dtype=np.float64)
+    numWaypoints = len(waypoints)
+    if dwellTimes is None:
+        dwellTimes = np.zeros(numWaypoints)
+    dwellTimes = np.array(dwellTimes, dtype=np.float64)
+
+    # drop repeated waypoints, they would make zero length segments
+    keep = [0]
+    for i in xrange(1, numWaypoints):
+        if np.any(np.abs(waypoints[i] - waypoints[keep[-1]]) > 1e-9):
+            keep.append(i)
+        else:
+            dwellTimes[keep[-1]] += dwellTimes[i]
+    index = np.searchsorted(keep, np.arange(numWaypoints), side='right') - 1
+
+    if len(keep) == 1:
+        # nowhere to go
+        return timeOptimalLinearTrajectory(waypoints[0], waypoints[0], maxVelocities, maxAccelerations) + \
+            (np.zeros(numWaypoints),)
+
+    # the trajectory stops at the ends and at every waypoint with dwell time
+    stops = [k for k, i in enumerate(keep) if k == 0 or k == len(keep) - 1 or dwellTimes[i] > 0]
+
+    allTimes, allPositions, allVelocities, allAccelerations = [], [], [], []
+    reached = np.zeros(len(keep))
+    start = 0.0
+    for first, last in zip(stops[:-1], stops[1:]):
+        segments = BlendedSegments(waypoints[keep[first:last + 1]], maxVelocities, maxAccelerations)
+        t = sampleTimes(segments.duration, knotSpacing,
+                        np.concatenate([segments.switchingTimes, segments.waypointTimes[1:-1]]))
+        q, qd, qdd = segments.sample(t)
+
+        allTimes.append(start + t)
+        allPositions.append(q)
+        allVelocities.append(qd)
+        allAccelerations.append(qdd)
+        reached[first + 1:last] = start + segments.waypointTimes[1:-1]
+        start += segments.duration
+        reached[last] = start
+        start += dwellTimes[keep[last]] if last != len(keep) - 1 else 0.0
+
+    times = np.concatenate(allTimes)
+    positions = np.concatenate(allPositions)
+    velocities = np.concatenate(allVelocities)
+    accelerations = np.concatenate(allAccelerations)
+    # where a piece ends and the next starts without dwell the knot is there twice
+    keepKnots = np.concatenate([[True], np.diff(times) > 1e-9])
+    return times[keepKnots], positions[keepKnots], velocities[keepKnots], accelerations[keepKnots], reached[index]
+
+
+def makeJointTrajectory(jointNames, times, positions, velocities=None, accelerations=None):
+    """
+    :return: trajectory_msgs/JointTrajectory with one point per entry of times
+    :rtype: JointTrajectory
+    """
+    trajectory = JointTrajectory()
+    trajectory.header.stamp = rospy.Time.now()
+    trajectory.joint_names = list(jointNames)
+
+    numJoints = len(jointNames)
+    zeros = [0.0]*numJoints
+    for i, t in enumerate(times):
+        point = JointTrajectoryPoint()
+        point.positions = positions[i].tolist()
+        point.velocities = velocities[i].tolist() if velocities is not None else zeros
+        point.accelerations = accelerations[i].tolist() if accelerations is not None else zeros
+        point.effort = zeros
+        point.time_from_start = rospy.Duration.from_sec(t)
+        trajectory.points.append(point)
+
+    return trajectory
@@ -2,6 +2,9 @@
 
 # system
 import numpy as np, math
+import select
+import threading
+import time
 
 
 # drake + LCM
@@ -21,9 +24,66 @@ from robot_msgs.srv import *
 from robot_msgs.msg import *
 import wsg_50_common.msg
 
-class JointStatePublisher:
+
+class LoopStats:
+    """
+    Interval and forwarding time statistics of the status messages,
+    accumulated between reset() calls
+    """
     def __init__(self):
-        self.rate = rospy.Rate(125)
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.last_arrival = None
+        self.sum_interval = 0.0
+        self.sum_interval_sq = 0.0
+        self.min_interval = float('inf')
+        self.max_interval = 0.0
+        self.sum_forward = 0.0
+        self.max_forward = 0.0
+
+    def add(self, arrival, forward_time):
+        if self.last_arrival is not None:
+            interval = arrival - self.last_arrival
+            self.sum_interval += interval
+            self.sum_interval_sq += interval*interval
+            self.min_interval = min(self.min_interval, interval)
+            self.max_interval = max(self.max_interval, interval)
+        self.last_arrival = arrival
+        self.count += 1
+        self.sum_forward += forward_time
+        self.max_forward = max(self.max_forward, forward_time)
+
+    def summary(self):
+        n = self.count - 1
+        if n < 1:
+            return "%d status messages" % self.count
+        mean = self.sum_interval/n
+        jitter = math.sqrt(max(self.sum_interval_sq/n - mean*mean, 0.0))
+        return ("%d status messages, %.1f Hz, interval mean %.3f ms, std %.3f ms, min %.3f ms, max %.3f ms, "
+                "forwarding mean %.3f ms, max %.3f ms") % (
+            self.count, 1.0/mean if mean > 0 else 0.0, 1000*mean, 1000*jitter, 1000*self.min_interval,
+            1000*self.max_interval, 1000*self.sum_forward/self.count, 1000*self.max_forward)
+
+
+class JointStatePublisher:
+    """
+    Forwards IIWA_STATUS to /joint_states, once per status message.
+
+    LCM is read on its own thread that blocks in select() on the LCM file
+    descriptor, so a status is forwarded as soon as it arrives instead of
+    on the next tick of a ROS rate. The JointState message is allocated
+    once and updated in place. With ~decimation N only every Nth status is
+    published. Every ~stats_period seconds the arrival interval and
+    forwarding time statistics are logged.
+    """
+    def __init__(self, decimation=1, stats_period=10.0):
+        self.decimation = max(int(decimation), 1)
+        self.stats_period = stats_period
+        self.stats = LoopStats()
+        self.last_stats_time = time.time()
+        self.num_received = 0
 
         self.robot_state = JointState()
         self.pub_joint_state = rospy.Publisher('/joint_states', JointState, queue_size=1)
@@ -33,6 +93,11 @@ class JointStatePublisher:
         self.joint_efforts = []
         self.joint_idx = {}
 
+        # the gripper callback runs on a ROS thread
+        self.lock = threading.Lock()
+        self.stopped = False
+        self.lcm_thread = None
+
         self.lc = lcm.LCM()
         self.lc.subscribe("IIWA_STATUS", self.onIiwaStatus)
         self.gripper_subscriber = rospy.Subscriber("/wsg50_driver/wsg50/status", 
@@ -58,12 +123,24 @@ class JointStatePublisher:
             self.joint_idx[str(self.joints[j])] = idx
             idx = idx + 1
 
+        self.iiwa_idx = [self.joint_idx[joint_name] for joint_name in self.iiwa_joint_names]
+
+        # the message holds on to these lists, they are only ever updated in place
+        self.robot_state.header = Header()
+        self.robot_state.name = self.joint_names
+        self.robot_state.position = self.joint_positions
+        self.robot_state.velocity = self.joint_velocities
+        self.robot_state.effort = self.joint_efforts
+
     def onIiwaStatus(self, channel, data):
+        arrival = time.time()
+        self.num_received += 1
+        if (self.num_received - 1) % self.decimation:
+            return
+
         msg = lcmt_iiwa_status.decode(data)
-        for data_idx in xrange(0, len(self.iiwa_joint_names)):
-            joint_name = self.iiwa_joint_names[data_idx]
-            if joint_name in self.joint_idx:
-                idx = self.joint_idx[joint_name]
+        with self.lock:
+            for data_idx, idx in enumerate(self.iiwa_idx):
                 self.joint_positions[idx] = msg.joint_position_measured[data_idx]
                 self.joint_velocities[idx] = msg.joint_velocity_estimated[data_idx] # TODO(gizatt) See which other fields are valid and add them here
                 self.joint_efforts[idx] = msg.joint_torque_measured[data_idx]
@@ -73,12 +150,22 @@ class JointStatePublisher:
         # (e.g. at time of writing, it was off by hours and was
         # messing up the TF server), so for now I'm approximating with
         # our local system time. -gizatt
-        self.publishROSJointStateMessage()
+            self.publishROSJointStateMessage()
+
+        self.stats.add(arrival, time.time() - arrival)
+        if arrival - self.last_stats_time >= self.stats_period:
+            rospy.loginfo("JointStatePublisher: %s" % self.stats.summary())
+            self.stats.reset()
+            self.last_stats_time = arrival
 
     def onSchunkStatus(self, msg):
         ros_time_now =  rospy.Time.now()
         
 
+        with self.lock:
+            self.updateGripper(msg)
+
+    def updateGripper(self, msg):
         # Left finger
         idx = self.joint_idx['wsg_50_base_joint_gripper_left']
         self.joint_positions[idx] = -msg.width * 0.5
@@ -97,17 +184,28 @@ class JointStatePublisher:
         # self.publishROSJointStateMessage(ros_time_now)
 
 
-    def run(self):
-        self.lc.handle_timeout(0.005)
-        self.publishROSJointStateMessage()
+    def runLcm(self):
+        fileno = self.lc.fileno()
+        while not self.stopped and not rospy.is_shutdown():
+            # the timeout only bounds how long stop() takes
+            readable, _, _ = select.select([fileno], [], [], 0.1)
+            if readable:
+                self.lc.handle()
+
+    def start(self):
+        self.stopped = False
+        self.lcm_thread = threading.Thread(target=self.runLcm)
+        self.lcm_thread.daemon = True
+        self.lcm_thread.start()
+
+    def stop(self):
+        self.stopped = True
+        if self.lcm_thread is not None:
+            self.lcm_thread.join()
+            self.lcm_thread = None
 
     def publishROSJointStateMessage(self):
-        self.robot_state.header = Header()
         self.robot_state.header.stamp = rospy.Time.now()
-        self.robot_state.name = self.joint_names
-        self.robot_state.position = self.joint_positions
-        self.robot_state.velocity = self.joint_velocities
-        self.robot_state.effort = self.joint_efforts
         self.pub_joint_state.publish(self.robot_state)
 
     def runServer(self):
@@ -116,9 +214,10 @@ class JointStatePublisher:
 
 if __name__ == '__main__':
     rospy.init_node('JointStatePublisher')
-    jp = JointStatePublisher()
+    jp = JointStatePublisher(decimation=rospy.get_param('~decimation', 1),
+                             stats_period=rospy.get_param('~stats_period', 10.0))
     print "Starting JointStatePublisher"
     jp.runServer()
-    while not rospy.is_shutdown():
-        jp.run()
-        jp.rate.sleep()
+    jp.start()
+    rospy.spin()
+    jp.stop()
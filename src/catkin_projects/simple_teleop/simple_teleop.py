@@ -27,6 +27,8 @@ import spartan.utils.utils as spartan_utils
 import spartan.utils.transformations as transformations
 import robot_control.control_utils as control_utils
 from spartan.utils.schunk_driver import SchunkDriver
+from spartan.teleop.teleop_engine import TeleopEngine, InputDevice
+import spartan.teleop.teleop_engine as teleop_engine
 # spartan ROS
 import robot_msgs.msg
 import geometry_msgs.msg
@@ -39,51 +41,143 @@ import math
 from teleop_mouse_manager import TeleopMouseManager
 
 
-def make_cartesian_gains_msg(kp_rot, kp_trans):
-    msg = robot_msgs.msg.CartesianGain()
-
-    msg.rotation.x = kp_rot
-    msg.rotation.y = kp_rot
-    msg.rotation.z = kp_rot
-
-    msg.translation.x = kp_trans
-    msg.translation.y = kp_trans
-    msg.translation.z = kp_trans
-
-    return msg
-
-def make_force_guard_msg(scale):
-    msg = robot_msgs.msg.ForceGuard()
-    external_force = robot_msgs.msg.ExternalForceGuard()
-
-    body_frame = "iiwa_link_ee"
-    expressed_in_frame = "iiwa_link_ee"
-    force_vec = scale*np.array([-1,0,0])
-
-    external_force.force.header.frame_id = expressed_in_frame
-    external_force.body_frame = body_frame
-    external_force.force.vector.x = force_vec[0]
-    external_force.force.vector.y = force_vec[1]
-    external_force.force.vector.z = force_vec[2]
-
-    msg.external_force_guards.append(external_force)
-
-    return msg
-
 def tf_matrix_from_pose(pose):
     trans, quat = pose
     mat = transformations.quaternion_matrix(quat)
     mat[:3, 3] = trans
     return mat
 
+class TeleopMouseInput(InputDevice):
+    """
+    The events dict of TeleopMouseManager
+    """
+
+    def __init__(self):
+        self.mouse_manager = TeleopMouseManager()
+
+    def poll(self):
+        return self.mouse_manager.get_events()
+
+
+class SimpleTeleopController(object):
+
+    joint_name_list = ['iiwa_joint_1', 'iiwa_joint_2', 'iiwa_joint_3', 'iiwa_joint_4', 'iiwa_joint_5', 'iiwa_joint_6', 'iiwa_joint_7']
+
+    def __init__(self, robotService, robotSubscriber, handDriver, above_table_pre_grasp, ee_tf_above_table):
+        self.robotService = robotService
+        self.robotSubscriber = robotSubscriber
+        self.handDriver = handDriver
+        self.above_table_pre_grasp = above_table_pre_grasp
+        self.ee_tf_above_table = ee_tf_above_table
+
+        self.roll_goal = 0.0
+        self.yaw_goal = 0.0
+        self.pitch_goal = 0.0
+        self.gripper_goal_pos = 0.1
+        self.ee_tf_last_commanded = None
+
+        self.pose_save_counter = 0
+        self.saved_pose_dict = dict()
+        self.saved_pose_counter = 0
+
+    def reset(self, engine):
+        print self.above_table_pre_grasp
+        print "that was above_table_pre_grasp"
+        success = self.robotService.moveToJointPosition(self.above_table_pre_grasp, timeout=3)
+        self.roll_goal = 0.0
+        self.yaw_goal = 0.0
+        self.pitch_goal = 0.0
+        engine.ee_pose_cache.invalidate()
+        self.ee_tf_last_commanded = tf_matrix_from_pose(engine.wait_for_ee_pose())
+
+    def update(self, engine, events, dt):
+        if self.ee_tf_last_commanded is None:
+            self.ee_tf_last_commanded = tf_matrix_from_pose(engine.wait_for_ee_pose())
+
+        if events["r"]:
+            self.reset(engine)
+            return None
+
+        self.pose_save_counter += 1
+        if events["o"] and self.pose_save_counter >= 100: # this make it not happen to much
+            joint_position_vector = self.robotSubscriber.get_position_vector_from_joint_names(self.joint_name_list)
+            print joint_position_vector
+            print "joint positions saved"
+            new_pose_name = "pose_"+str(self.saved_pose_counter).zfill(3)
+            self.saved_pose_counter += 1
+            self.saved_pose_dict[new_pose_name] = joint_position_vector.tolist()
+            self.pose_save_counter = 0
+
+        if events["escape"]:
+            engine.stop()
+            return None
+
+        scale_down = 0.0001
+        delta_x = events["delta_x"]*scale_down
+        delta_y = events["delta_y"]*-scale_down
+
+        delta_forward = 0.0
+        forward_scale = 0.001
+        if events["w"]:
+            delta_forward -= forward_scale
+        if events["s"]:
+            delta_forward += forward_scale
+
+        # extract and normalize quat from tf
+        if events["rotate_left"]:
+            self.roll_goal += 0.01
+        if events["rotate_right"]:
+            self.roll_goal -= 0.01
+        self.roll_goal = np.clip(self.roll_goal, a_min = -0.9, a_max = 0.9)
+
+        if events["side_button_back"]:
+            self.yaw_goal += 0.01
+            print("side button back")
+        if events["side_button_forward"]:
+            self.yaw_goal -= 0.01
+            print("side side_button_forward")
+        self.yaw_goal = np.clip(self.yaw_goal, a_min = -1.314, a_max = 1.314)
+
+        if events["d"]:
+            self.pitch_goal += 0.01
+        if events["a"]:
+            self.pitch_goal -= 0.01
+        self.pitch_goal = np.clip(self.pitch_goal, a_min = -1.314, a_max = 1.314)
+
+        R = transformations.euler_matrix(self.pitch_goal, self.roll_goal, self.yaw_goal, 'syxz')
+        # third is "yaw", when in above table pre-grasp
+        # second is "roll", ''
+        # first must be "pitch"
+
+        above_table_quat_ee = transformations.quaternion_from_matrix(R.dot(self.ee_tf_above_table))
+        above_table_quat_ee = np.array(above_table_quat_ee) / np.linalg.norm(above_table_quat_ee)
+
+        # calculate controller position delta and add to start position to get target ee position
+        self.ee_tf_last_commanded[:3, 3] += [delta_forward, delta_x, delta_y]
+        target_trans_ee = self.ee_tf_last_commanded[:3, 3]
+
+        return target_trans_ee, above_table_quat_ee, None, (self.roll_goal, self.pitch_goal, self.yaw_goal)
+
+    def update_gripper(self, engine, events, dt):
+        if events["mouse_wheel_up"]:
+            self.gripper_goal_pos += 0.006
+        if events["mouse_wheel_down"]:
+            self.gripper_goal_pos -= 0.006
+        if self.gripper_goal_pos < 0:
+            self.gripper_goal_pos = 0.0
+        if self.gripper_goal_pos > 0.1:
+            self.gripper_goal_pos = 0.1
+
+        self.handDriver.sendGripperCommand(self.gripper_goal_pos, speed=0.2, stream=True)
+
+
 def do_main():
     rospy.init_node('simple_teleop', anonymous=True)
 
     # setup listener for tf2s (used for ee and controller poses)
     tfBuffer = tf2_ros.Buffer()
     listener = tf2_ros.TransformListener(tfBuffer)
-    robotSubscriber = JointStateSubscriber("/joint_states")
-    
+
     # wait until robot state found
     robotSubscriber = ros_utils.JointStateSubscriber("/joint_states")
     print("Waiting for full kuka state...")
@@ -93,12 +187,9 @@ def do_main():
 
     # init gripper
     handDriver = SchunkDriver()
-    
+
     # init mouse manager
-    mouse_manager = TeleopMouseManager()
-    roll_goal = 0.0
-    yaw_goal = 0.0
-    pitch_goal = 0.0
+    mouse_input = TeleopMouseInput()
 
     # Start by moving to an above-table pregrasp pose that we know
     # EE control will work well from (i.e. far from singularity)
@@ -134,179 +225,37 @@ def do_main():
             time.sleep(0.1)
 
     # Then kick off task space streaming
-    sp = rospy.ServiceProxy('plan_runner/init_task_space_streaming',
-        robot_msgs.srv.StartStreamingPlan)
-    init = robot_msgs.srv.StartStreamingPlanRequest()
-    init.force_guard.append(make_force_guard_msg(20.))
-    res = sp(init)
-    
+    res = teleop_engine.start_task_space_streaming(force_guard_scale=20.)
     print("Started task space streaming")
-    pub = rospy.Publisher('plan_runner/task_space_streaming_setpoint',
-        robot_msgs.msg.CartesianGoalPoint, queue_size=1);
-
 
     def cleanup():
-        rospy.wait_for_service("plan_runner/stop_plan")
-        sp = rospy.ServiceProxy('plan_runner/stop_plan',
-            std_srvs.srv.Trigger)
-        init = std_srvs.srv.TriggerRequest()
-        print sp(init)
+        print teleop_engine.stop_streaming_plan()
         print("Done cleaning up and stopping streaming plan")
 
     rospy.on_shutdown(cleanup)
-    br = tf.TransformBroadcaster()
-    rate = rospy.Rate(100) # max rate at which control should happen
-
-
-    ee_tf_last_commanded = np.zeros((4,4))
-    def get_initial_pose():
-        while not rospy.is_shutdown():
-            # get current tf from ros world to ee
-            try:
-                ee_pose_current = ros_utils.poseFromROSTransformMsg(
-                    tfBuffer.lookup_transform("base", frame_name, rospy.Time()).transform)
-                ee_tf_last_commanded = tf_matrix_from_pose(ee_pose_current)
-                return ee_tf_last_commanded
-            except (tf2_ros.LookupException, tf2_ros.ConnectivityException, tf2_ros.ExtrapolationException):
-                print("Troubling looking up robot pose...")
-                rate.sleep()
-                continue
-
-    print ee_tf_last_commanded
-    ee_tf_last_commanded = get_initial_pose()
-    print ee_tf_last_commanded
+
+    controller = SimpleTeleopController(robotService, robotSubscriber, handDriver, above_table_pre_grasp,
+                                        ee_tf_above_table)
+    # 100 Hz is the max rate at which control should happen
+    engine = TeleopEngine(mouse_input, controller, rate=100., ee_frame=frame_name, tf_buffer=tfBuffer)
+    engine.add_periodic(controller.update_gripper, engine.period)
 
     sys.path.append("../imitation_tools/scripts")
     from capture_imitation_data_client import start_bagging_imitation_data_client, stop_bagging_imitation_data_client
     start_bagging_imitation_data_client()
-    
-    pose_save_counter = 0
-    saved_pose_dict = dict()
-    saved_pose_counter = 0
 
     try:
-
-        # control loop
-        while not rospy.is_shutdown():
-          
-            # # get teleop mouse
-            events = mouse_manager.get_events()
-
-            if events["r"]:
-                print above_table_pre_grasp
-                print "that was above_table_pre_grasp"
-                success = robotService.moveToJointPosition(above_table_pre_grasp, timeout=3)
-                roll_goal = 0.0
-                yaw_goal = 0.0
-                pitch_goal = 0.0
-                ee_tf_last_commanded = get_initial_pose()
-                continue
-
-            pose_save_counter += 1
-            if events["o"] and pose_save_counter >= 100: # this make it not happen to much
-                joint_name_list = ['iiwa_joint_1', 'iiwa_joint_2', 'iiwa_joint_3', 'iiwa_joint_4', 'iiwa_joint_5', 'iiwa_joint_6', 'iiwa_joint_7']
-                joint_position_vector = robotSubscriber.get_position_vector_from_joint_names(joint_name_list)
-                print joint_position_vector
-                print "joint positions saved"
-                new_pose_name = "pose_"+str(saved_pose_counter).zfill(3)
-                saved_pose_counter += 1
-                saved_pose_dict[new_pose_name] = joint_position_vector.tolist()
-                pose_save_counter = 0
-
-            if events["escape"]:
-                stop_bagging_imitation_data_client()
-                if len(saved_pose_dict) > 0:
-                    spartan_utils.saveToYaml(saved_pose_dict, "saved_poses.yaml")
-                sys.exit(0)
-            
-            scale_down = 0.0001
-            delta_x = events["delta_x"]*scale_down
-            delta_y = events["delta_y"]*-scale_down
-
-            delta_forward = 0.0
-            forward_scale = 0.001
-            if events["w"]:
-                delta_forward -= forward_scale
-            if events["s"]:
-                delta_forward += forward_scale
-
-            # extract and normalize quat from tf
-            if events["rotate_left"]:
-                roll_goal += 0.01
-            if events["rotate_right"]:
-                roll_goal -= 0.01
-            roll_goal = np.clip(roll_goal, a_min = -0.9, a_max = 0.9)
-            
-            if events["side_button_back"]:
-                yaw_goal += 0.01
-                print("side button back")
-            if events["side_button_forward"]:
-                yaw_goal -= 0.01
-                print("side side_button_forward")
-            yaw_goal = np.clip(yaw_goal, a_min = -1.314, a_max = 1.314)
-
-            if events["d"]:
-                pitch_goal += 0.01
-            if events["a"]:
-                pitch_goal -= 0.01
-            pitch_goal = np.clip(pitch_goal, a_min = -1.314, a_max = 1.314)
-
-
-            R = transformations.euler_matrix(pitch_goal, roll_goal, yaw_goal, 'syxz')
-            # third is "yaw", when in above table pre-grasp
-            # second is "roll", ''
-            # first must be "pitch"
-
-            above_table_quat_ee = transformations.quaternion_from_matrix(R.dot(ee_tf_above_table))
-            above_table_quat_ee = np.array(above_table_quat_ee) / np.linalg.norm(above_table_quat_ee)
-
-            # calculate controller position delta and add to start position to get target ee position
-            target_translation = np.asarray([delta_forward, delta_x, delta_y])
-            empty_matrx = np.zeros_like(ee_tf_last_commanded)
-            empty_matrx[:3, 3] = target_translation
-            ee_tf_last_commanded += empty_matrx
-            target_trans_ee = ee_tf_last_commanded[:3, 3]
-            
-
-            # publish target pose as cartesian goal point
-            new_msg = robot_msgs.msg.CartesianGoalPoint()
-            new_msg.xyz_point.header.stamp = rospy.Time.now()
-            new_msg.xyz_point.header.frame_id = "world"
-            new_msg.xyz_point.point.x = target_trans_ee[0]
-            new_msg.xyz_point.point.y = target_trans_ee[1]
-            new_msg.xyz_point.point.z = target_trans_ee[2]
-            new_msg.xyz_d_point.x = 0.0
-            new_msg.xyz_d_point.y = 0.0
-            new_msg.xyz_d_point.z = 0.0
-            new_msg.quaternion.w = above_table_quat_ee[0]
-            new_msg.quaternion.x = above_table_quat_ee[1]
-            new_msg.quaternion.y = above_table_quat_ee[2]
-            new_msg.quaternion.z = above_table_quat_ee[3]
-            new_msg.roll = roll_goal 
-            new_msg.pitch = pitch_goal
-            new_msg.yaw = yaw_goal
-            new_msg.gain = make_cartesian_gains_msg(5., 10.)
-            new_msg.ee_frame_id = frame_name
-            pub.publish(new_msg)
-
-            #gripper
-            if events["mouse_wheel_up"]:
-                gripper_goal_pos += 0.006
-            if events["mouse_wheel_down"]:
-                gripper_goal_pos -= 0.006
-            if gripper_goal_pos < 0:
-                gripper_goal_pos = 0.0
-            if gripper_goal_pos > 0.1:
-                gripper_goal_pos = 0.1
-            
-            handDriver.sendGripperCommand(gripper_goal_pos, speed=0.2, stream=True)
-
-            rate.sleep()
-
-
-
+        engine.run()
     except Exception as e:
         print "Suffered exception ", e
 
+    engine.print_stats()
+
+    # escape was pressed
+    stop_bagging_imitation_data_client()
+    if len(controller.saved_pose_dict) > 0:
+        spartan_utils.saveToYaml(controller.saved_pose_dict, "saved_poses.yaml")
+    sys.exit(0)
+
 if __name__ == "__main__":
     do_main()
\ No newline at end of file